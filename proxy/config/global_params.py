@@ -34,6 +34,12 @@ def load_openai_limits(path: str = GLOBAL_PARAMS_PATH) -> dict:
     return data.get("openAiLimits", {})
 
 
+def load_openai_key_tiers(path: str = GLOBAL_PARAMS_PATH) -> dict:
+    """Return per API key limit tiers from the global params file."""
+    data = _load_file(path)
+    return data.get("openAiKeyTiers", {})
+
+
 def load_elevenlabs_limits(path: str = GLOBAL_PARAMS_PATH) -> dict:
     """Return ElevenLabs limits from the global params file."""
     data = _load_file(path)
@@ -48,6 +54,7 @@ def load_recraft_limits(path: str = GLOBAL_PARAMS_PATH) -> dict:
 __all__ = [
     "load_openai_prices",
     "load_openai_limits",
+    "load_openai_key_tiers",
     "load_elevenlabs_limits",
     "load_recraft_limits",
     "GLOBAL_PARAMS_PATH",
@@ -2,9 +2,24 @@
 """
 Configuration settings for the proxy server
 """
+import os
 
 # Default configurations
-DEFAULT_OPENAI_CONFIG = {}
+# Бюджет повторов запроса к OpenAI (можно переопределить параметрами запроса)
+DEFAULT_OPENAI_CONFIG = {
+    "max_attempts": 6,
+    "retry_deadline_seconds": 300.0,
+    "max_backoff_seconds": 120.0,
+}
+
+# Серверный пул ключей OpenAI (через запятую). Запросы без Authorization
+# распределяются по этим ключам; пусто — пул выключен.
+OPENAI_KEY_POOL = [k.strip() for k in os.getenv("OPENAI_KEY_POOL", "").split(",") if k.strip()]
+
+# Асинхронный движок для запросов к OpenAI (нужен пакет aiohttp): все запросы
+# выполняются в одном event loop вместо отдельного потока на запрос.
+OPENAI_ASYNC_ENGINE = os.getenv("OPENAI_ASYNC_ENGINE", "").lower() in ("1", "true", "yes", "on")
+OPENAI_ASYNC_MAX_CONNECTIONS = int(os.getenv("OPENAI_ASYNC_MAX_CONNECTIONS", "200"))
 
 
 # Default configuration for proxy manager / audio requests
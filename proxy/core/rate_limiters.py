@@ -1,12 +1,437 @@
 # -*- coding: utf-8 -*-
 """Rate limiting implementations for different services"""
+import asyncio
+import hashlib
+import math
+import re
 import time
 import threading
-from collections import defaultdict
+from collections import deque
 from threading import Condition
-from typing import Dict
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
 from utils.logger import log
-from config.global_params import load_openai_limits
+from config.global_params import load_openai_limits, load_openai_key_tiers
+from config.settings import OPENAI_KEY_POOL
+from core.token_estimator import TokenEstimator
+
+
+INF = float("inf")
+
+# Vesa klassov prioriteta (zagolovok X-Priority); v ramkakh klassa — FIFO
+PRIORITY_WEIGHTS = {"high": 4, "normal": 2, "low": 1}
+DEFAULT_PRIORITY = "normal"
+
+
+def normalize_priority(priority) -> str:
+    priority = str(priority or "").strip().lower()
+    return priority if priority in PRIORITY_WEIGHTS else DEFAULT_PRIORITY
+
+
+LIMIT_KEYS = ("rpm", "rpd", "tmp", "tpd")
+NO_LIMITS: Mapping[str, float] = MappingProxyType({key: INF for key in LIMIT_KEYS})
+# Skolko raznykh imen modeley pomnim (imena prikhodyat ot klientov)
+ALIAS_MEMO_SIZE = 1024
+
+_VARIANT = re.compile(r"^(.*?)(\s*\([^)]*\))?$")          # "gpt-4.1 (long context)"
+_SNAPSHOT = re.compile(r"-(?:\d{4}-\d{2}-\d{2}|\d{4})$")  # "-2024-08-06", "-0613"
+
+
+def _compile_limit_values(model: str, values: dict) -> Mapping[str, float]:
+    result = {}
+    for key in LIMIT_KEYS:
+        value = (values or {}).get(key)
+        try:
+            result[key] = INF if value in (0, None) else int(value)
+        except (TypeError, ValueError):
+            log.warning(f"⚠️ Bad OpenAI limit {key}={value!r} for {model}, ignoring")
+            result[key] = INF
+    return MappingProxyType(result)
+
+
+def _alias_candidates(model: str):
+    """Imena iz tablitsy, kotorye mogut opisyvat ``model``: sam, bez daty, bez varianta."""
+    name = model.strip()
+    base, variant = _VARIANT.match(name).groups()
+    variant = variant or ""
+    undated = _SNAPSHOT.sub("", base)
+    for candidate in (name, name.lower(), undated + variant, base, undated):
+        yield candidate
+        yield candidate.lower()
+
+
+class _LimitsTable:
+    """Resolved, read-only limits per model plus a memo of resolved aliases.
+
+    Built once per load/reload and swapped as a whole, so lookups need no lock.
+    """
+
+    __slots__ = ("models", "default", "memo")
+
+    def __init__(self, raw: dict):
+        raw = raw or {}
+        self.models = {model: _compile_limit_values(model, values)
+                       for model, values in raw.items() if isinstance(values, dict)}
+        self.default = self.models.get("default", NO_LIMITS)
+        self.memo: Dict[str, Mapping[str, float]] = dict(self.models)
+
+    def get(self, model: str) -> Mapping[str, float]:
+        limits = self.memo.get(model)
+        if limits is None:
+            limits = self.resolve(model)
+            if len(self.memo) < len(self.models) + ALIAS_MEMO_SIZE:
+                self.memo[model] = limits
+        return limits
+
+    def resolve(self, model: str) -> Mapping[str, float]:
+        model = model or ""
+        for candidate in _alias_candidates(model):
+            limits = self.models.get(candidate)
+            if limits is not None:
+                return limits
+        # Staroe povedenie: pervyy klyuch, soderzhashchiy imya modeli
+        if model:
+            for key, limits in self.models.items():
+                if model in key:
+                    return limits
+        return self.default
+
+
+def _tier_limits(raw: dict, tier: dict) -> dict:
+    """Tablitsa limitov tira: bazovaya * scale, poverkh — yavnye limity modeley."""
+    scale = tier.get("scale", 1)
+    result = {
+        model: {k: (int(v * scale) if isinstance(v, (int, float)) and v else v) for k, v in values.items()}
+        for model, values in (raw or {}).items() if isinstance(values, dict)
+    }
+    for model, override in (tier.get("models") or {}).items():
+        if isinstance(override, dict):
+            result.setdefault(model, {}).update(override)
+    return result
+
+
+class _KeyTiers:
+    """Limit tables per API key tier (``openAiKeyTiers`` in globalParams.json).
+
+    ``{"tiers": {"1": {"scale": 0.1, "models": {...}}, ...},
+    "keys": {"<api_key_id>": "1"}, "default_tier": "1"}`` — tiers are named
+    like the client's ``OPENAI_TIERS``; keys not listed get ``default_tier``
+    or the plain ``openAiLimits`` table.
+    """
+
+    __slots__ = ("tables", "keys", "default", "default_name")
+
+    def __init__(self, raw_limits: dict, config: dict):
+        config = config or {}
+        self.tables: Dict[str, _LimitsTable] = {"": _LimitsTable(raw_limits)}
+        for name, tier in (config.get("tiers") or {}).items():
+            if isinstance(tier, dict):
+                self.tables[str(name)] = _LimitsTable(_tier_limits(raw_limits, tier))
+        self.keys: Dict[str, str] = {}
+        for key_id, name in (config.get("keys") or {}).items():
+            if str(name) in self.tables:
+                self.keys[str(key_id)] = str(name)
+            else:
+                log.warning(f"⚠️ Unknown OpenAI key tier {name!r} for key {key_id}")
+        default_name = str(config.get("default_tier") or "")
+        self.default_name = default_name if default_name in self.tables else ""
+        self.default = self.tables[self.default_name]
+
+    def table(self, key_id: str) -> _LimitsTable:
+        name = self.keys.get(key_id)
+        return self.default if name is None else self.tables[name]
+
+    def tier_of(self, key_id: str) -> Optional[str]:
+        return self.keys.get(key_id, self.default_name) or None
+
+
+class _SlidingWindow:
+    """Events of the last ``span`` seconds with a running total.
+
+    Entries are ``(monotonic time, amount)`` in arrival order, so expired ones
+    are popped from the left: add/prune/total are amortized O(1).
+    """
+
+    __slots__ = ("span", "events", "total")
+
+    def __init__(self, span: float):
+        self.span = span
+        self.events = deque()
+        self.total = 0
+
+    def add(self, now: float, amount: int) -> None:
+        if amount:
+            self.events.append((now, amount))
+            self.total += amount
+
+    def prune(self, now: float) -> None:
+        events = self.events
+        span = self.span
+        while events and now - events[0][0] >= span:
+            self.total -= events.popleft()[1]
+
+    def fits(self, amount: int, limit: float) -> bool:
+        return self.total + amount <= limit
+
+    def wait_for(self, amount: int, limit: float, now: float) -> float:
+        """Seconds until ``amount`` more fits under ``limit`` (0 if it fits now)."""
+        excess = self.total + amount - limit
+        if excess <= 0:
+            return 0.0
+        freed = 0
+        # Obychno nuzhno dozhdatsya istecheniya odnoy-dvukh samykh starykh zapisey
+        for t, value in self.events:
+            freed += value
+            if freed >= excess:
+                return t + self.span - now
+        # Ne pomestitsya dazhe v pustoe okno — khotya by do polnogo osvobozhdeniya
+        return (self.events[-1][0] + self.span - now) if self.events else 0.0
+
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset(value) -> float:
+    """Seconds from an x-ratelimit-reset-* value (``"6m0s"``, ``"20ms"``, ``"1.5"``) or ``None``."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+
+def api_key_id(api_key: str) -> str:
+    """Short stable id of an API key (the key itself is never stored)."""
+    if not api_key:
+        return ""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def _header_int(headers: dict, name: str):
+    try:
+        return int(float(headers[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class _ServerBudget:
+    """Remaining request/token budget of one API key as reported by OpenAI.
+
+    ``x-ratelimit-remaining-*`` is a snapshot; between responses the budget
+    refills linearly towards ``x-ratelimit-limit-*`` by the reset time and
+    is reduced by what we admitted since the snapshot.
+    """
+
+    __slots__ = ("requests", "tokens", "limits")
+
+    def __init__(self):
+        # [limit, remaining, observed_at, reset_at, used] dlya zaprosov i tokenov
+        self.requests = None
+        self.tokens = None
+        # Staticheskie limity s rpm/tmp, kotorye soobshchil server
+        self.limits = None
+
+    def update(self, headers: dict, now: float, static: Mapping[str, float]) -> bool:
+        updated = False
+        for attr, kind in (("requests", "requests"), ("tokens", "tokens")):
+            remaining = _header_int(headers, f"x-ratelimit-remaining-{kind}")
+            reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+            if remaining is None or reset is None:
+                continue
+            limit = _header_int(headers, f"x-ratelimit-limit-{kind}")
+            setattr(self, attr, [limit, remaining, now, now + reset, 0])
+            updated = True
+        if updated:
+            self.merge_limits(static)
+        return updated
+
+    def merge_limits(self, static: Mapping[str, float]) -> None:
+        merged = dict(static)
+        if self.requests and self.requests[0]:
+            merged["rpm"] = self.requests[0]
+        if self.tokens and self.tokens[0]:
+            merged["tmp"] = self.tokens[0]
+        self.limits = MappingProxyType(merged) if merged != dict(static) else None
+
+    @staticmethod
+    def _wait(entry, amount: int, now: float) -> float:
+        if entry is None or not amount:
+            return 0.0
+        limit, remaining, observed, reset_at, used = entry
+        if now >= reset_at:
+            return 0.0  # okno servera obnovilos — zhdem svezhikh zagolovkov
+        span = reset_at - observed
+        if limit and limit > remaining and span > 0:
+            rate = (limit - remaining) / span
+            available = remaining + rate * (now - observed) - used
+            if available >= amount:
+                return 0.0
+            return min(reset_at - now, (amount - available) / rate)
+        return 0.0 if remaining - used >= amount else reset_at - now
+
+    def wait(self, tokens: int, now: float) -> float:
+        return max(self._wait(self.requests, 1, now), self._wait(self.tokens, tokens, now))
+
+    def consume(self, requests: int, tokens: int) -> None:
+        if self.requests is not None:
+            self.requests[4] += requests
+        if self.tokens is not None:
+            self.tokens[4] += tokens
+
+    def snapshot(self, now: float) -> dict:
+        result = {}
+        for name, entry in (("requests", self.requests), ("tokens", self.tokens)):
+            if entry is not None:
+                limit, remaining, observed, reset_at, used = entry
+                result[name] = {"limit": limit, "remaining": remaining, "used_since": used,
+                                "reset_in": round(max(0.0, reset_at - now), 2)}
+        return result
+
+
+class _Waiter:
+    """A queued ``acquire_slot`` call; sleeps on its own condition."""
+
+    __slots__ = ("priority", "tokens", "condition")
+
+    def __init__(self, priority: str, tokens: int, condition):
+        self.priority = priority
+        self.tokens = tokens
+        self.condition = condition
+
+
+class _LoopSignal:
+    """Condition stand-in for :meth:`OpenAIRateLimiter.acquire_slot_async` waiters.
+
+    ``notify`` may be called from any thread (under the state lock, like
+    ``Condition.notify``); the waiting coroutine is woken on its own loop.
+    """
+
+    __slots__ = ("loop", "event")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def notify(self) -> None:
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout: float = None) -> None:
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class _ModelState:
+    """rpm/rpd/tmp/tpd windows of one (API key, model) pair, its lock and its waiter queues.
+
+    Waiters are kept per priority class in arrival order.  Only the head
+    waiter (see :meth:`head`) checks the limits; the rest sleep until they
+    become the head, so newcomers can't overtake requests already waiting.
+    Between classes admission is weighted-fair (stride scheduling): a class
+    with weight ``w`` gets ``w`` admissions per unit of virtual time.
+    """
+
+    __slots__ = ("key", "model", "req_minute", "req_day", "tok_minute", "tok_day", "lock",
+                 "queues", "passes", "vtime", "budget")
+
+    def __init__(self, key: str = "", model: str = ""):
+        self.key = key
+        self.model = model
+        self.req_minute = _SlidingWindow(60.0)
+        self.req_day = _SlidingWindow(86400.0)
+        self.tok_minute = _SlidingWindow(60.0)
+        self.tok_day = _SlidingWindow(86400.0)
+        self.lock = threading.Lock()
+        self.queues: Dict[str, deque] = {p: deque() for p in PRIORITY_WEIGHTS}
+        self.passes: Dict[str, float] = {p: 0.0 for p in PRIORITY_WEIGHTS}
+        self.vtime = 0.0
+        # Ostatok limita klyucha po zagolovkam x-ratelimit-*
+        self.budget: Optional[_ServerBudget] = None
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def _next_class(self, passes: Dict[str, float], counts: Dict[str, int]):
+        best = None
+        for p in PRIORITY_WEIGHTS:
+            if counts[p] and (best is None or passes[p] < passes[best]):
+                best = p
+        return best
+
+    def head(self):
+        """Waiter that is admitted next, or ``None`` if nobody waits."""
+        p = self._next_class(self.passes, {k: len(q) for k, q in self.queues.items()})
+        return self.queues[p][0] if p else None
+
+    def enqueue(self, waiter: _Waiter) -> None:
+        queue = self.queues[waiter.priority]
+        if not queue:
+            # Prostoy ne kopit kredit: klass vstaet v tekushchee virtualnoe vremya
+            self.passes[waiter.priority] = max(self.passes[waiter.priority], self.vtime)
+        queue.append(waiter)
+
+    def admit(self, waiter: _Waiter) -> None:
+        self.queues[waiter.priority].popleft()
+        self.vtime = self.passes[waiter.priority]
+        self.passes[waiter.priority] += 1.0 / PRIORITY_WEIGHTS[waiter.priority]
+
+    def remove(self, waiter: _Waiter) -> None:
+        try:
+            self.queues[waiter.priority].remove(waiter)
+        except ValueError:
+            pass
+
+    def ahead_of_new(self, priority: str):
+        """``(count, tokens)`` of waiters admitted before a new ``priority`` arrival."""
+        passes = dict(self.passes)
+        counts = {p: len(q) for p, q in self.queues.items()}
+        if not counts[priority]:
+            passes[priority] = max(passes[priority], self.vtime)
+        counts[priority] += 1
+        iters = {p: iter(q) for p, q in self.queues.items()}
+        ahead = tokens = 0
+        while True:
+            p = self._next_class(passes, counts)
+            counts[p] -= 1
+            passes[p] += 1.0 / PRIORITY_WEIGHTS[p]
+            waiter = next(iters[p], None)
+            if waiter is None:
+                return ahead, tokens
+            ahead += 1
+            tokens += waiter.tokens
+
+    def prune(self, now: float) -> None:
+        self.req_minute.prune(now)
+        self.req_day.prune(now)
+        self.tok_minute.prune(now)
+        self.tok_day.prune(now)
+
+    def checks(self, limits: Mapping[str, float], tokens: int):
+        """``(window, amount, limit)`` for every configured limit."""
+        return (
+            (self.req_minute, 1, limits.get("rpm", INF)),
+            (self.req_day, 1, limits.get("rpd", INF)),
+            (self.tok_minute, tokens, limits.get("tmp", INF)),
+            (self.tok_day, tokens, limits.get("tpd", INF)),
+        )
+
+    def record_request(self, now: float, tokens: int) -> None:
+        self.req_minute.add(now, 1)
+        self.req_day.add(now, 1)
+        self.record_tokens(now, tokens)
+
+    def record_tokens(self, now: float, tokens: int) -> None:
+        self.tok_minute.add(now, tokens)
+        self.tok_day.add(now, tokens)
 
 
 class OpenAIRateLimiter:
@@ -20,221 +445,406 @@ class OpenAIRateLimiter:
         - ``tpd``  – tokens per day
 
     If a model is not found in the config, the ``default`` limits are used.
+    Usage is kept in sliding windows (see :class:`_SlidingWindow`) on the
+    monotonic clock, so admission checks don't rescan the day's history.
+
+    State is kept per ``(API key, model)``: every pair has its own windows,
+    lock and condition, so one key's traffic never throttles another key
+    and waiters are only woken for their own pair.  Keys are known by
+    :func:`api_key_id` and may be assigned limit tiers (``openAiKeyTiers``).
+    ``x-ratelimit-*`` headers of OpenAI responses (:meth:`update_from_headers`)
+    add the server's remaining budget on top of these limits.  With a
+    server-side key pool (``OPENAI_KEY_POOL``) :meth:`pick_pool_key` spreads
+    requests over the pooled keys.
     """
 
-    def __init__(self, limits: Dict[str, Dict[str, int]] = None):
+    def __init__(self, limits: Dict[str, Dict[str, int]] = None, key_tiers: dict = None,
+                 key_pool: List[str] = None):
         self.model_limits = limits or load_openai_limits()
-        self.usage = defaultdict(lambda: {"requests": [], "tokens": []})
+        self.key_tiers = key_tiers if key_tiers is not None else load_openai_key_tiers()
+        self._tiers = _KeyTiers(self.model_limits, self.key_tiers)
+        # Otsenka tokenov zaprosa dlya tmp/tpd; kalibruetsya cherez record_usage
+        self.estimator = TokenEstimator()
+        # U kazhdoy pary (klyuch, model) svoi okna, lock i condition:
+        # ozhidayushchie odnoy pary ne budyat i ne blokiruyut drugie
+        self._states_by_key: Dict[Tuple[str, str], _ModelState] = {}
+        self._states_lock = threading.Lock()
+        pool = OPENAI_KEY_POOL if key_pool is None else key_pool
+        self.key_pool = [(key, api_key_id(key)) for key in pool if key]
         self.active_requests = 0
+        self._active_lock = threading.Lock()
         self.lock = threading.Lock()
-        self.condition = Condition(self.lock)
         # optional queue timeout (None = wait indefinitely)
         self.queue_timeout = None
+        # "weighted" — klassy prioriteta, "fifo" — odna ochered bez prioritetov
+        self.admission_policy = "weighted"
 
     def update_config(self, config):
         """Update limiter configuration."""
         with self.lock:
             if "queue_timeout" in config:
                 self.queue_timeout = config["queue_timeout"]
+            if config.get("admission_policy") in ("weighted", "fifo"):
+                self.admission_policy = config["admission_policy"]
 
     def reload_limits(self) -> None:
-        """Reload model limits from the global parameters file."""
+        """Reload model limits and key tiers from the global parameters file."""
+        model_limits = load_openai_limits() or {}
+        key_tiers = load_openai_key_tiers() or {}
+        tiers = _KeyTiers(model_limits, key_tiers)
         with self.lock:
-            self.model_limits = load_openai_limits() or {}
+            self.model_limits = model_limits
+            self.key_tiers = key_tiers
+            self._tiers = tiers
+        # Limity mogli vyrasti — pust golova ocheredi pereproverit
+        for state in self._states():
+            with state.lock:
+                if state.budget is not None:
+                    state.budget.merge_limits(self._static_limits(state))
+                self._wake_head(state)
 
     # ------------------------------------------------------------------
     # Internal helpers
     # ------------------------------------------------------------------
-    def _get_limits(self, model: str) -> Dict[str, int]:
-        limits = self.model_limits.get(model)
-        if not limits:
-            for key, val in self.model_limits.items():
-                if model in key:
-                    limits = val
-                    break
-        if not limits:
-            limits = self.model_limits.get("default", {})
-        result = {}
-        for key, value in limits.items():
-            result[key] = float("inf") if value in (0, None) else int(value)
-        return result
+    def _state(self, model: str, key: str = "") -> _ModelState:
+        state = self._states_by_key.get((key, model))
+        if state is None:
+            with self._states_lock:
+                state = self._states_by_key.get((key, model))
+                if state is None:
+                    state = self._states_by_key[(key, model)] = _ModelState(key, model)
+        return state
+
+    def _states(self):
+        with self._states_lock:
+            return list(self._states_by_key.values())
+
+    def _static_limits(self, state: _ModelState) -> Mapping[str, float]:
+        return self._tiers.table(state.key).get(state.model)
+
+    def _limits_for(self, state: _ModelState) -> Mapping[str, float]:
+        budget = state.budget
+        return (budget.limits if budget is not None else None) or self._static_limits(state)
+
+    def _admission(self, state: _ModelState, tokens: int, now: float) -> float:
+        """0.0 if the request can start now, else seconds to wait. Called under ``state.lock``."""
+        limits = self._limits_for(state)
+        tokens = self._capped(limits, tokens)
+        state.prune(now)
+        server_wait = state.budget.wait(tokens, now) if state.budget is not None else 0.0
+        if server_wait <= 0 and self._fits(state, limits, tokens):
+            return 0.0
+        return max(server_wait, self._compute_wait_seconds(state, limits, tokens))
+
+    def _admit(self, state: _ModelState, tokens: int, now: float) -> None:
+        tokens = self._capped(self._limits_for(state), tokens)
+        state.record_request(now, tokens)
+        if state.budget is not None:
+            state.budget.consume(1, tokens)
+        with self._active_lock:
+            self.active_requests += 1
+
+    def _priority(self, priority) -> str:
+        if self.admission_policy == "fifo":
+            return DEFAULT_PRIORITY
+        return normalize_priority(priority)
+
+    @staticmethod
+    def _capped(limits: Mapping[str, float], tokens: int) -> int:
+        """``tokens`` capped at the key's tmp/tpd.
+
+        A bigger request never fits, and as the head waiter it would block
+        the whole queue; capped, it waits for an empty window instead.
+        """
+        return min(tokens, limits.get("tmp", INF), limits.get("tpd", INF))
+
+    @staticmethod
+    def _wake_head(state: _ModelState) -> None:
+        head = state.head()
+        if head is not None:
+            head.condition.notify()
 
-    def _prune_model(self, model: str) -> None:
-        """Remove outdated usage entries for a model."""
-        now = time.time()
-        usage = self.usage[model]
-        # keep last 24h for requests/tokens
-        usage["requests"] = [t for t in usage["requests"] if now - t < 86400]
-        usage["tokens"] = [(t, tok) for t, tok in usage["tokens"] if now - t < 86400]
+    @staticmethod
+    def _fits(state: _ModelState, limits: Mapping[str, float], tokens: int) -> bool:
+        return all(window.fits(amount, limit) for window, amount, limit in state.checks(limits, tokens))
+
+    def _compute_wait_seconds(self, state: _ModelState, limits: Mapping[str, float], tokens: int) -> float:
+        """Compute precise seconds to wait until the model can start.
+
+        Considers rpm/rpd/tmp/tpd limits. Returns 0.0 if it can start
+        immediately. Called under ``state.lock``.
+        """
+        now = time.monotonic()
+        state.prune(now)
+        wait = 0.0
+        for window, amount, limit in state.checks(limits, max(0, int(tokens))):
+            if limit != INF:
+                wait = max(wait, window.wait_for(amount, limit, now))
+        return wait
 
     # ------------------------------------------------------------------
     # Public API
     # ------------------------------------------------------------------
-    def _compute_wait_seconds(self, model: str, tokens: int) -> float:
-        """Compute precise seconds to wait until ``model`` can start.
+    def suggest_wait_seconds(self, model: str, tokens: int = 0, api_key: str = None) -> float:
+        """Public helper to compute an estimated wait before a slot is free."""
+        state = self._state(model, api_key_id(api_key))
+        with state.lock:
+            return self._admission(state, max(0, int(tokens or 0)), time.monotonic())
+
+    def pick_pool_key(self, model: str, tokens: int = 0) -> Optional[str]:
+        """Pooled API key that can serve ``model`` soonest, or ``None`` without a pool.
 
-        Considers rpm/rpd/tmp/tpd limits and current active concurrency.
-        Returns 0.0 if it can start immediately. Returns ``inf`` if blocked
-        by unknown factors.
+        Keys are compared by admission wait, then queue length, then by
+        requests in the last minute, so load spreads evenly when all are free.
         """
-        limits = self._get_limits(model)
-        self._prune_model(model)
-        usage = self.usage[model]
-        now = time.time()
-
-        # Build windows
-        req_last_minute = [t for t in usage["requests"] if now - t < 60]
-        req_last_day = usage["requests"]  # already pruned to 24h
-        tok_last_minute = [(t, tok) for t, tok in usage["tokens"] if now - t < 60]
-        tok_last_day = usage["tokens"]  # already pruned to 24h
-
-        waits = [0.0]
-
-        # rpm
-        rpm = limits.get("rpm", float("inf"))
-        if rpm != float("inf") and len(req_last_minute) >= rpm:
-            # Need the oldest of the last-minute entries that contributes to overflow to expire
-            kth_oldest = sorted(req_last_minute)[len(req_last_minute) - int(rpm)]
-            waits.append((kth_oldest + 60.0) - now)
-
-        # rpd (requests per day)
-        rpd = limits.get("rpd", float("inf"))
-        if rpd != float("inf") and len(req_last_day) >= rpd:
-            oldest = min(req_last_day)
-            waits.append((oldest + 86400.0) - now)
-
-        # tmp (tokens per minute)
-        tmp = limits.get("tmp", float("inf"))
-        if tmp != float("inf"):
-            minute_tokens = sum(tok for _, tok in tok_last_minute)
-            need = minute_tokens + max(0, int(tokens)) - tmp
-            if need > 0:
-                # Drop oldest minute tokens until we free >= need
-                freed = 0
-                for t, tok in sorted(tok_last_minute, key=lambda x: x[0]):
-                    freed += tok
-                    if freed >= need:
-                        waits.append((t + 60.0) - now)
-                        break
-
-        # tpd (tokens per day)
-        tpd = limits.get("tpd", float("inf"))
-        if tpd != float("inf"):
-            day_tokens = sum(tok for _, tok in tok_last_day)
-            need = day_tokens + max(0, int(tokens)) - tpd
-            if need > 0:
-                freed = 0
-                for t, tok in sorted(tok_last_day, key=lambda x: x[0]):
-                    freed += tok
-                    if freed >= need:
-                        waits.append((t + 86400.0) - now)
-                        break
-
-        wait = max(waits) if waits else 0.0
-        return max(0.0, wait)
-
-    def suggest_wait_seconds(self, model: str, tokens: int = 0) -> float:
-        """Public helper to compute an estimated wait before a slot is free."""
-        with self.condition:
-            return self._compute_wait_seconds(model, tokens)
+        tokens = max(0, int(tokens or 0))
+        best = None
+        for key, key_id in self.key_pool:
+            state = self._state(model, key_id)
+            with state.lock:
+                score = (self._admission(state, tokens, time.monotonic()), state.waiting, state.req_minute.total)
+            if best is None or score < best[0]:
+                best = (score, key)
+        return best[1] if best else None
+
+    def update_from_headers(self, model: str, headers, api_key: str = None) -> bool:
+        """Take the server's remaining budget from ``x-ratelimit-*`` response headers.
+
+        Admission for this model and key then also waits for that budget,
+        and the advertised ``limit`` values replace the static rpm/tmp.
+        Returns ``False`` if the response carried no such headers.
+        """
+        if not headers:
+            return False
+        headers = {str(k).lower(): v for k, v in headers.items() if str(k).lower().startswith("x-ratelimit-")}
+        if not headers:
+            return False
+        state = self._state(model, api_key_id(api_key))
+        with state.lock:
+            if state.budget is None:
+                state.budget = _ServerBudget()
+            updated = state.budget.update(headers, time.monotonic(), self._static_limits(state))
+            if updated:
+                # Byudzhet mog vyrasti — golova ocheredi pereproverit
+                self._wake_head(state)
+        return updated
+
+    def queue_status(self, model: str, tokens: int = 0, priority: str = None, api_key: str = None) -> dict:
+        """Where a new request for ``model`` would stand and roughly how long it would wait.
+
+        The wait assumes everyone ahead uses what they asked for; windows
+        that need more than one period to drain count whole periods.
+        """
+        tokens = max(0, int(tokens or 0))
+        priority = self._priority(priority)
+        state = self._state(model, api_key_id(api_key))
+        with state.lock:
+            now = time.monotonic()
+            limits = self._limits_for(state)
+            state.prune(now)
+            ahead, ahead_tokens = state.ahead_of_new(priority)
+            requests, total_tokens = ahead + 1, ahead_tokens + tokens
+            wait = state.budget.wait(tokens, now) if state.budget is not None else 0.0
+            for window, amount, limit in (
+                (state.req_minute, requests, limits.get("rpm", INF)),
+                (state.req_day, requests, limits.get("rpd", INF)),
+                (state.tok_minute, total_tokens, limits.get("tmp", INF)),
+                (state.tok_day, total_tokens, limits.get("tpd", INF)),
+            ):
+                if limit == INF:
+                    continue
+                if amount <= limit:
+                    wait = max(wait, window.wait_for(amount, limit, now))
+                else:
+                    periods = math.ceil(amount / limit) - 1
+                    wait = max(wait, window.wait_for(limit, limit, now) + periods * window.span)
+            return {
+                "queue_position": requests,
+                "queue_length": state.waiting,
+                "priority": priority,
+                "estimated_wait_seconds": round(wait, 2),
+            }
 
-    def acquire_slot(self, model: str, tokens: int = 0, timeout: float = None) -> bool:
-        """Attempt to acquire a processing slot for ``model``.
+    def acquire_slot(self, model: str, tokens: int = 0, timeout: float = None, priority: str = None,
+                     api_key: str = None) -> bool:
+        """Attempt to acquire a processing slot for ``model`` under ``api_key``.
 
         ``tokens`` is a best-effort estimate of tokens that will be used.
+        Requests are admitted in arrival order within a ``priority`` class
+        (``high``/``normal``/``low``) and weighted-fair between classes.
+        Limits come from the key's tier and the server budget reported for
+        the key (see :meth:`update_from_headers`).
         Returns ``True`` if a slot is acquired before ``timeout`` expires.
         If ``timeout`` <= 0, waits indefinitely according to limits.
         """
         if timeout is None:
             timeout = self.queue_timeout
-
-        with self.condition:
-            start = time.time()
-            deadline = float("inf") if (timeout is None or timeout <= 0) else (start + timeout)
-
+        tokens = max(0, int(tokens or 0))
+        state = self._state(model, api_key_id(api_key))
+
+        with state.lock:
+            start = time.monotonic()
+            deadline = INF if (timeout is None or timeout <= 0) else (start + timeout)
+
+            # Bystryy put: nikto ne zhdet i limity pozvolyayut
+            if state.head() is None and self._admission(state, tokens, start) <= 0:
+                self._admit(state, tokens, start)
+                return True
+
+            waiter = _Waiter(self._priority(priority), tokens, Condition(state.lock))
+            state.enqueue(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait_time = INF
+                    if state.head() is waiter:
+                        wait = self._admission(state, tokens, now)
+                        if wait <= 0:
+                            state.admit(waiter)
+                            self._admit(state, tokens, now)
+                            self._wake_head(state)
+                            return True
+                        # Spim rovno do osvobozhdeniya okna (ili do reload_limits / svezhikh zagolovkov)
+                        wait_time = max(0.05, wait)
+
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return False
+                    wait_time = min(wait_time, remaining)
+                    waiter.condition.wait(timeout=None if wait_time == INF else wait_time)
+            finally:
+                # Ushli po taymautu — ochered dvigaetsya dalshe
+                was_head = state.head() is waiter
+                state.remove(waiter)
+                if was_head:
+                    self._wake_head(state)
+
+    async def acquire_slot_async(self, model: str, tokens: int = 0, timeout: float = None,
+                                 priority: str = None, api_key: str = None) -> bool:
+        """Coroutine version of :meth:`acquire_slot` for the asyncio engine.
+
+        Async and thread waiters share the same queues, so ordering and
+        fairness are the same for both; the event loop is never blocked
+        (``state.lock`` is only held for the admission check itself).
+        """
+        if timeout is None:
+            timeout = self.queue_timeout
+        tokens = max(0, int(tokens or 0))
+        state = self._state(model, api_key_id(api_key))
+
+        with state.lock:
+            start = time.monotonic()
+            deadline = INF if (timeout is None or timeout <= 0) else (start + timeout)
+            if state.head() is None and self._admission(state, tokens, start) <= 0:
+                self._admit(state, tokens, start)
+                return True
+            signal = _LoopSignal(asyncio.get_running_loop())
+            waiter = _Waiter(self._priority(priority), tokens, signal)
+            state.enqueue(waiter)
+        try:
             while True:
-                limits = self._get_limits(model)
-                self._prune_model(model)
-                usage = self.usage[model]
-                now = time.time()
-
-                # Calculate current usage
-                minute_requests = sum(1 for t in usage["requests"] if now - t < 60)
-                day_requests = len(usage["requests"])
-                minute_tokens = sum(tok for t, tok in usage["tokens"] if now - t < 60)
-                day_tokens = sum(tok for _, tok in usage["tokens"])
-
-                can_start = (
-                    minute_requests < limits.get("rpm", float("inf")) and
-                    day_requests < limits.get("rpd", float("inf")) and
-                    minute_tokens + tokens <= limits.get("tmp", float("inf")) and
-                    day_tokens + tokens <= limits.get("tpd", float("inf"))
-                )
-
-                if can_start:
-                    usage["requests"].append(now)
-                    usage["tokens"].append((now, tokens))
-                    self.active_requests += 1
-                    return True
-
-                remaining = deadline - time.time()
-                if remaining <= 0:
-                    return False
-
-                precise_wait = self._compute_wait_seconds(model, tokens)
-                wait_time = min(remaining, max(0.05, precise_wait))
-                self.condition.wait(timeout=wait_time)
-
-    def record_usage(self, model: str, tokens: int, estimated: int = 0) -> None:
+                with state.lock:
+                    now = time.monotonic()
+                    wait_time = INF
+                    if state.head() is waiter:
+                        wait = self._admission(state, tokens, now)
+                        if wait <= 0:
+                            state.admit(waiter)
+                            self._admit(state, tokens, now)
+                            self._wake_head(state)
+                            return True
+                        wait_time = max(0.05, wait)
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return False
+                    wait_time = min(wait_time, remaining)
+                    # Sbrasyvaem pod lockom: notify posle etogo ne poteryaetsya
+                    signal.event.clear()
+                await signal.wait(None if wait_time == INF else wait_time)
+        finally:
+            with state.lock:
+                was_head = state.head() is waiter
+                state.remove(waiter)
+                if was_head:
+                    self._wake_head(state)
+
+    def record_usage(self, model: str, tokens: int, estimated: int = 0,
+                     prompt_tokens: int = None, raw_prompt: int = None, api_key: str = None) -> None:
         """Record the actual ``tokens`` used for ``model``.
 
         ``estimated`` should match the value passed to :meth:`acquire_slot`.
         If actual usage exceeds the estimate, the difference is added.
+        Extra usage can only delay waiters, so nobody is woken up.
+        ``prompt_tokens`` (actual input) and ``raw_prompt`` (the uncalibrated
+        count from :meth:`TokenEstimator.estimate`) calibrate :attr:`estimator`.
         """
+        if prompt_tokens and raw_prompt:
+            self.estimator.observe(model, raw_prompt, prompt_tokens)
         diff = tokens - estimated
         if diff <= 0:
             return
-        with self.condition:
-            self._prune_model(model)
-            self.usage[model]["tokens"].append((time.time(), diff))
-            self.condition.notify_all()
+        state = self._state(model, api_key_id(api_key))
+        with state.lock:
+            now = time.monotonic()
+            state.prune(now)
+            state.record_tokens(now, diff)
+            if state.budget is not None:
+                state.budget.consume(0, diff)
 
     def release_slot(self) -> None:
-        """Освободить слот и уведомить ожидающих"""
-        with self.condition:
+        """Освободить слот (лимиты считаются по окнам, поэтому никого не будим)"""
+        with self._active_lock:
             if self.active_requests > 0:
                 self.active_requests -= 1
-            self.condition.notify_all()
 
     # ------------------------------------------------------------------
     # Diagnostics
     # ------------------------------------------------------------------
     def get_stats(self) -> dict:
         """Получить общую статистику лимитера"""
-        with self.lock:
-            now = time.time()
-            recent_requests = 0
-            for usage in self.usage.values():
-                recent_requests += sum(1 for t in usage["requests"] if now - t < 60)
-            return {
-                "recent_requests": recent_requests,
-                "active_requests": self.active_requests,
-                "requests_per_second": recent_requests / 60.0 if recent_requests else 0,
-            }
+        now = time.monotonic()
+        recent_requests = 0
+        waiting = 0
+        keys = set()
+        for state in self._states():
+            with state.lock:
+                state.prune(now)
+                recent_requests += state.req_minute.total
+                waiting += state.waiting
+            keys.add(state.key)
+        return {
+            "recent_requests": recent_requests,
+            "active_requests": self.active_requests,
+            "waiting_requests": waiting,
+            "requests_per_second": recent_requests / 60.0 if recent_requests else 0,
+            "api_keys": len(keys),
+            "key_pool_size": len(self.key_pool),
+            "token_estimator": self.estimator.get_stats(),
+        }
 
     def get_detailed_stats(self, model: str) -> dict:
-        """Получить детальную статистику для конкретной модели"""
-        with self.lock:
-            self._prune_model(model)
-            usage = self.usage[model]
-            now = time.time()
-            minute_requests = sum(1 for t in usage["requests"] if now - t < 60)
-            minute_tokens = sum(tok for t, tok in usage["tokens"] if now - t < 60)
-            return {
-                "recent_requests": minute_requests,
-                "recent_tokens": minute_tokens,
-                "active_requests": self.active_requests,
-            }
+        """Получить детальную статистику для конкретной модели (в сумме и по ключам)"""
+        now = time.monotonic()
+        per_key = {}
+        for state in self._states():
+            if state.model != model:
+                continue
+            with state.lock:
+                state.prune(now)
+                per_key[state.key or "anonymous"] = {
+                    "tier": self._tiers.tier_of(state.key),
+                    "recent_requests": state.req_minute.total,
+                    "recent_tokens": state.tok_minute.total,
+                    "waiting_requests": state.waiting,
+                    "server_budget": state.budget.snapshot(now) if state.budget is not None else None,
+                }
+        return {
+            "recent_requests": sum(k["recent_requests"] for k in per_key.values()),
+            "recent_tokens": sum(k["recent_tokens"] for k in per_key.values()),
+            "waiting_requests": sum(k["waiting_requests"] for k in per_key.values()),
+            "active_requests": self.active_requests,
+            "keys": per_key,
+        }
 
 class ElevenLabsRateLimiter:
     """Placeholder for backward compatibility.
@@ -24,6 +24,45 @@ class Stats:
                 "error": self.error,
             }
 
+class RotationStats:
+    """Mobile proxy IP rotations vs. ElevenLabs requests served.
+
+    Also remembers which account the current IP is bound to: reusing that
+    account needs no rotation, switching to another one does.
+    """
+
+    def __init__(self):
+        self.rotations = self.requests = self.affinity_hits = 0
+        self.bound_key = None
+        self.lock = threading.Lock()
+
+    def record_rotation(self):
+        # Novyy IP eshche ne svyazan ni s odnim akkauntom
+        with self.lock:
+            self.rotations += 1
+            self.bound_key = None
+
+    def record_requests(self, count: int = 1):
+        with self.lock:
+            self.requests += count
+
+    def bind(self, api_key: str):
+        """Mark ``api_key`` as the account using the current IP."""
+        with self.lock:
+            if api_key and api_key == self.bound_key:
+                self.affinity_hits += 1
+            self.bound_key = api_key
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            per_1000 = self.rotations * 1000 / self.requests if self.requests else 0.0
+            return {
+                "rotations": self.rotations,
+                "requests": self.requests,
+                "affinity_hits": self.affinity_hits,
+                "rotations_per_1000_requests": round(per_1000, 1),
+            }
+
 def _stats_loop():
     while True:
         time.sleep(60)
@@ -53,4 +92,5 @@ def _rate_limit_monitor():
                         stats_data["recent_requests"],
                         stats_data.get("requests_per_second", 0))
 # Глобальная статистика
-stats = Stats()
\ No newline at end of file
+stats = Stats()
+rotation_stats = RotationStats()
\ No newline at end of file
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Bounded chunk pipe between an upstream worker and a streaming HTTP response."""
+import queue
+import threading
+
+_END = object()
+
+
+class StreamChannel:
+    """Producer pushes chunks with :meth:`put` and finishes with :meth:`close`;
+    the Flask response iterates over the channel.
+
+    The buffer is bounded, so a slow client slows down the upstream read
+    instead of growing memory.  When the client goes away, iteration stops,
+    the channel is cancelled and :meth:`put` returns ``False``.
+    """
+
+    def __init__(self, max_chunks: int = 64):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self.started = threading.Event()   # pervyy chank ili zavershenie
+        self.cancelled = threading.Event()
+        self.error = None
+        self.bytes_sent = 0
+        self._closed = False
+
+    def _offer(self, item) -> bool:
+        while not self.cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def put(self, chunk: bytes) -> bool:
+        if not self._offer(chunk):
+            return False
+        self.bytes_sent += len(chunk)
+        self.started.set()
+        return True
+
+    def close(self, error: str = None) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self.error = error
+        self.started.set()
+        self._offer(_END)
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is _END:
+                    return
+                yield chunk
+        finally:
+            self.cancel()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Token estimates for OpenAI limiter admission.
+
+The limiter reserves ``prompt + max output`` tokens for every request (this
+is also how OpenAI counts tmp/tpd).  The prompt part is counted from the
+Responses / Chat Completions / Images payload by a pluggable counter:
+
+* :class:`TiktokenCounter` — exact BPE counts when ``tiktoken`` is installed;
+* :class:`CharTokenCounter` — character heuristic per tokenizer family.
+
+Counts are corrected by a per-model factor learned from the real prompt
+usage reported back through :meth:`TokenEstimator.observe`.
+"""
+import json
+import threading
+from typing import Dict, Tuple
+
+from utils.logger import log
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional
+    tiktoken = None
+
+# Kartinka vo vkhode: primerno stolko tokenov stoit high detail 512x512 tile
+IMAGE_TOKENS = 765
+MESSAGE_OVERHEAD = 4
+CALIBRATION_ALPHA = 0.1
+CALIBRATION_BOUNDS = (0.5, 3.0)
+CALIBRATION_MODELS = 1024
+
+_O200K_PREFIXES = ("gpt-4o", "gpt-4.1", "gpt-5", "gpt-image", "gpt-audio", "gpt-realtime",
+                   "chatgpt-4o", "o1", "o3", "o4", "codex", "omni")
+# (ASCII simvolov na token, ne-ASCII simvolov na token)
+_CHAR_RATIOS = {"o200k_base": (4.0, 2.5), "cl100k_base": (3.8, 1.6)}
+
+
+def encoding_family(model: str) -> str:
+    return "o200k_base" if (model or "").lower().startswith(_O200K_PREFIXES) else "cl100k_base"
+
+
+class CharTokenCounter:
+    """Character based estimate; non-Latin text packs fewer chars per token."""
+
+    name = "chars"
+
+    def count(self, model: str, text: str) -> int:
+        if not text:
+            return 0
+        ascii_ratio, other_ratio = _CHAR_RATIOS[encoding_family(model)]
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        other_chars = len(text) - ascii_chars
+        return int(ascii_chars / ascii_ratio + other_chars / other_ratio) + 1
+
+
+class TiktokenCounter:
+    """Exact BPE counts via ``tiktoken``; falls back to characters if an encoding can't load."""
+
+    name = "tiktoken"
+
+    def __init__(self):
+        self._encodings: Dict[str, object] = {}
+        self._fallback = CharTokenCounter()
+        self._lock = threading.Lock()
+
+    def _encoding(self, model: str):
+        family = encoding_family(model)
+        encoding = self._encodings.get(family)
+        if encoding is None and family not in self._encodings:
+            with self._lock:
+                if family not in self._encodings:
+                    try:
+                        self._encodings[family] = tiktoken.get_encoding(family)
+                    except Exception as e:
+                        # Naprimer, net seti dlya zagruzki BPE-faylov
+                        log.warning(f"⚠️ tiktoken encoding {family} unavailable, counting characters: {e}")
+                        self._encodings[family] = None
+                encoding = self._encodings[family]
+        return encoding
+
+    def count(self, model: str, text: str) -> int:
+        if not text:
+            return 0
+        encoding = self._encoding(model)
+        if encoding is None:
+            return self._fallback.count(model, text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+
+def make_counter(name: str = "auto"):
+    """``"tiktoken"``, ``"chars"`` or ``"auto"`` (tiktoken if installed)."""
+    if name in ("auto", "tiktoken") and tiktoken is not None:
+        return TiktokenCounter()
+    if name == "tiktoken":
+        log.warning("⚠️ tiktoken is not installed, using character token estimates")
+    return CharTokenCounter()
+
+
+def _collect(value, texts: list) -> int:
+    """Sobiraet tekst iz soderzhimogo soobshcheniya; vozvrashchaet tokeny za kartinki."""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        texts.append(value)
+        return 0
+    if isinstance(value, list):
+        return sum(_collect(item, texts) for item in value)
+    if isinstance(value, dict):
+        kind = value.get("type", "")
+        if kind in ("input_image", "image_url", "image"):
+            return IMAGE_TOKENS
+        extra = 0
+        for key in ("text", "content", "output", "arguments", "refusal"):
+            if key in value:
+                extra += _collect(value[key], texts)
+        for call in value.get("tool_calls") or ():
+            texts.append(json.dumps(call.get("function", call), ensure_ascii=False))
+        return extra
+    return 0
+
+
+def prompt_parts(body: dict) -> Tuple[str, int]:
+    """``(text, fixed_tokens)`` of everything in ``body`` that counts as input."""
+    texts = []
+    fixed = 0
+    for key in ("instructions", "prompt", "input", "messages"):
+        value = body.get(key)
+        if isinstance(value, list):
+            fixed += MESSAGE_OVERHEAD * len(value)
+        fixed += _collect(value, texts)
+    for key in ("tools", "functions", "response_format"):
+        if body.get(key):
+            texts.append(json.dumps(body[key], ensure_ascii=False))
+    text_format = (body.get("text") or {}).get("format") if isinstance(body.get("text"), dict) else None
+    if text_format:
+        texts.append(json.dumps(text_format, ensure_ascii=False))
+    return "\n".join(texts), fixed
+
+
+def max_output_tokens(body: dict) -> int:
+    value = body.get("max_output_tokens") or body.get("max_completion_tokens") or body.get("max_tokens") or 0
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+class TokenEstimator:
+    """Estimates tokens a request reserves and learns a per-model correction."""
+
+    def __init__(self, counter=None):
+        self.counter = counter or make_counter()
+        self._factors: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def estimate(self, model: str, body: dict) -> Tuple[int, int]:
+        """``(total, raw_prompt)``: tokens to reserve and the uncalibrated prompt count.
+
+        ``total`` includes the calibrated prompt; ``raw_prompt`` is what
+        :meth:`observe` expects back once the real usage is known.
+        """
+        if not isinstance(body, dict):
+            return 0, 0
+        text, fixed = prompt_parts(body)
+        raw = self.counter.count(model, text) + fixed if (text or fixed) else 0
+        prompt = int(raw * self._factors.get(model, 1.0))
+        return prompt + max_output_tokens(body), raw
+
+    def observe(self, model: str, raw_prompt: int, actual_prompt: int) -> None:
+        """Pull the model's factor towards ``actual / raw`` (EWMA, bounded)."""
+        if raw_prompt <= 0 or actual_prompt <= 0:
+            return
+        with self._lock:
+            factor = self._factors.get(model, 1.0)
+            if model not in self._factors and len(self._factors) >= CALIBRATION_MODELS:
+                return
+            low, high = CALIBRATION_BOUNDS
+            target = min(high, max(low, actual_prompt / raw_prompt))
+            self._factors[model] = factor + CALIBRATION_ALPHA * (target - factor)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "counter": self.counter.name,
+                "calibration": {m: round(f, 3) for m, f in self._factors.items()},
+            }
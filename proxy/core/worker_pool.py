@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Long-lived bounded worker pool with per-key concurrency slots.
+
+Replaces "one ``threading.Thread`` per request": a fixed set of daemon
+workers pulls tasks, and at most ``per_key_limit`` tasks with the same key
+(e.g. an ElevenLabs account) run at once.  Tasks of a saturated key wait in
+the pool without occupying a worker; keys with free slots are served
+round-robin so one busy account can't starve the others.
+"""
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+from utils.logger import log
+
+
+class KeyedWorkerPool:
+    def __init__(self, max_workers: int, per_key_limit: Optional[int] = None, name: str = "pool"):
+        self.max_workers = max(1, int(max_workers))
+        self.per_key_limit = per_key_limit
+        self.name = name
+        self._cond = threading.Condition()
+        self._pending: Dict[Hashable, Deque] = {}
+        self._running: Dict[Hashable, int] = {}
+        self._ready: Deque[Hashable] = deque()  # klyuchi s zadachami i svobodnym slotom
+        self._threads = []
+        self._active = 0
+        self._completed = 0
+        self._stopped = False
+
+    # ------------------------------------------------------------------
+    def _limit(self, key) -> int:
+        # Zadachi bez klyucha ogranicheny tolko chislom vorkerov
+        if key is None or not self.per_key_limit:
+            return self.max_workers
+        return self.per_key_limit
+
+    def _start_workers(self) -> None:
+        # Vyzyvaetsya pod self._cond
+        while len(self._threads) < self.max_workers:
+            t = threading.Thread(
+                target=self._worker, name=f"{self.name}-{len(self._threads)}", daemon=True
+            )
+            self._threads.append(t)
+            t.start()
+
+    def _mark_ready(self, key) -> None:
+        if (self._pending.get(key) and key not in self._ready
+                and self._running.get(key, 0) < self._limit(key)):
+            self._ready.append(key)
+            self._cond.notify()
+
+    def submit(self, fn: Callable, *args, key: Hashable = None, **kwargs) -> Future:
+        """Schedule ``fn(*args, **kwargs)``; tasks with the same ``key`` share its slots."""
+        future: Future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError(f"{self.name} is shut down")
+            self._start_workers()
+            self._pending.setdefault(key, deque()).append((future, fn, args, kwargs))
+            self._mark_ready(key)
+        return future
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                key = self._ready.popleft()
+                future, fn, args, kwargs = self._pending[key].popleft()
+                if not self._pending[key]:
+                    del self._pending[key]
+                self._running[key] = self._running.get(key, 0) + 1
+                self._active += 1
+                # Esli u klyucha est eshche sloty — stavim v konets (round-robin)
+                self._mark_ready(key)
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as exc:
+                    log.error(f"❌ {self.name} task failed (key={key}): {exc}")
+                    future.set_exception(exc)
+
+            with self._cond:
+                self._active -= 1
+                self._completed += 1
+                self._running[key] -= 1
+                if not self._running[key]:
+                    del self._running[key]
+                self._mark_ready(key)
+
+    # ------------------------------------------------------------------
+    def cancel_pending(self, key: Hashable = None) -> int:
+        """Cancel queued (not yet started) tasks, optionally only for ``key``."""
+        cancelled = 0
+        with self._cond:
+            keys = [key] if key is not None else list(self._pending)
+            for k in keys:
+                for future, *_ in self._pending.pop(k, ()):
+                    future.cancel()
+                    cancelled += 1
+                if k in self._ready:
+                    self._ready.remove(k)
+        return cancelled
+
+    def shutdown(self) -> None:
+        """Stop workers after their current task; queued tasks are cancelled."""
+        self.cancel_pending()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    @staticmethod
+    def _label(key) -> str:
+        # Klyuchi API v statistike ne pokazyvaem tselikom
+        if isinstance(key, tuple):
+            return "/".join(str(part)[-10:] for part in key)
+        return str(key)[-10:]
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return {
+                "workers": len(self._threads),
+                "max_workers": self.max_workers,
+                "active_workers": self._active,
+                "queue_depth": sum(len(q) for q in self._pending.values()),
+                "per_key_limit": self.per_key_limit,
+                "running_per_key": {self._label(k): n for k, n in self._running.items()},
+                "completed": self._completed,
+            }
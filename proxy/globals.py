@@ -5,6 +5,7 @@ Global objects container
 
 # Глобальные объекты - инициализируются в main.py
 openai_limiter = None
+openai_engine = None
 elevenlabs_rate_limiter = None
 proxy_manager = None
 elevenlabs_manager = None
@@ -14,10 +15,11 @@ app = None
 
 def init_globals(**kwargs):
     """Инициализация глобальных объектов"""
-    global openai_limiter, elevenlabs_rate_limiter
+    global openai_limiter, openai_engine, elevenlabs_rate_limiter
     global proxy_manager, elevenlabs_manager, elevenlabs_queue, stats, app
 
     openai_limiter = kwargs.get('openai_limiter')
+    openai_engine = kwargs.get('openai_engine')
     elevenlabs_rate_limiter = kwargs.get('elevenlabs_rate_limiter')
     proxy_manager = kwargs.get('proxy_manager')
     elevenlabs_manager = kwargs.get('elevenlabs_manager')
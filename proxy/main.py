@@ -12,6 +12,7 @@ from core.stats import stats, _stats_loop, _rate_limit_monitor
 from proxy.mobile_proxy import MobileProxyManager
 from proxy.proxy_manager import ElevenLabsProxyManager
 from services.elevenlabs_manager import ElevenLabsManager, ElevenLabsQueue
+from services.openai_async import create_openai_engine
 from web.routes import create_app
 from web.excel_management import register_excel_routes
 
@@ -24,11 +25,16 @@ from web.excel_management import register_excel_routes
 openai_limiter = OpenAIRateLimiter()
 elevenlabs_rate_limiter = ElevenLabsRateLimiter()
 
+# Асинхронный движок OpenAI (None, если выключен или нет aiohttp)
+openai_engine = create_openai_engine()
 
 # Managers
 proxy_manager = ElevenLabsProxyManager()
 elevenlabs_manager = ElevenLabsManager()
-elevenlabs_queue = ElevenLabsQueue(excel_path=elevenlabs_manager.excel_path)
+elevenlabs_queue = ElevenLabsQueue(
+    excel_path=elevenlabs_manager.excel_path,
+    accounts=elevenlabs_manager.accounts,
+)
 
 def start_background_threads():
     """Запускает фоновые потоки"""
@@ -38,6 +44,10 @@ def start_background_threads():
     # Rate limit monitor thread
     threading.Thread(target=_rate_limit_monitor, daemon=True).start()
 
+    # Event loop асинхронного движка OpenAI
+    if openai_engine:
+        openai_engine.start()
+
 def setup_mobile_proxy():
     """Настройка мобильного прокси (один экземпляр для всех менеджеров)"""
     MOBILE_PROXY_ID = "407714"
@@ -94,6 +104,7 @@ def main():
     import globals as g
     g.init_globals(
         openai_limiter=openai_limiter,
+        openai_engine=openai_engine,
         elevenlabs_rate_limiter=elevenlabs_rate_limiter,
         proxy_manager=proxy_manager,
         elevenlabs_manager=elevenlabs_manager,
@@ -104,7 +115,7 @@ def main():
     
     # Запуск сервера
     app.run(host="0.0.0.0", port=8001, threaded=True)
-__all__ = ['openai_limiter', 'elevenlabs_rate_limiter',
+__all__ = ['openai_limiter', 'openai_engine', 'elevenlabs_rate_limiter',
            'proxy_manager', 'elevenlabs_manager', 'elevenlabs_queue']
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@ import time
 import threading
 import requests
 from utils.logger import log, FULL_LOGS, maybe_truncate
+from core.stats import rotation_stats
+from proxy.session_pool import session_pool
 
 class MobileProxyManager:
     def __init__(self, proxy_id: str, api_key: str):
@@ -190,6 +192,8 @@ class MobileProxyManager:
                     if status['ip']:
                         self.current_ip = status['ip']
                         log.info(f"✅ Rotation completed: new IP {self.current_ip} after {elapsed:.1f}s")
+                        # Keep-alive соединения через прокси ведут на старый IP
+                        session_pool.invalidate(reason=f"IP rotated to {self.current_ip}")
                         return True
                     else:
                         log.warning("⚠️ Rotation completed but no IP received, retrying...")
@@ -277,6 +281,7 @@ class MobileProxyManager:
                         log.info(f"🔍 IP rotation response: {result}")
 
                         if result.get('status') in ['ok', 'OK'] or result.get('code') == 200:
+                            rotation_stats.record_rotation()
                             log.info("⏳ Waiting for rotation to complete...")
                             if self.wait_for_rotation_complete(max_wait=60):
                                 log.info(f"✅ IP rotation successful: {self.current_ip}")
@@ -360,13 +365,17 @@ class MobileProxyManager:
         log.error(f"❌ Failed to get stats. Response: {result}")
         return {}
 
-    def get_proxy_connection_info(self, stats: dict = None) -> dict:
-        """Получает данные для подключения к прокси серверу с кэшированием"""
+    def get_proxy_connection_info(self, stats: dict = None, force: bool = False) -> dict:
+        """Получает данные для подключения к прокси серверу с кэшированием
+
+        ``force=True`` обновляет кэш, даже если он еще актуален.
+        """
         current_time = time.time()
 
         # Используем кэш если он еще актуален
         if (
-            self.connection_info_cache
+            not force
+            and self.connection_info_cache
             and current_time - self.cache_timestamp < self.cache_ttl
         ):
             log.debug("✅ Using cached connection info")
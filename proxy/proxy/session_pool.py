@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Shared ``requests`` sessions keyed by (proxy URL, upstream host).
+
+Opening a connection through the mobile proxy costs a TCP connect, a proxy
+CONNECT and a TLS handshake.  Sessions from :data:`session_pool` keep those
+connections alive between requests to the same upstream through the same
+proxy.  Callers must not ``close()`` pooled sessions; after an IP rotation
+the mobile proxy calls :meth:`SessionPool.invalidate` and the next request
+opens fresh connections (in-flight requests finish on the old ones).
+
+Pooled sessions don't keep cookies, so accounts sharing a session can't
+see each other's cookies.
+"""
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.logger import log
+
+# Profili povtorov urllib3; po umolchaniyu povtory delaet vyzyvayushchiy kod
+RETRY_PROFILES = {
+    "none": lambda: Retry(total=0, read=False, redirect=3, raise_on_status=False),
+    "get": lambda: Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                         allowed_methods=["GET"], raise_on_status=False),
+}
+
+
+def _proxy_url(proxies: Optional[dict]) -> str:
+    if not proxies:
+        return ""
+    return proxies.get("https") or proxies.get("http") or ""
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class SessionPool:
+    def __init__(self, pool_maxsize: int = 50, idle_ttl: float = 300.0):
+        self.pool_maxsize = pool_maxsize
+        self.idle_ttl = idle_ttl
+        self.lock = threading.Lock()
+        self._sessions: Dict[Tuple[str, str, str], list] = {}  # klyuch -> [session, last_used]
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.expired = 0
+
+    def _create(self, proxy_url: str, retry: str) -> requests.Session:
+        session = requests.Session()
+        session.trust_env = False  # ignor sistemnykh proksi
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        if proxy_url:
+            session.proxies = {"http": proxy_url, "https": proxy_url}
+        adapter = HTTPAdapter(max_retries=RETRY_PROFILES[retry](),
+                              pool_connections=4, pool_maxsize=self.pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session(self, url: str, proxies: dict = None, retry: str = "none") -> requests.Session:
+        """Shared session for requests to ``url``'s host through ``proxies``."""
+        key = (_proxy_url(proxies), _origin(url), retry)
+        now = time.monotonic()
+        stale = []
+        with self.lock:
+            entry = self._sessions.get(key)
+            if entry is not None and now - entry[1] > self.idle_ttl:
+                # Prostaivavshie soedineniya skoree vsego uzhe zakryty s toy storony
+                stale.append(self._sessions.pop(key)[0])
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                entry = self._sessions[key] = [self._create(key[0], retry), now]
+            else:
+                self.hits += 1
+                entry[1] = now
+        for session in stale:
+            session.close()
+        return entry[0]
+
+    def invalidate(self, reason: str = "", proxy_url: str = None) -> int:
+        """Drop pooled sessions (all, or those through ``proxy_url``)."""
+        with self.lock:
+            keys = [k for k in self._sessions if proxy_url is None or k[0] == proxy_url]
+            dropped = [self._sessions.pop(k)[0] for k in keys]
+            self.invalidations += 1
+        for session in dropped:
+            try:
+                session.close()
+            except Exception:
+                pass
+        if dropped:
+            log.info(f"🔌 Dropped {len(dropped)} pooled upstream sessions{f' ({reason})' if reason else ''}")
+        return len(dropped)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._sessions),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "expired": self.expired,
+                "hosts": sorted({k[1] for k in self._sessions}),
+            }
+
+
+session_pool = SessionPool()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Bin-packing of ElevenLabs requests onto accounts.
+
+Requests are items (size = quota cost), accounts are bins (capacity =
+remaining quota).  Strategies:
+
+* ``ffd`` — first-fit decreasing: biggest request first, earliest account
+  with room;
+* ``bfd`` — best-fit decreasing: biggest request first, account whose
+  remaining quota is the tightest fit;
+* ``min_accounts`` — best-fit among accounts already used in the batch and
+  only then opens the largest unused account.  Every newly touched account
+  costs an IP rotation, so this keeps the number of accounts low.
+
+All strategies use :class:`QuotaIndex`, so each placement is O(log n).
+
+``preferred`` names the account already bound to the current proxy IP: it is
+filled first (biggest requests that still fit), the strategy packs the rest.
+"""
+from typing import Callable, Dict, List, Tuple
+
+from services.quota_index import QuotaIndex
+
+DEFAULT_STRATEGY = "min_accounts"
+
+
+def _place_ffd(items, bins, place) -> None:
+    index = QuotaIndex((key, pos, cap) for pos, (key, cap) in enumerate(bins))
+    for item, cost in items:
+        key = index.first_fit(cost)
+        if key is not None:
+            index.update(key, index.quota(key) - cost)
+        place(item, cost, key)
+
+
+def _place_bfd(items, bins, place) -> None:
+    index = QuotaIndex((key, pos, cap) for pos, (key, cap) in enumerate(bins))
+    for item, cost in items:
+        key = index.best_fit(cost)
+        if key is not None:
+            index.update(key, index.quota(key) - cost)
+        place(item, cost, key)
+
+
+def _place_min_accounts(items, bins, place) -> None:
+    opened = QuotaIndex((key, pos, None) for pos, (key, _) in enumerate(bins))
+    unopened = QuotaIndex((key, pos, cap) for pos, (key, cap) in enumerate(bins))
+    for item, cost in items:
+        key = opened.best_fit(cost)
+        if key is not None:
+            opened.update(key, opened.quota(key) - cost)
+        else:
+            # Novyy akkaunt = novaya rotatsiya IP: berem samyy bolshoy
+            key = unopened.worst_fit(cost)
+            if key is not None:
+                capacity = unopened.quota(key)
+                unopened.update(key, None)
+                opened.update(key, capacity - cost)
+        place(item, cost, key)
+
+
+PACKING_STRATEGIES: Dict[str, Callable] = {
+    "ffd": _place_ffd,
+    "bfd": _place_bfd,
+    "min_accounts": _place_min_accounts,
+}
+
+
+def _min_bins_needed(capacities: List[int], total: int) -> int:
+    """Lower bound on accounts needed to hold ``total`` chars."""
+    if total <= 0:
+        return 0
+    filled = 0
+    for count, capacity in enumerate(sorted(capacities, reverse=True), start=1):
+        filled += capacity
+        if filled >= total:
+            return count
+    return len(capacities)
+
+
+def pack(items: List[Tuple[object, int]], bins: List[Tuple[str, int]],
+         strategy: str = DEFAULT_STRATEGY, preferred: str = None) -> dict:
+    """Assign ``(item, cost)`` pairs to ``(key, capacity)`` bins.
+
+    ``bins`` order matters for ``ffd`` (and breaks ties elsewhere).  Returns::
+
+        {"strategy", "assignments": {key: [item, ...]}, "used": {key: cost},
+         "unassigned": [item, ...], "stats": {...}}
+    """
+    placer = PACKING_STRATEGIES.get(strategy)
+    if placer is None:
+        raise ValueError(f"Unknown packing strategy: {strategy}")
+
+    assignments: Dict[str, list] = {}
+    used: Dict[str, int] = {}
+    unassigned = []
+    unassigned_cost = 0
+
+    def place(item, cost, key):
+        nonlocal unassigned_cost
+        if key is None:
+            unassigned.append(item)
+            unassigned_cost += cost
+            return
+        assignments.setdefault(key, []).append(item)
+        used[key] = used.get(key, 0) + cost
+
+    ordered = sorted(items, key=lambda pair: pair[1], reverse=True)
+    capacity = dict(bins)
+    if preferred in capacity:
+        # Snachala zagruzhaem privyazannyy k IP akkaunt — bez rotatsii
+        room = capacity[preferred]
+        rest = []
+        for item, cost in ordered:
+            if cost <= room:
+                room -= cost
+                place(item, cost, preferred)
+            else:
+                rest.append((item, cost))
+        ordered = rest
+        bins = [(key, cap) for key, cap in bins if key != preferred]
+    placer(ordered, bins, place)
+
+    assigned_cost = sum(used.values())
+    touched_capacity = sum(capacity[key] for key in used)
+    lower_bound = _min_bins_needed(list(capacity.values()), assigned_cost)
+    stats = {
+        "requests": len(items),
+        "assigned": len(items) - len(unassigned),
+        "unassigned": len(unassigned),
+        "chars_assigned": assigned_cost,
+        "chars_unassigned": unassigned_cost,
+        "accounts_available": len(capacity),
+        "accounts_touched": len(used),
+        "preferred_used": preferred in used,
+        "accounts_lower_bound": lower_bound,
+        # Dolya kvoty zadeystvovannykh akkauntov, zanyataya pachkoy
+        "fill_ratio": round(assigned_cost / touched_capacity, 4) if touched_capacity else 0.0,
+        # 1.0 = ne bolshe akkauntov, chem teoreticheskiy minimum
+        "efficiency": round(lower_bound / len(used), 4) if used else 1.0,
+    }
+    return {
+        "strategy": strategy,
+        "assignments": assignments,
+        "used": used,
+        "unassigned": unassigned,
+        "stats": stats,
+    }
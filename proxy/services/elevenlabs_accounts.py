@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+"""In-process registry of ElevenLabs accounts.
+
+Live account state is kept in SQLite (see :mod:`services.elevenlabs_store`);
+``api_elevenlabs.xlsx`` is the human-editable format, imported into the
+database on first start or via :meth:`ElevenLabsAccountRegistry.import_excel`
+and written back with :meth:`ElevenLabsAccountRegistry.export_excel`.  Lookups
+work on in-memory records indexed by ``api_key`` and ``email``; usable
+accounts are also kept in a :class:`QuotaIndex` ordered by remaining quota,
+updated on every change, so selection doesn't scan all accounts.
+
+Mutations are write-behind: they are applied in memory, appended to a small
+JSON-lines journal next to the workbook and flushed to the database in batches
+by a background thread (every ``flush_interval`` seconds or after
+``flush_threshold`` pending changes).  Each journal entry carries a sequence
+number and the database stores the last sequence it contains, so replaying the
+journal after a crash never applies a change twice.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+from zipfile import BadZipFile
+
+import openpyxl
+
+from services.elevenlabs_store import AccountStore
+from services.quota_index import QuotaIndex
+from utils.logger import log
+
+# Column header -> record field.  Order matches the canonical workbook layout.
+EXCEL_COLUMNS = [
+    ("API Key", "api_key"),
+    ("Email", "email"),
+    ("Password", "password"),
+    ("Quota Remaining", "quota_remaining"),
+    ("Last Checked", "last_checked"),
+    ("Status", "status"),
+    ("Usage Count", "usage_count"),
+    ("Total Used This Month", "total_used"),
+    ("Unusual Activity", "unusual_activity"),
+    ("Unusual Activity Time", "unusual_activity_time"),
+    ("Notes", "notes"),
+    ("Retry Count", "retry_count"),
+]
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Sluzhebnyy list (zapisyvalsya do perekhoda na SQLite) — pri importe propuskaem
+META_SHEET = "_meta"
+
+
+def now_str() -> str:
+    """Current local time in the format stored in the ``Last Checked`` column."""
+    return datetime.now().strftime(TIME_FORMAT)
+
+
+def is_usable(account: dict, avoid_unusual: bool = True) -> bool:
+    """``True`` if the account is not disabled (and not flagged when ``avoid_unusual``)."""
+    if not account.get('api_key'):
+        return False
+    if str(account.get('status') or 'active').lower() == 'disabled':
+        return False
+    if avoid_unusual and str(account.get('unusual_activity') or 'no').lower() == 'yes':
+        return False
+    return True
+
+
+class QuotaJournal:
+    """Append-only log of account mutations not yet flushed to the workbook.
+
+    ``rotate`` moves the active log aside right before a batch is flushed;
+    ``discard_rotated`` deletes it once the batch is committed.  If the
+    process dies in between, :meth:`replay` reads both files and the caller
+    skips entries already covered by the stored sequence.
+    """
+
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = str(path)
+        self.rotated_path = self.path + ".1"
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self._fh = None
+
+    def append(self, entry: dict) -> None:
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self.lock:
+            if self._fh is None:
+                self._fh = open(self.path, "a", encoding="utf-8")
+            self._fh.write(line)
+            self._fh.flush()
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+
+    def rotate(self) -> None:
+        """Start a fresh log; pending entries move to ``rotated_path``."""
+        with self.lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            if not os.path.exists(self.path):
+                return
+            if os.path.exists(self.rotated_path):
+                # Predydushchiy flush ne udalsya — dopisyvaem, a ne zatiraem
+                with open(self.path, "r", encoding="utf-8") as src, \
+                        open(self.rotated_path, "a", encoding="utf-8") as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+
+    def discard_rotated(self) -> None:
+        with self.lock:
+            try:
+                os.remove(self.rotated_path)
+            except FileNotFoundError:
+                pass
+
+    def replay(self, after_seq: int = 0) -> List[dict]:
+        """Entries with ``seq > after_seq`` from both log files, in sequence order."""
+        entries = []
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Oborvannaya poslednyaya stroka pri padenii — propuskaem
+                        log.warning("⚠️ Skipping damaged journal line in %s", path)
+                        continue
+                    if entry.get("seq", 0) > after_seq:
+                        entries.append(entry)
+        entries.sort(key=lambda e: e["seq"])
+        return entries
+
+
+class ElevenLabsAccountRegistry:
+    """Thread-safe in-memory view of ElevenLabs accounts backed by SQLite.
+
+    Records are plain dicts with the fields from :data:`EXCEL_COLUMNS` plus
+    ``row`` (original spreadsheet row, used for stable ordering).  All public
+    getters return copies so callers can't mutate the registry by accident.
+    """
+
+    def __init__(self, excel_path: str = "api_elevenlabs.xlsx", db_path: str = None,
+                 flush_interval: float = 5.0, flush_threshold: int = 50):
+        self.excel_path = excel_path
+        self.db_path = str(db_path or Path(excel_path).with_suffix('.db'))
+        self.lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._by_key: Dict[str, dict] = {}
+        self._by_email: Dict[str, dict] = {}
+        self._extra_headers: List[str] = []
+        self._sheet_title = "ElevenLabs APIs"
+        self.store = AccountStore(self.db_path)
+        self.quota_index = QuotaIndex()
+
+        # Write-behind
+        self.journal = QuotaJournal(Path(excel_path).with_suffix('.journal'))
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._seq = 0          # posledniy primenennyy v pamyati nomer
+        self._unflushed: List[dict] = []   # zapisi zhurnala, eshche ne v SQLite
+        self._flush_event = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+
+    # ------------------------------------------------------------------
+    # Startup / import / export
+    # ------------------------------------------------------------------
+    def load(self) -> int:
+        """Open the live state. Returns number of accounts.
+
+        On the first start (empty database) the workbook is imported.  Journal
+        entries that never reached the database are replayed into it.
+        """
+        with self._save_lock, self.lock:
+            if self.store.count() == 0 and os.path.exists(self.excel_path):
+                parsed = self._read_workbook(self.excel_path)
+                if parsed is not None:
+                    records, meta = parsed
+                    self.store.replace_all(records, meta)
+
+            store_seq = self.store.journal_seq
+            replayed = self.journal.replay(after_seq=store_seq)
+            if replayed:
+                self.store.apply(replayed, replayed[-1]["seq"])
+                log.info("📒 Replayed %d journaled account changes", len(replayed))
+            self.journal.rotate()
+            self.journal.discard_rotated()
+            self._reload(max(store_seq, replayed[-1]["seq"] if replayed else 0))
+            count = len(self._by_key)
+        log.info("📊 Loaded %d ElevenLabs accounts from %s", count, self.db_path)
+        return count
+
+    def import_excel(self, path: str = None) -> int:
+        """Replace the live account set with the contents of ``path``.
+
+        Pending changes are flushed first; everything in the workbook wins.
+        """
+        path = path or self.excel_path
+        if not os.path.exists(path):
+            log.warning("⚠️ Accounts file not found: %s", path)
+            return 0
+        parsed = self._read_workbook(path)
+        if parsed is None:
+            return 0
+        records, meta = parsed
+        self.flush()
+        with self._save_lock, self.lock:
+            if self._unflushed:
+                self.store.apply(self._unflushed, self._seq)
+                self._unflushed = []
+            meta['journal_seq'] = self._seq
+            self.store.replace_all(records, meta)
+            self.journal.rotate()
+            self.journal.discard_rotated()
+            self._reload(self._seq)
+        log.info("📥 Imported %d ElevenLabs accounts from %s", len(records), path)
+        return len(records)
+
+    def export_excel(self, path: str = None) -> str:
+        """Export current accounts to a workbook. Returns the written path.
+
+        Writes to a temporary file first and atomically replaces the target,
+        so a crash mid-write never leaves a truncated xlsx behind.
+        """
+        path = path or self.excel_path
+        self.flush()
+        with self.lock:
+            records = [dict(r) for r in sorted(self._by_key.values(), key=lambda r: r['row'])]
+            extra_headers = list(self._extra_headers)
+            title = self._sheet_title
+
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.title = title
+        ws.append([h for h, _ in EXCEL_COLUMNS] + extra_headers)
+        for r in records:
+            extra = r.get('extra') or {}
+            ws.append([r.get(field) for _, field in EXCEL_COLUMNS] + [extra.get(h) for h in extra_headers])
+
+        tmp_path = str(Path(path).with_suffix('.tmp.xlsx'))
+        try:
+            wb.save(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        log.info("📤 Exported %d ElevenLabs accounts to %s", len(records), path)
+        return path
+
+    def _read_workbook(self, path: str):
+        """Parse the workbook into ``(records, meta)`` or ``None`` if unreadable."""
+        try:
+            wb = openpyxl.load_workbook(path, read_only=True)
+        except BadZipFile:
+            log.error(f"❌ Excel file is corrupted: {path}. Keeping current accounts")
+            return None
+
+        try:
+            journal_seq = 0
+            if META_SHEET in wb.sheetnames:
+                for key, value in wb[META_SHEET].iter_rows(min_row=1, max_col=2, values_only=True):
+                    if key == "journal_seq":
+                        journal_seq = int(value or 0)
+            ws = wb[next(name for name in wb.sheetnames if name != META_SHEET)]
+            title = ws.title
+            rows = ws.iter_rows(values_only=True)
+            headers = [h for h in (next(rows, None) or [])]
+            known = dict(EXCEL_COLUMNS)
+            field_by_col = {}
+            extra_headers = []
+            for idx, header in enumerate(headers):
+                if header in known:
+                    field_by_col[idx] = known[header]
+                elif header:
+                    extra_headers.append(header)
+                    field_by_col[idx] = None
+
+            by_key: Dict[str, dict] = {}
+            for row_num, values in enumerate(rows, start=2):
+                record = {field: None for _, field in EXCEL_COLUMNS}
+                record['row'] = row_num
+                record['extra'] = {}
+                for idx, value in enumerate(values):
+                    if idx not in field_by_col:
+                        continue
+                    field = field_by_col[idx]
+                    if field:
+                        record[field] = value
+                    else:
+                        record['extra'][headers[idx]] = value
+                if not record['api_key']:
+                    continue
+                by_key[record['api_key']] = record
+        finally:
+            wb.close()
+
+        meta = {"extra_headers": extra_headers, "sheet_title": title, "journal_seq": journal_seq}
+        return list(by_key.values()), meta
+
+    def _reload(self, seq: int) -> None:
+        """Rebuild the in-memory indexes from the database (caller holds the lock)."""
+        by_key = {r['api_key']: r for r in self.store.all()}
+        self._by_key = by_key
+        self._by_email = {r['email']: r for r in by_key.values() if r.get('email')}
+        self._extra_headers = self.store.get_meta("extra_headers", [])
+        self._sheet_title = self.store.get_meta("sheet_title", "ElevenLabs APIs")
+        self._seq = seq
+        self._unflushed = []
+        self.quota_index.rebuild(
+            (r['api_key'], r['row'], self._indexed_quota(r)) for r in by_key.values()
+        )
+
+    @staticmethod
+    def _indexed_quota(record: dict) -> Optional[int]:
+        """Quota to index for ``record`` or ``None`` if it must not be selected."""
+        quota = record.get('quota_remaining')
+        if not is_usable(record) or not isinstance(quota, (int, float)) or quota <= 0:
+            return None
+        return int(quota)
+
+    # ------------------------------------------------------------------
+    # Write-behind flush
+    # ------------------------------------------------------------------
+    def flush(self) -> None:
+        """Write pending journaled changes to the database (no-op when clean)."""
+        with self._save_lock:
+            with self.lock:
+                if not self._unflushed:
+                    return
+                entries, self._unflushed = self._unflushed, []
+                seq = self._seq
+                # Vse zapisi s nomerom <= seq uydut v etu tranzaktsiyu
+                self.journal.rotate()
+            try:
+                self.store.apply(entries, seq)
+            except Exception as e:
+                log.error(f"❌ Error flushing account changes to {self.db_path}: {e}")
+                with self.lock:
+                    self._unflushed[:0] = entries
+                return
+            self.journal.discard_rotated()
+
+    def _ensure_flusher(self) -> None:
+        with self.lock:
+            if self._flush_thread is None or not self._flush_thread.is_alive():
+                self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flush_thread.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"❌ Account journal flush failed: {e}")
+
+    # ------------------------------------------------------------------
+    # Indexed selection
+    # ------------------------------------------------------------------
+    def pick(self, required_chars: int, strategy: str = "first_fit", min_quota: int = 0) -> Optional[dict]:
+        """Usable account for ``required_chars`` from the in-memory quota index.
+
+        ``strategy`` is ``first_fit`` (earliest row), ``best_fit`` (tightest
+        quota) or ``worst_fit`` (largest quota).  Accounts flagged for unusual
+        activity are never returned.
+        """
+        with self.lock:
+            key = self.quota_index.pick(max(required_chars, min_quota), strategy)
+            return dict(self._by_key[key]) if key else None
+
+    def largest(self, min_quota: int = 0) -> Optional[dict]:
+        """Usable account with the most remaining quota (at least ``min_quota``)."""
+        return self.pick(0, strategy="worst_fit", min_quota=min_quota)
+
+    def select_usable(self, min_quota: int = None, avoid_unusual: bool = True,
+                      unknown_quota: bool = False, order_by: str = "row") -> List[dict]:
+        """Usable accounts from memory, same filters as :meth:`AccountStore.usable`.
+
+        The database lags behind by up to one flush interval, so selection
+        never reads it.
+        """
+        selected = []
+        with self.lock:
+            for record in self._by_key.values():
+                if not is_usable(record, avoid_unusual):
+                    continue
+                quota = record.get('quota_remaining')
+                if unknown_quota:
+                    if quota:
+                        continue
+                elif min_quota is not None and not (isinstance(quota, (int, float)) and quota >= min_quota):
+                    continue
+                selected.append(dict(record))
+        if order_by == "quota":
+            selected.sort(key=lambda r: (-(r.get('quota_remaining') or 0), r['row']))
+        else:
+            selected.sort(key=lambda r: r['row'])
+        return selected
+
+    def select_best(self, required_chars: int, min_quota: int = 0,
+                    avoid_unusual: bool = True) -> Optional[dict]:
+        """First account (by row) that fits ``required_chars``, else the largest quota."""
+        candidates = self.select_usable(min_quota=max(min_quota, 1), avoid_unusual=avoid_unusual)
+        fitting = [r for r in candidates if r['quota_remaining'] >= required_chars]
+        if fitting:
+            return fitting[0]
+        return max(candidates, key=lambda r: (r['quota_remaining'], -r['row']), default=None)
+
+    # ------------------------------------------------------------------
+    # Lookups
+    # ------------------------------------------------------------------
+    def get(self, api_key: str) -> Optional[dict]:
+        with self.lock:
+            record = self._by_key.get(api_key)
+            return dict(record) if record else None
+
+    def get_by_email(self, email: str) -> Optional[dict]:
+        with self.lock:
+            record = self._by_email.get(email)
+            return dict(record) if record else None
+
+    def accounts(self) -> List[dict]:
+        """Snapshot of all accounts ordered by spreadsheet row."""
+        with self.lock:
+            return [dict(r) for r in sorted(self._by_key.values(), key=lambda r: r['row'])]
+
+    # ------------------------------------------------------------------
+    # Mutations
+    # ------------------------------------------------------------------
+    def _apply(self, entry: dict) -> Optional[dict]:
+        """Apply a journal entry to the in-memory record (caller holds the lock)."""
+        record = self._by_key.get(entry["api_key"])
+        if record is None:
+            return None
+        if entry["op"] == "consume":
+            chars = entry["chars"]
+            record['quota_remaining'] = max(0, (record.get('quota_remaining') or 0) - chars)
+            record['usage_count'] = (record.get('usage_count') or 0) + chars
+            if entry.get("touched_at"):
+                record['last_checked'] = entry["touched_at"]
+        elif entry["op"] == "update":
+            fields = entry["fields"]
+            if 'email' in fields and fields['email'] != record.get('email'):
+                self._by_email.pop(record.get('email'), None)
+                if fields['email']:
+                    self._by_email[fields['email']] = record
+            record.update(fields)
+        self.quota_index.update(record['api_key'], self._indexed_quota(record))
+        return record
+
+    def _commit(self, entry: dict) -> Optional[dict]:
+        """Apply ``entry`` in memory and append it to the journal.
+
+        Returns a copy of the updated record, or ``None`` for unknown keys.
+        """
+        with self.lock:
+            if entry["api_key"] not in self._by_key:
+                return None
+            self._seq += 1
+            entry["seq"] = self._seq
+            result = dict(self._apply(entry))
+            self._unflushed.append(entry)
+            pending = len(self._unflushed)
+        self.journal.append(entry)
+        self._ensure_flusher()
+        if pending >= self.flush_threshold:
+            self._flush_event.set()
+        return result
+
+    def update(self, api_key: str, **fields) -> Optional[dict]:
+        """Set record fields for ``api_key``. Returns the updated copy or ``None``."""
+        return self._commit({"op": "update", "api_key": api_key, "fields": fields})
+
+    def set_quota(self, api_key: str, quota_remaining: int) -> Optional[dict]:
+        """Store a freshly checked quota value."""
+        return self.update(api_key, quota_remaining=quota_remaining, last_checked=now_str())
+
+    def consume(self, api_key: str, chars: int, touch: bool = True) -> Optional[int]:
+        """Subtract ``chars`` from the quota and add them to the usage counter.
+
+        Returns the new remaining quota or ``None`` for unknown keys.
+        """
+        record = self._commit({
+            "op": "consume",
+            "api_key": api_key,
+            "chars": chars,
+            "touched_at": now_str() if touch else None,
+        })
+        return record['quota_remaining'] if record else None
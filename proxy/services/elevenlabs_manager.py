@@ -10,22 +10,29 @@ import json
 from datetime import datetime
 from pathlib import Path
 import openpyxl
-from zipfile import BadZipFile
 import requests
 import queue as thread_queue
 import math
+from collections import deque
+from concurrent.futures import wait as wait_futures
 from typing import Dict
 from utils.logger import log, FULL_LOGS, maybe_truncate
 import globals as g
-import random
 import socket
 import re
-from requests.exceptions import ReadTimeout, ConnectionError
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
+from requests.exceptions import ReadTimeout, ConnectionError, ChunkedEncodingError
 from config.global_params import load_elevenlabs_limits
 
 from proxy.mobile_proxy import MobileProxyManager
+from services.elevenlabs_accounts import ElevenLabsAccountRegistry, is_usable, now_str
+from services.account_packing import DEFAULT_STRATEGY, PACKING_STRATEGIES, pack
+from core.stats import rotation_stats
+from proxy.session_pool import session_pool
+from core.worker_pool import KeyedWorkerPool
+from core.stream_channel import StreamChannel
+from services.tts_cache import TTSCache, make_key as make_cache_key
+from services.result_store import ResultStore
+from services.tts_chunker import join_mp3, split_text
 
 VOICE_DEFAULTS = {
     'stability': 0.5,
@@ -83,7 +90,7 @@ BASIC_VOICE_IDS = {
 }
 
 class ElevenLabsManager:
-    def __init__(self, excel_path: str = "api_elevenlabs.xlsx"):
+    def __init__(self, excel_path: str = "api_elevenlabs.xlsx", accounts: ElevenLabsAccountRegistry = None):
         import threading
         from queue import Queue as _Queue
 
@@ -92,7 +99,6 @@ class ElevenLabsManager:
         self.lock = threading.Lock()
         self.mobile_proxy = None  # DOBAVLENO
         self.account_rotation_lock = threading.Lock()  # DOBAVLENO
-        self._last_used_key = None  # DOBAVLENO
         self.cleaned_accounts = set()  # DOBAVLENO: ochishchennye akkaunty
         self._results: Dict[str, dict] = {}          # id  → result
         self._events : Dict[str, threading.Event] = {}# id  → Event dlya wait()
@@ -120,6 +126,11 @@ class ElevenLabsManager:
 
         # Прочее
         self._ensure_excel_structure()
+        # Reestr akkauntov v pamyati (Excel chitaetsya odin raz pri starte)
+        self.accounts = accounts
+        if self.accounts is None:
+            self.accounts = ElevenLabsAccountRegistry(excel_path)
+            self.accounts.load()
         self.quota_refresh_needed = False
         self.quota_refresh_accounts = set()
 
@@ -182,19 +193,6 @@ class ElevenLabsManager:
         except Exception as e:
             log.exception("❌ Error in _ensure_excel_structure: %s", e)
 
-    def _load_workbook_safe(self):
-        """Safely load Excel workbook, recreating if corrupted."""
-        try:
-            return openpyxl.load_workbook(self.excel_path)
-        except BadZipFile:
-            log.error(f"❌ Excel file is corrupted: {self.excel_path}. Recreating...")
-            self._ensure_excel_structure()
-            try:
-                return openpyxl.load_workbook(self.excel_path)
-            except Exception as e:
-                log.error(f"❌ Failed to reload Excel file: {e}")
-                raise
-
     def _cleanup_elevenlabs_voices_for(self, api_key: str, account_email: str):
         """Udalyaet polzovatelskie golosa s akkaunta ElevenLabs"""
         try:
@@ -211,9 +209,7 @@ class ElevenLabsManager:
             }
             log.info(f"🌐 Using proxy for cleanup: {proxy_info['host']}:{proxy_info['port']}")
 
-            session = requests.Session()
-            session.trust_env = False
-            session.proxies = proxy_dict
+            session = session_pool.session("https://api.elevenlabs.io", proxy_dict)
 
             headers = {
                 "xi-api-key": api_key,
@@ -253,11 +249,6 @@ class ElevenLabsManager:
                     time.sleep(1)
                 except Exception as e:
                     log.error(f"❌ Exception deleting {vname} (ID: {vid}): {e}")
-
-            try:
-                session.close()
-            except Exception:
-                pass
         except Exception as e:
             log.error(f"❌ Cleanup error: {e}")
 
@@ -298,82 +289,65 @@ class ElevenLabsManager:
         key_data = None  # vazhno: initsializiruem zaranee
         outer_lock = self.account_rotation_lock if rotate_ip else nullcontext()
         with outer_lock:
-            wb = None
             try:
-                with self.lock:
-                    wb = openpyxl.load_workbook(self.excel_path)
-                    ws = wb.active
-
-                    best_key = None
-                    best_quota = -1
-                    min_useful_quota = 100
-
-                    for row in range(2, ws.max_row + 1):
-                        api_key = ws[f'A{row}'].value
-                        quota = ws[f'D{row}'].value
-                        status = (ws[f'F{row}'].value or 'active').lower()
-                        unusual_activity = (ws[f'I{row}'].value or 'no').lower()
-                        email = ws[f'B{row}'].value
-
-                        if not api_key or status == 'disabled':
-                            continue
-                        if avoid_unusual and unusual_activity == 'yes':
-                            log.debug(f"⚠️ Skipping account with unusual activity: {email}")
-                            continue
-
-                        # esli v Excel kvota pustaya/nol — poprobuem poluchit ee cherez API odin raz
-                        if quota in (None, '', 0):
-                            proxy_dict = {}
-                            if self.mobile_proxy:
-                                proxy_info = self.mobile_proxy.get_proxy_connection_info()
-                                if proxy_info:
-                                    proxy_dict = {
-                                        "http":  f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
-                                        "https": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
-                                    }
-                            quota = self.check_quota(api_key, proxy_dict, force=True)
-                            self.update_quota_in_excel(api_key, quota)
-
-                        # otsekaem melkie ostatki
-                        if quota is not None and quota != '' and quota < min_useful_quota:
-                            continue
-
-                        # esli polnostyu khvataet — berem srazu
+                min_useful_quota = 100
+
+                def find_account():
+                    if not avoid_unusual:
+                        return self.accounts.select_best(required_chars, min_quota=min_useful_quota,
+                                                         avoid_unusual=False)
+                    # Indeks po kvote: pervyy po poryadku s dostatochnoy kvotoy, inache — s maksimalnoy
+                    return (self.accounts.pick(required_chars, strategy="first_fit", min_quota=min_useful_quota)
+                            or self.accounts.largest(min_quota=min_useful_quota))
+
+                # Akkaunt, privyazannyy k tekushchemu IP, ispolzuem poka khvataet kvoty:
+                # smena akkaunta = rotatsiya IP (5-60 s ozhidaniya)
+                account = None
+                bound_key = rotation_stats.bound_key
+                if bound_key:
+                    bound = self.accounts.get(bound_key)
+                    if (bound and is_usable(bound, avoid_unusual=avoid_unusual)
+                            and (bound['quota_remaining'] or 0) >= max(required_chars, min_useful_quota)):
+                        account = bound
+
+                if account is None:
+                    account = find_account()
+                if not account or account['quota_remaining'] < required_chars:
+                    # akkaunty s pustoy/nulevoy kvotoy — proveryaem cherez API, poka ne naydem podkhodyashchiy
+                    for candidate in self.accounts.select_usable(avoid_unusual=avoid_unusual, unknown_quota=True):
+                        proxy_dict = {}
+                        if self.mobile_proxy:
+                            proxy_info = self.mobile_proxy.get_proxy_connection_info()
+                            if proxy_info:
+                                proxy_dict = {
+                                    "http":  f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
+                                    "https": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
+                                }
+                        quota = self.check_quota(candidate['api_key'], proxy_dict, force=True)
+                        self.update_quota_in_excel(candidate['api_key'], quota)
                         if quota and quota >= required_chars:
-                            key_data = {
-                                'api_key': api_key,
-                                'quota_remaining': quota,
-                                'email': email,
-                                'row': row
-                            }
                             break
-
-                        # inache — zapominaem nailuchshiy
-                        if quota and quota > best_quota:
-                            best_quota = quota
-                            best_key = {
-                                'api_key': api_key,
-                                'quota_remaining': quota,
-                                'email': email,
-                                'row': row
-                            }
-
-                    if key_data is None:
-                        key_data = best_key
+                    account = find_account()
+
+                if account:
+                    key_data = {
+                        'api_key': account['api_key'],
+                        'quota_remaining': account['quota_remaining'],
+                        'email': account['email'],
+                        'row': account['row']
+                    }
 
             except Exception as e:
                 log.error(f"❌ Error getting best API key: {e}")
                 return None
-            finally:
-                if wb:
-                    wb.close()
 
         if not key_data:
             log.warning("⚠️ No suitable API key found")
             return None
 
-        if rotate_ip and self.mobile_proxy and self._last_used_key and self._last_used_key != key_data['api_key']:
-            log.info(f"🔄 Account changed: {str(self._last_used_key)[-10:]} → {str(key_data['api_key'])[-10:]}")
+        bound_key = rotation_stats.bound_key
+        if rotate_ip and self.mobile_proxy and bound_key and bound_key != key_data['api_key']:
+            log.info(f"🔄 Account changed: {str(bound_key)[-10:]} → {str(key_data['api_key'])[-10:]}")
             rotation_success = False
             for attempt in range(3):
                 if self.mobile_proxy.rotate_ip():
@@ -386,110 +360,93 @@ class ElevenLabsManager:
                 log.error("❌ Unable to rotate IP after 3 attempts")
                 return None
 
-        self._last_used_key = key_data['api_key']
+        rotation_stats.bind(key_data['api_key'])
+        rotation_stats.record_requests()
         return key_data
 
 
     def mark_unusual_activity(self, api_key: str, email: str = None, retry_count: int = 1):
         """Pomechaet API klyuch kak imeyushchiy podozritelnuyu aktivnost s schetchikom popytok"""
         try:
-            wb = openpyxl.load_workbook(self.excel_path)
-            ws = wb.active
-            
-            for row in range(2, ws.max_row + 1):
-                if ws[f'A{row}'].value == api_key:
-                    # Poluchaem tekushchiy schetchik popytok
-                    current_retries = ws[f'L{row}'].value or 0  # Novyy stolbets L dlya schetchika
-                    new_retry_count = current_retries + retry_count
-                    
-                    ws[f'I{row}'] = "yes"  # Unusual Activity
-                    ws[f'J{row}'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Time
-                    ws[f'L{row}'] = new_retry_count  # Retry count
-                    
-                    # Esli prevyshen limit popytok - pomechaem kak nerabochiy
-                    if new_retry_count >= 4:
-                        ws[f'F{row}'] = "disabled"  # Status
-                        ws[f'K{row}'] = f"Disabled after {new_retry_count} unusual activity attempts"  # Notes
-                        log.warning(f"🚨 Account disabled after {new_retry_count} attempts: {email}")
-                    else:
-                        log.warning(f"🚨 Unusual activity attempt {new_retry_count}/4: {email}")
-                    
-                    wb.save(self.excel_path)
-                    break
-                    
+            account = self.accounts.get(api_key)
+            if not account:
+                return
+
+            # Poluchaem tekushchiy schetchik popytok
+            new_retry_count = (account.get('retry_count') or 0) + retry_count
+            fields = {
+                'unusual_activity': "yes",
+                'unusual_activity_time': now_str(),
+                'retry_count': new_retry_count,
+            }
+
+            # Esli prevyshen limit popytok - pomechaem kak nerabochiy
+            if new_retry_count >= 4:
+                fields['status'] = "disabled"
+                fields['notes'] = f"Disabled after {new_retry_count} unusual activity attempts"
+                log.warning(f"🚨 Account disabled after {new_retry_count} attempts: {email}")
+            else:
+                log.warning(f"🚨 Unusual activity attempt {new_retry_count}/4: {email}")
+
+            self.accounts.update(api_key, **fields)
+
         except Exception as e:
             log.error(f"❌ Error marking unusual activity: {e}")
 
     def clear_unusual_activity(self, api_key: str):
         """Ochishchaet otmetku o podozritelnoy aktivnosti"""
         try:
-            wb = openpyxl.load_workbook(self.excel_path)
-            ws = wb.active
-            
-            for row in range(2, ws.max_row + 1):
-                if ws[f'A{row}'].value == api_key:
-                    ws[f'I{row}'] = "no"
-                    ws[f'J{row}'] = ""
-                    wb.save(self.excel_path)
-                    
-                    email = ws[f'B{row}'].value or "unknown"
-                    log.info(f"✅ Cleared unusual activity flag for: {email}")
-                    break
-                    
+            account = self.accounts.update(api_key, unusual_activity="no", unusual_activity_time="")
+            if account:
+                log.info(f"✅ Cleared unusual activity flag for: {account.get('email') or 'unknown'}")
+
         except Exception as e:
             log.error(f"❌ Error clearing unusual activity: {e}")
 
     def mark_quota_exceeded(self, api_key: str, remaining: int = 0, message: str = ""):
         """Pomechaet akkaunt kak ischerpavshiy kvotu"""
         try:
-            with self.lock:
-                wb = self._load_workbook_safe()
-                ws = wb.active
+            fields = {'quota_remaining': remaining, 'last_checked': now_str()}
+            if message:
+                fields['notes'] = message
+            account = self.accounts.update(api_key, **fields)
+            if not account:
+                return
+            email = account.get('email') or 'unknown'
+            log.warning(
+                f"⚠️ Quota exceeded for {email}: remaining={remaining}"
+            )
 
-                for row in range(2, ws.max_row + 1):
-                    if ws[f'A{row}'].value == api_key:
-                        ws[f'D{row}'] = remaining
-                        ws[f'E{row}'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        if message:
-                            ws[f'K{row}'] = message
-                        email = ws[f'B{row}'].value or 'unknown'
-                        wb.save(self.excel_path)
-                        wb.close()
-                        log.warning(
-                            f"⚠️ Quota exceeded for {email}: remaining={remaining}"
-                        )
-
-                        # Posle oshibki proveryaem aktualnuyu kvotu i obnovlyaem Excel
-                        try:
-                            proxy_obj = None
-                            proxy_dict = {}
-                            if hasattr(g, 'proxy_manager'):
-                                proxy_obj = g.proxy_manager.get_available_proxy(for_openai_fm=False)
-                                proxy_dict = self._get_proxy_dict(proxy_obj) if proxy_obj else {}
-
-                            quota_remaining = self.check_quota(api_key, proxy_dict, force=True)
-                            self.update_quota_in_excel(api_key, quota_remaining)
-
-                            # Log quota check result to JSON file
-                            try:
-                                data = {}
-                                if self.quota_log_path.exists():
-                                    with self.quota_log_path.open('r', encoding='utf-8') as f:
-                                        data = json.load(f)
-                                data[email] = {
-                                    'api_key': api_key[-8:],
-                                    'remaining': quota_remaining,
-                                    'checked_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                    'message': message,
-                                }
-                                with self.quota_log_path.open('w', encoding='utf-8') as f:
-                                    json.dump(data, f, ensure_ascii=False, indent=2)
-                            except Exception as log_err:
-                                log.error(f"❌ Error writing quota log: {log_err}")
+            # Posle oshibki proveryaem aktualnuyu kvotu i obnovlyaem reestr
+            try:
+                proxy_obj = None
+                proxy_dict = {}
+                if hasattr(g, 'proxy_manager'):
+                    proxy_obj = g.proxy_manager.get_available_proxy(for_openai_fm=False)
+                    proxy_dict = self._get_proxy_dict(proxy_obj) if proxy_obj else {}
 
-                        except Exception as check_err:
-                            log.error(f"❌ Error refreshing quota after exceed: {check_err}")
-                        break
+                quota_remaining = self.check_quota(api_key, proxy_dict, force=True)
+                self.update_quota_in_excel(api_key, quota_remaining)
+
+                # Log quota check result to JSON file
+                try:
+                    data = {}
+                    if self.quota_log_path.exists():
+                        with self.quota_log_path.open('r', encoding='utf-8') as f:
+                            data = json.load(f)
+                    data[email] = {
+                        'api_key': api_key[-8:],
+                        'remaining': quota_remaining,
+                        'checked_at': now_str(),
+                        'message': message,
+                    }
+                    with self.quota_log_path.open('w', encoding='utf-8') as f:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                except Exception as log_err:
+                    log.error(f"❌ Error writing quota log: {log_err}")
+
+            except Exception as check_err:
+                log.error(f"❌ Error refreshing quota after exceed: {check_err}")
         except Exception as e:
             log.error(f"❌ Error marking quota exceeded: {e}")
 
@@ -499,26 +456,13 @@ class ElevenLabsManager:
             log.debug(f"⏭️ Skipping quota check for {api_key[-8:]}")
             return 0
 
-        session = requests.Session()
-        session.trust_env = False
-
-        # Retrai na urovne urllib3 (na sluchay 429/5xx)
-        retry = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["GET"]
-        )
-        session.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=10))
-
-        if proxy_dict:
-            session.proxies = proxy_dict
-
         headers = {
             "xi-api-key": api_key,
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
         }
         url = "https://api.elevenlabs.io/v1/user/subscription"
+        # Retrai na urovne urllib3 (na sluchay 429/5xx)
+        session = session_pool.session(url, proxy_dict, retry="get")
 
         try:
             resp = session.get(url, headers=headers)
@@ -536,53 +480,32 @@ class ElevenLabsManager:
         except Exception as e:
             log.error(f"❌ Error checking quota: {e}")
             return 0
-        finally:
-            try:
-                session.close()
-            except:
-                pass
 
         
     def update_quota_in_excel(self, api_key: str, quota_remaining: int):
-        """Obnovlyaet kvotu v Excel fayle"""
+        """Obnovlyaet kvotu akkaunta v reestre (Excel obnovlyaetsya pri eksporte)"""
         try:
-            with self.lock:
-                wb = self._load_workbook_safe()
-                ws = wb.active
-
-                for row in range(2, ws.max_row + 1):
-                    if ws[f'A{row}'].value == api_key:
-                        ws[f'D{row}'] = quota_remaining
-                        ws[f'E{row}'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        break
-
-                wb.save(self.excel_path)
-                wb.close()
-
+            self.accounts.set_quota(api_key, quota_remaining)
         except Exception as e:
             log.error(f"❌ Error updating quota in Excel: {e}")
 
     def refresh_all_quotas(self, accounts=None, max_workers: int = 5) -> dict:
         """Proveryaet kvotu akkauntov. Esli accounts=None - proveryayutsya vse"""
         try:
-            wb = openpyxl.load_workbook(self.excel_path)
-            ws = wb.active
             accounts_list = []
             filter_set = set(accounts) if accounts else None
-            for row in range(2, ws.max_row + 1):
-                api_key = ws[f'A{row}'].value
-                email = ws[f'B{row}'].value
-                status = ws[f'F{row}'].value or 'active'
-                if not api_key or (status and status.lower() == 'disabled'):
+            for account in self.accounts.accounts():
+                api_key = account['api_key']
+                email = account['email']
+                if not is_usable(account, avoid_unusual=False):
                     continue
                 if filter_set and api_key not in filter_set and email not in filter_set:
                     continue
-                accounts_list.append((row, api_key, email))
-            wb.close()
+                accounts_list.append((api_key, email))
 
             results = {}
 
-            def worker(row, api_key, email):
+            def worker(api_key, email):
                 proxy_dict = None
                 if self.mobile_proxy:
                     proxy_info = self.mobile_proxy.get_proxy_connection_info()
@@ -592,18 +515,12 @@ class ElevenLabsManager:
                             "https": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}"
                         }
                 quota = self.check_quota(api_key, proxy_dict, force=True)
-                with self.lock:
-                    wb_local = openpyxl.load_workbook(self.excel_path)
-                    ws_local = wb_local.active
-                    ws_local[f'D{row}'] = quota
-                    ws_local[f'E{row}'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    wb_local.save(self.excel_path)
-                    wb_local.close()
+                self.accounts.set_quota(api_key, quota)
                 results[email] = quota
 
             threads = []
-            for row, api_key, email in accounts_list:
-                t = threading.Thread(target=worker, args=(row, api_key, email), daemon=True)
+            for api_key, email in accounts_list:
+                t = threading.Thread(target=worker, args=(api_key, email), daemon=True)
                 threads.append(t)
                 t.start()
                 if len(threads) >= max_workers:
@@ -632,54 +549,36 @@ class ElevenLabsManager:
     def update_usage(self, api_key: str, chars_used: int):
             """Obnovlyaet ispolzovanie API klyucha"""
             try:
-                wb = openpyxl.load_workbook(self.excel_path)
-                ws = wb.active
-                
-                for row in range(2, ws.max_row + 1):
-                    if ws[f'A{row}'].value == api_key:
-                        current_quota = ws[f'D{row}'].value or 0
-                        current_usage = ws[f'G{row}'].value or 0
-                        
-                        ws[f'D{row}'] = max(0, current_quota - chars_used)
-                        ws[f'G{row}'] = current_usage + chars_used
-                        break
-                        
-                wb.save(self.excel_path)
-                
+                self.accounts.consume(api_key, chars_used, touch=False)
             except Exception as e:
                 log.error(f"❌ Error updating usage: {e}")
 
     def check_and_update_quota_from_excel(self, api_key: str) -> int:
-        """Proveryaet kvotu iz Excel; pri ustarevanii obnovlyaet cherez API"""
+        """Proveryaet kvotu iz reestra; pri ustarevanii obnovlyaet cherez API"""
         try:
-            wb = openpyxl.load_workbook(self.excel_path)
-            ws = wb.active
-
-            for row in range(2, ws.max_row + 1):
-                if ws.cell(row=row, column=1).value == api_key:
-                    email = ws.cell(row=row, column=2).value
-                    quota_from_excel = ws.cell(row=row, column=4).value or 0
-                    last_checked = ws.cell(row=row, column=5).value
-                    wb.close()
-
-                    # spolzuem kesh, esli dannye svezhie (<5 minut)
-                    if quota_from_excel > 0 and last_checked:
-                        try:
-                            last_checked_time = datetime.strptime(last_checked, '%Y-%m-%d %H:%M:%S')
-                            if (datetime.now() - last_checked_time).total_seconds() < 300:
-                                log.debug(f"📊 Using cached quota for {email}: {quota_from_excel}")
-                                return quota_from_excel
-                        except Exception:
-                            pass
-
-                    # Kvota otsutstvuet ili ustarela – obnovlyaem cherez API
-                    new_quota = self.check_quota(api_key, force=True)
-                    self.update_quota_in_excel(api_key, new_quota)
-                    log.debug(f"📊 Refreshed quota for {email}: {new_quota}")
-                    return new_quota
-
-            wb.close()
-            return 0
+            account = self.accounts.get(api_key)
+            if not account:
+                return 0
+
+            email = account['email']
+            quota_cached = account['quota_remaining'] or 0
+            last_checked = account['last_checked']
+
+            # spolzuem kesh, esli dannye svezhie (<5 minut)
+            if quota_cached > 0 and last_checked:
+                try:
+                    last_checked_time = datetime.strptime(str(last_checked), '%Y-%m-%d %H:%M:%S')
+                    if (datetime.now() - last_checked_time).total_seconds() < 300:
+                        log.debug(f"📊 Using cached quota for {email}: {quota_cached}")
+                        return quota_cached
+                except Exception:
+                    pass
+
+            # Kvota otsutstvuet ili ustarela – obnovlyaem cherez API
+            new_quota = self.check_quota(api_key, force=True)
+            self.update_quota_in_excel(api_key, new_quota)
+            log.debug(f"📊 Refreshed quota for {email}: {new_quota}")
+            return new_quota
 
         except Exception as e:
             log.error(f"❌ Error checking quota from Excel: {e}")
@@ -692,34 +591,15 @@ class ElevenLabsManager:
         return chars_used
 
     def update_quota_after_request(self, api_key: str, chars_used: int, model_id: str):
-        """Obnovlyaet kvotu v Excel posle otpravki zaprosa (potokobezopasno)"""
+        """Obnovlyaet kvotu v reestre posle otpravki zaprosa (potokobezopasno)"""
         cost = self._calculate_quota_cost(chars_used, model_id)
-        with self.lock:
-            try:
-                wb = openpyxl.load_workbook(self.excel_path)
-                ws = wb.active
-
-                for row in range(2, ws.max_row + 1):
-                    if ws.cell(row=row, column=1).value == api_key:
-                        email = ws.cell(row=row, column=2).value
-                        current_quota = ws.cell(row=row, column=4).value or 0
-                        current_usage = ws.cell(row=row, column=7).value or 0
-
-                        new_quota = max(0, current_quota - cost)
-                        new_usage = current_usage + cost
-
-                        ws.cell(row=row, column=4, value=new_quota)
-                        ws.cell(row=row, column=7, value=new_usage)
-                        ws.cell(row=row, column=5, value=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-
-                        wb.save(self.excel_path)
-                        wb.close()
-
-                        log.debug(f"📊 Updated quota for {email}: {new_quota} remaining (+{cost} used)")
-                        break
-
-            except Exception as e:
-                log.error(f"❌ Error updating quota after request: {e}")
+        try:
+            new_quota = self.accounts.consume(api_key, cost)
+            if new_quota is not None:
+                account = self.accounts.get(api_key) or {}
+                log.debug(f"📊 Updated quota for {account.get('email')}: {new_quota} remaining (+{cost} used)")
+        except Exception as e:
+            log.error(f"❌ Error updating quota after request: {e}")
 
 
 
@@ -741,18 +621,15 @@ class ElevenLabsManager:
             if last_time and time.time() - last_time < 10:
                 return
 
-            session = requests.Session()
-            session.trust_env = False
             # Prefer explicit proxies; else mobile proxy; else no proxies
-            if proxies:
-                session.proxies = proxies
-            elif self.mobile_proxy:
+            if not proxies and self.mobile_proxy:
                 proxy_info = self.mobile_proxy.get_proxy_connection_info()
                 if proxy_info:
-                    session.proxies = {
+                    proxies = {
                         "http": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
                         "https": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}"
                     }
+            session = session_pool.session("https://api.elevenlabs.io", proxies)
 
             headers = {
                 "xi-api-key": api_key,
@@ -763,10 +640,6 @@ class ElevenLabsManager:
             resp = session.get("https://api.elevenlabs.io/v1/voices", headers=headers, timeout=30)
             if resp.status_code != 200:
                 log.error(f"Voices API error (cleanup): {resp.status_code} - {maybe_truncate(resp.text, 200)}")
-                try:
-                    session.close()
-                except Exception:
-                    pass
                 return
 
             voices = (resp.json() or {}).get("voices", [])
@@ -793,11 +666,6 @@ class ElevenLabsManager:
                 except Exception as de:
                     log.warning(f"Voice delete exception {name} ({vid}): {de}")
 
-            try:
-                session.close()
-            except Exception:
-                pass
-
             # Record cleanup time for this API key
             self._last_voice_cleanup[api_key] = time.time()
         except Exception as e:
@@ -805,15 +673,30 @@ class ElevenLabsManager:
 
 
 class ElevenLabsQueue:
-    def __init__(self, excel_path: str = "api_elevenlabs.xlsx"):
+    def __init__(self, excel_path: str = "api_elevenlabs.xlsx", accounts: ElevenLabsAccountRegistry = None):
         self.excel_path = excel_path
+        # Obshchiy s ElevenLabsManager reestr akkauntov
+        self.accounts = accounts
+        if self.accounts is None:
+            self.accounts = ElevenLabsAccountRegistry(excel_path)
+            self.accounts.load()
         self.queue = thread_queue.Queue()
         self.processing = False
         self.lock = threading.Lock()
         self.account_assignments = {}  # {account_id: [requests]}
         self.processing_thread = None
-        self._events: Dict[str, threading.Event] = {}
-        self._results: Dict[str, dict] = {}
+        self._streams: Dict[str, StreamChannel] = {}  # id → kanal dlya strim-zaprosov
+        # Single-flight: odinakovye zaprosy zhdut odnu generatsiyu
+        self._inflight_lock = threading.Lock()
+        self._inflight: Dict[str, list] = {}       # klyuch zaprosa -> [id vedushchego, id vedomykh...]
+        self._inflight_keys: Dict[str, str] = {}   # id vedushchego -> klyuch zaprosa
+        self.coalesced = 0
+        self._live: Dict[str, dict] = {}        # id → slovar zaprosa, poka net rezultata (status zadachi)
+        self._completions = deque(maxlen=200)   # vremya zaversheniya zaprosov — dlya otsenki ETA
+        # Dlinnye teksty: id kuska → id roditelya; roditel → {ids kuskov, skolko ostalos, klyuch kesha}
+        self._chunk_lock = threading.Lock()
+        self._chunk_parent: Dict[str, str] = {}
+        self._chunked: Dict[str, dict] = {}
         self.stop_event = threading.Event()
 
         # Default configuration for requests in the queue. This mirrors
@@ -830,12 +713,42 @@ class ElevenLabsQueue:
         # Mobile proxy instance reused across managers (set externally)
         self.mobile_proxy = None
         limits = load_elevenlabs_limits()
+        # Rezultaty s TTL i limitom pamyati (vmesto vechnykh _results/_events)
+        spill_kb = limits.get("result_spill_kb")
+        self.results = ResultStore(
+            ttl=limits.get("result_ttl_sec", 600),
+            max_bytes=limits.get("result_max_mb", 256) * 1024 * 1024,
+            spill_bytes=spill_kb * 1024 if spill_kb else None,
+            spill_dir=limits.get("result_spill_dir"),
+        )
         self._account_semaphores = {}  # api_key -> Semaphore(limit)
         self._semaphores_lock = threading.Lock()
         self._max_concurrent_per_account = limits.get("max_concurrent_per_account", 2)
         self._batch_size = limits.get("batch_size")
+        self._max_chunk_chars = limits.get("max_chunk_chars", 2500)
+        self._packing_strategy = limits.get("packing_strategy", DEFAULT_STRATEGY)
+        if self._packing_strategy not in PACKING_STRATEGIES:
+            log.warning(f"⚠️ Unknown packing strategy {self._packing_strategy!r}, using {DEFAULT_STRATEGY}")
+            self._packing_strategy = DEFAULT_STRATEGY
+        self.packing_stats = deque(maxlen=50)  # statistika upakovki po poslednim pachkam
+        # Postoyannyy pul vorkerov vmesto potoka na kazhdyy zapros
+        self._pool = KeyedWorkerPool(
+            limits.get("max_workers", 10),
+            per_key_limit=self._max_concurrent_per_account,
+            name="elevenlabs",
+        )
         self._cleanup_events_lock = threading.Lock()
         self._account_cleanup_events = {}
+        # Akkaunt, poslednim otrabotavshiy zapros na tekushchem IP
+        self._last_served_key = None
+        # Kesh gotovykh MP3 na diske (0 MB — otklyuchen)
+        cache_mb = limits.get("tts_cache_max_mb", 1024)
+        self.cache = None
+        if cache_mb:
+            try:
+                self.cache = TTSCache(limits.get("tts_cache_dir", "tts_cache"), cache_mb * 1024 * 1024)
+            except OSError as e:
+                log.error(f"❌ TTS cache disabled: {e}")
 
 
     def update_config(self, config: dict) -> None:
@@ -846,6 +759,42 @@ class ElevenLabsQueue:
         # Обновляем общий конфиг
         self.config.update(config)
 
+    def get_stats(self) -> dict:
+        """Queue metrics for the /elevenlabs/queue-stats endpoint."""
+        return {
+            "queue_size": self.queue.qsize(),
+            "packing_strategy": self._packing_strategy,
+            "packing": list(self.packing_stats),
+            "rotations": rotation_stats.snapshot(),
+            "pool": self._pool.get_stats(),
+            "cache": self.cache.get_stats() if self.cache else None,
+            "results": self.results.get_stats(),
+            "inflight": len(self._inflight),
+            "coalesced": self.coalesced,
+        }
+
+    def _voice_payload(self, config: dict) -> tuple:
+        """``(model_id, voice_settings)`` that will be sent for ``config``."""
+        model_id = config.get('model_id', self.config.get('model_id'))
+        allowed = MODEL_VOICE_PARAMS.get(model_id, VOICE_DEFAULTS.keys())
+        voice_settings = {
+            p: config.get(p, VOICE_DEFAULTS.get(p))
+            for p in allowed
+            if config.get(p, VOICE_DEFAULTS.get(p)) is not None
+        }
+        return model_id, voice_settings
+
+    def request_key(self, text: str, voice_id: str, config: dict) -> str:
+        """Klyuch zaprosa: odinakovyy klyuch = odinakovoe audio."""
+        model_id, voice_settings = self._voice_payload(config)
+        return make_cache_key(text, voice_id, model_id, voice_settings)
+
+    def cache_key(self, text: str, voice_id: str, config: dict) -> str | None:
+        """Klyuch kesha dlya zaprosa (None, esli kesh vyklyuchen)."""
+        if not self.cache:
+            return None
+        return self.request_key(text, voice_id, config)
+
     def _get_account_semaphore(self, api_key: str) -> threading.Semaphore:
         """Return per-account semaphore, creating it with configured limit."""
         with self._semaphores_lock:
@@ -869,6 +818,20 @@ class ElevenLabsQueue:
         if manager and hasattr(manager, "mark_quota_exceeded"):
             manager.mark_quota_exceeded(api_key, remaining, message)
 
+    def check_quota(self, api_key: str, proxy_dict: dict = None, force: bool = False) -> int:
+        """Delegate the live quota check to the global manager."""
+        manager = getattr(g, "elevenlabs_manager", None)
+        if manager and hasattr(manager, "check_quota"):
+            return manager.check_quota(api_key, proxy_dict, force=force)
+        return 0
+
+    def refresh_all_quotas(self, accounts=None, max_workers: int = 5) -> dict:
+        """Delegate quota refresh to the global manager."""
+        manager = getattr(g, "elevenlabs_manager", None)
+        if manager and hasattr(manager, "refresh_all_quotas"):
+            return manager.refresh_all_quotas(accounts=accounts, max_workers=max_workers)
+        return {}
+
     def _ensure_initial_voice_cleanup(self, account: dict, proxies: dict | None):
         """Perform voice cleanup once per account for the current batch.
 
@@ -902,17 +865,14 @@ class ElevenLabsQueue:
             if last_time and time.time() - last_time < 10:
                 return
 
-            session = requests.Session()
-            session.trust_env = False
-            if proxies:
-                session.proxies = proxies
-            elif self.mobile_proxy:
+            if not proxies and self.mobile_proxy:
                 proxy_info = self.mobile_proxy.get_proxy_connection_info()
                 if proxy_info:
-                    session.proxies = {
+                    proxies = {
                         "http": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
                         "https": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
                     }
+            session = session_pool.session("https://api.elevenlabs.io", proxies)
 
             headers = {
                 "xi-api-key": api_key,
@@ -923,7 +883,6 @@ class ElevenLabsQueue:
             resp = session.get("https://api.elevenlabs.io/v1/voices", headers=headers, timeout=30)
             if resp.status_code != 200:
                 log.error(f"Voices API error (cleanup): {resp.status_code} - {maybe_truncate(resp.text, 200)}")
-                session.close()
                 return
 
             voices = (resp.json() or {}).get("voices", [])
@@ -950,39 +909,219 @@ class ElevenLabsQueue:
                 except Exception as de:
                     log.warning(f"Voice delete exception {name} ({vid}): {de}")
 
-            session.close()
             self._last_voice_cleanup[api_key] = time.time()
         except Exception as e:
             log.error(f"ensure_account_voices_cleaned error: {e}")
 
 
-    def add_request(self, text: str, voice_id: str, config: dict) -> str:
-        """Kladet zapros v ochered i sozdaet Event dlya ozhidaniya."""
+    def add_request(self, text: str, voice_id: str, config: dict, stream: bool = False) -> str:
+        """Kladet zapros v ochered i sozdaet Event dlya ozhidaniya.
+
+        ``stream=True`` — audio otdaetsya po chastyam cherez :meth:`get_stream`.
+        Esli takoy zhe (ne strimovyy) zapros uzhe v rabote, novyy ne stavitsya v
+        ochered, a zhdet rezultat togo zhe zaprosa. Dlinnyy tekst rezhetsya na
+        kuski (sm. :meth:`_chunk_limit`), audio kuskov skleivaetsya po poryadku.
+        """
+        req_id, reqs = self._register_request(text, voice_id, config, stream)
+        for req in reqs:
+            self.queue.put(req)
+            log.info("📝 Request %s queued: %d chars", req['id'][:8], req['chars_needed'])
+        if reqs:
+            self._start_processing()
+        return req_id
+
+    def add_requests(self, items) -> list:
+        """Bulk-postanovka: ``items`` — spisok ``(text, voice_id, config)``.
+
+        Vse zaprosy kladutsya v ochered podryad, poetomu obrabotchik zabiraet ikh
+        odnoy pachkoy (v predelakh ``batch_size``) i raspredelyaet po akkauntam
+        vsyu nagruzku srazu. Vozvrashchaet id v poryadke ``items``.
+        """
+        ids, batch = [], []
+        for text, voice_id, config in items:
+            req_id, reqs = self._register_request(text, voice_id, config)
+            ids.append(req_id)
+            batch.extend(reqs)
+        for req in batch:
+            self.queue.put(req)
+        if batch:
+            log.info("📝 Bulk: %d items → %d requests queued (%d chars)",
+                     len(ids), len(batch), sum(r['chars_needed'] for r in batch))
+            self._start_processing()
+        return ids
+
+    def _chunk_limit(self, config: dict) -> int:
+        """Maksimum simvolov v kuske: ne bolshe max_chunk_chars i kvoty samogo bolshogo akkaunta."""
+        limit = self._max_chunk_chars
+        largest = self.accounts.largest() if self.accounts else None
+        if largest and largest.get('quota_remaining'):
+            model_id = config.get('model_id', self.config.get('model_id'))
+            affordable = largest['quota_remaining'] * (2 if model_id in DISCOUNTED_MODELS else 1)
+            # Sovsem melkie kuski portyat intonatsiyu — nizhe 500 ne rezhem
+            limit = min(limit, max(affordable, 500))
+        return limit
+
+    def _register_request(self, text: str, voice_id: str, config: dict, stream: bool = False):
+        """Sozdaet zapis rezultata; vozvrashchaet ``(id, [zaprosy dlya ocheredi])``.
+
+        Spisok pust, esli ochered ostanovlena ili takoy zhe zapros uzhe v rabote.
+        """
         req_id = str(uuid.uuid4())
-        chars_needed = len(text)
+        if stream:
+            self._streams[req_id] = StreamChannel()
 
         if self.stop_event.is_set():
             log.warning("⚠️ Queue stopped, rejecting request %s", req_id[:8])
-            self._events[req_id] = threading.Event()
+            self.results.create(req_id)
             result = {'success': False, 'error': 'Queue stopped'}
             self._store_result(req_id, result)
-            return req_id
+            return req_id, []
+
+        # Rezhem i dlinnyy tekst, i tekst bolshe kvoty lyubogo akkaunta
+        limit = self._chunk_limit(config) if self._max_chunk_chars else 0
+        if not stream and limit and len(text) > limit:
+            pieces = split_text(text, limit)
+            if len(pieces) > 1:
+                return req_id, self._register_chunked(req_id, text, voice_id, config, pieces)
 
+        key = self.request_key(text, voice_id, config)
+        self.results.create(req_id)
         req = {
             "id": req_id,
             "text": text,
             "voice_id": voice_id,
             "config": config,
-            "chars_needed": chars_needed,
+            "chars_needed": len(text),
             "status": "queued",
             "result": None,
+            "stream": self._streams.get(req_id),
+            "cache_key": key,
         }
-        self._events[req_id] = threading.Event()
-        self.queue.put(req)
-        log.info("📝 Request %s queued: %d chars", req_id[:8], chars_needed)
-        self._start_processing()
+        with self._inflight_lock:
+            group = None if stream else self._inflight.get(key)
+            if group is not None:
+                group.append(req_id)
+                self._live[req_id] = self._live.get(group[0])
+                self.coalesced += 1
+                log.info("🔗 Request %s joined in-flight %s", req_id[:8], group[0][:8])
+                return req_id, []
+            if not stream:
+                self._inflight[key] = [req_id]
+                self._inflight_keys[req_id] = key
+            self._live[req_id] = req
+        return req_id, [req]
+
+    def _register_chunked(self, req_id: str, text: str, voice_id: str, config: dict, pieces: list) -> list:
+        """Roditelskiy zapros iz kuskov: kazhdyy kusok — obychnyy zapros ocheredi."""
+        self.results.create(req_id)
+        child_ids, reqs = [], []
+        for piece in pieces:
+            child_id, child_reqs = self._register_request(piece, voice_id, config)
+            child_ids.append(child_id)
+            reqs.extend(child_reqs)
+        with self._chunk_lock:
+            self._chunked[req_id] = {
+                "children": child_ids,
+                "remaining": set(child_ids),
+                "cache_key": self.request_key(text, voice_id, config),
+            }
+            for child_id in child_ids:
+                self._chunk_parent[child_id] = req_id
+        # Status roditelya = status pervogo kuska
+        self._live[req_id] = self._live.get(child_ids[0])
+        log.info("✂️ Request %s split into %d chunks (%d chars)", req_id[:8], len(pieces), len(text))
+        # Kuski mogli zavershitsya srazu (ochered ostanovlena)
+        for child_id in child_ids:
+            if self.results.status(child_id) == "done":
+                self._chunk_done(child_id)
+        return reqs
+
+    def _chunk_done(self, child_id: str) -> None:
+        with self._chunk_lock:
+            parent_id = self._chunk_parent.pop(child_id, None)
+            parent = self._chunked.get(parent_id)
+            if parent is None:
+                return
+            parent["remaining"].discard(child_id)
+            if parent["remaining"]:
+                return
+            del self._chunked[parent_id]
+
+        parts, error = [], None
+        for child_id in parent["children"]:
+            result = self.results.pop(child_id) or {'success': False, 'error': 'Chunk result lost'}
+            if not result.get('success'):
+                error = error or result.get('error', 'Generation failed')
+            else:
+                parts.append(result['content'])
+        if error:
+            result = {'success': False, 'error': f'Chunk failed: {error}'}
+        else:
+            content = join_mp3(parts)
+            if self.cache:
+                self.cache.put(parent["cache_key"], content)
+            result = {'success': True, 'content': content, 'content_type': 'audio/mpeg',
+                      'chunks': len(parts)}
+            log.info("🧩 Request %s stitched from %d chunks (%d bytes)", parent_id[:8], len(parts), len(content))
+        self._live.pop(parent_id, None)
+        self.results.set(parent_id, result)
+
+    def add_cached_result(self, cache_key: str) -> str:
+        """Gotovaya zadacha dlya audio iz kesha (audio otdaetsya iz fayla kesha)."""
+        req_id = str(uuid.uuid4())
+        self.results.create(req_id)
+        self.results.set(req_id, {
+            'success': True, 'cached': True, 'cache_key': cache_key, 'content_type': 'audio/mpeg',
+        })
         return req_id
 
+    def job_status(self, request_id: str) -> dict | None:
+        """Status zadachi: queued (s poziciey i otsenkoy starta), processing, done ili failed."""
+        state = self.results.status(request_id)
+        if state is None:
+            return None
+        info = {"job_id": request_id}
+        if state == "done":
+            result = self.results.peek(request_id) or {}
+            info["status"] = "done" if result.get("success") else "failed"
+            if not result.get("success"):
+                info["error"] = result.get("error", "Generation failed")
+            return info
+
+        req = self._live.get(request_id)
+        position = self._queue_position(req) if req else None
+        if position is None:
+            info["status"] = "processing"
+            return info
+        info["status"] = "queued"
+        info["queue_position"] = position
+        info["queue_size"] = self.queue.qsize()
+        per_request = self._seconds_per_request()
+        if per_request is not None:
+            wait = round((position - 1) * per_request, 1)
+            info["estimated_start_in"] = wait
+            info["estimated_start_at"] = datetime.fromtimestamp(time.time() + wait).isoformat(timespec="seconds")
+        else:
+            info["estimated_start_in"] = None
+            info["estimated_start_at"] = None
+        return info
+
+    def _queue_position(self, req: dict) -> int | None:
+        """1 = sleduyushchiy v ocheredi; None — zapros uzhe zabran v obrabotku."""
+        with self.queue.mutex:
+            for pos, item in enumerate(self.queue.queue, start=1):
+                if item is req:
+                    return pos
+        return None
+
+    def _seconds_per_request(self) -> float | None:
+        """Srednee vremya mezhdu zaversheniyami zaprosov za poslednie 10 minut."""
+        now = time.time()
+        recent = [t for t in self._completions if t > now - 600]
+        if len(recent) < 2:
+            return None
+        return (recent[-1] - recent[0]) / (len(recent) - 1)
+
     def _calculate_quota_cost(self, chars_used: int, model_id: str) -> int:
         """Return the quota cost for a request taking model discounts into account."""
         if model_id in DISCOUNTED_MODELS:
@@ -990,27 +1129,41 @@ class ElevenLabsQueue:
         return chars_used
 
     def _store_result(self, request_id: str, result: dict) -> None:
-        """Kladet rezultat i budit ozhidayushchiy potok."""
-        self._results[request_id] = result
-        ev = self._events.get(request_id)
-        if ev:
-            ev.set()
+        """Kladet rezultat i budit ozhidayushchiy potok (i vse prisoedinivshiesya)."""
+        with self._inflight_lock:
+            key = self._inflight_keys.pop(request_id, None)
+            group = self._inflight.pop(key, None) if key else None
+            if self._live.pop(request_id, None) is not None:
+                self._completions.append(time.time())
+            for rid in group or ():
+                self._live.pop(rid, None)
+        for rid in group or [request_id]:
+            channel = self._streams.get(rid)
+            if channel is not None:
+                channel.close(None if result.get('success') else result.get('error', 'Generation failed'))
+            self.results.set(rid, result)
+            if rid in self._chunk_parent:
+                self._chunk_done(rid)
+
+    def get_stream(self, request_id: str) -> StreamChannel | None:
+        """Kanal s chankami audio dlya zaprosa, postavlennogo s ``stream=True``."""
+        return self._streams.get(request_id)
+
+    def release_result(self, request_id: str) -> None:
+        """Zabyvaet rezultat, kotoryy uzhe ne nuzhen (naprimer, posle strima)."""
+        self.results.discard(request_id)
+        self._streams.pop(request_id, None)
 
     def wait_for_result(self, request_id: str, timeout: int = 300) -> dict | None:
-        """Blokiruetsya do rezultata ili taym-auta."""
-        ev = self._events.get(request_id)
-        if not ev:
+        """Blokiruetsya do rezultata ili taym-auta; zabrannyy rezultat udalyaetsya iz khranilishcha."""
+        if not self.results.wait(request_id, timeout):
             return None
-        is_set = ev.wait(timeout)
-        return self._results.get(request_id) if is_set else None
+        return self.results.pop(request_id)
 
 
     def _get_additional_accounts(self, needed_quota: int, max_single_needed: int = 0):
         """shchet dopolnitelnye akkaunty s pustoy kvotoy dlya proverki"""
         try:
-            wb = openpyxl.load_workbook(self.excel_path)
-            ws = wb.active
-            
             additional_accounts = []
             found_quota = 0
             checked_count = 0
@@ -1019,7 +1172,7 @@ class ElevenLabsQueue:
             
             log.info(f"🔍 Looking for additional accounts (need {needed_quota} more quota, max_single={max_single_needed})")
             
-            for row in range(2, ws.max_row + 1):
+            for account in self.accounts.accounts():
                 if checked_count >= max_check:
                     log.info(f"⏸️ Reached max check limit ({max_check}), stopping additional search")
                     break
@@ -1029,13 +1182,11 @@ class ElevenLabsQueue:
                     log.info(f"✅ Found enough quota during search: {found_quota} >= {needed_quota}, suitable_single={found_suitable_single}")
                     break
                     
-                api_key = ws[f'A{row}'].value
-                email = ws[f'B{row}'].value
-                status = ws[f'F{row}'].value or 'active'
-                unusual_activity = ws[f'I{row}'].value or 'no'
-                quota = ws[f'D{row}'].value
+                api_key = account['api_key']
+                email = account['email']
+                quota = account['quota_remaining']
 
-                if not api_key or (status and status.lower() == 'disabled') or unusual_activity == 'yes':
+                if not is_usable(account):
                     continue
                 
                 # shchem tolko akkaunty s pustoy kvotoy (kotorye eshche ne proveryalis)
@@ -1057,10 +1208,8 @@ class ElevenLabsQueue:
 
                     new_quota = self.check_quota(api_key, proxy_dict, force=True)
                     
-                    # Sokhranyaem v Excel
-                    ws[f'D{row}'] = new_quota
-                    ws[f'E{row}'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    wb.save(self.excel_path)
+                    # Sokhranyaem v reestr
+                    self.accounts.set_quota(api_key, new_quota)
                     
                     log.info(f"💾 Additional account {email}: {new_quota} quota")
                     
@@ -1069,7 +1218,7 @@ class ElevenLabsQueue:
                             'api_key': api_key,
                             'email': email,
                             'quota_remaining': new_quota,
-                            'row': row
+                            'row': account['row']
                         })
                         found_quota += new_quota
                         
@@ -1080,8 +1229,6 @@ class ElevenLabsQueue:
                     
                     time.sleep(2)  # Pauza mezhdu zaprosami
             
-            wb.close()
-            
             # Sortiruem po ubyvaniyu kvoty
             additional_accounts.sort(key=lambda x: x['quota_remaining'], reverse=True)
             
@@ -1214,8 +1361,14 @@ class ElevenLabsQueue:
                 if self.stop_event.is_set():
                     break
 
+                self._last_served_key = None
                 suspicious = self._process_accounts_concurrently()
 
+                rotation_stats.record_requests(sum(1 for req in requests if req.get('status') == 'completed'))
+                if self._last_served_key:
+                    # IP zakreplyaem za akkauntom, kotoryy poslednim rabotal na nem
+                    rotation_stats.bind(self._last_served_key)
+
                 if suspicious:
                     log.warning("🚨 Suspicious activity detected in batch; rotating proxy")
                     if self.mobile_proxy:
@@ -1244,6 +1397,12 @@ class ElevenLabsQueue:
                     self.queue.get_nowait()
             except Exception:
                 pass
+        self._pool.cancel_pending()
+        # Ne ostavlyaem "visyashchikh" grupp: k nim by prisoedinyalis novye zaprosy
+        with self._inflight_lock:
+            leaders = list(self._inflight_keys)
+        for req_id in leaders:
+            self._store_result(req_id, {'success': False, 'error': 'Queue stopped'})
 
         if getattr(self, "processing_thread", None) and self.processing_thread.is_alive():
             self.processing_thread.join(timeout=5)
@@ -1255,50 +1414,47 @@ class ElevenLabsQueue:
         log.info("📊 Assigning requests to accounts...")
 
         self.account_assignments = {}
-        unassigned_requests = sorted(requests, key=lambda x: x['chars_needed'])
-        log.info(f"📋 Sorted requests by size: {[req['chars_needed'] for req in unassigned_requests]}")
 
-        # Pytaemsya naznachit snachala samye malenkie zaprosy
-        for req in unassigned_requests[:]:
-            req_chars = req['chars_needed']
+        # Upakovka zaprosov v akkaunty (sm. services/account_packing.py)
+        items = []
+        for req in requests:
             model_id = req.get('config', {}).get('model_id', self.config.get('model_id'))
-            cost = self._calculate_quota_cost(req_chars, model_id)
-            assigned = False
-
-            # shchem podkhodyashchiy akkaunt sverkhu vniz po spisku
-            for account in available_accounts:
-                account_id = account['api_key']
-                available_quota = account['quota_remaining']
-
-                used_quota = 0
-                if account_id in self.account_assignments:
-                    used_quota = self.account_assignments[account_id]['total_chars']
-
-                remaining_quota = available_quota - used_quota
+            items.append((req, self._calculate_quota_cost(req['chars_needed'], model_id)))
+        bins = [(account['api_key'], account['quota_remaining']) for account in available_accounts]
+        bound_key = rotation_stats.bound_key
+        packing = pack(items, bins, strategy=self._packing_strategy, preferred=bound_key)
+
+        # Okna akkauntov: snachala privyazannyy k IP, dalshe kak v spiske; zaprosy — v poryadke ocheredi
+        batch_order = {id(req): pos for pos, req in enumerate(requests)}
+        windows = sorted(available_accounts, key=lambda account: account['api_key'] != bound_key)
+        for account in windows:
+            account_id = account['api_key']
+            assigned = packing['assignments'].get(account_id)
+            if not assigned:
+                continue
+            assigned.sort(key=lambda r: batch_order[id(r)])
+            self.account_assignments[account_id] = {
+                'account': account,
+                'requests': assigned,
+                'total_chars': packing['used'][account_id]
+            }
+            for req in assigned:
+                log.info(f"✅ Assigned request {req['id'][:8]} ({req['chars_needed']} chars) to {account['email']}")
 
-                if cost <= remaining_quota:
-                    if account_id not in self.account_assignments:
-                        self.account_assignments[account_id] = {
-                            'account': account,
-                            'requests': [],
-                            'total_chars': 0
-                        }
+        unassigned_requests = packing['unassigned']
+        for req in unassigned_requests:
+            log.warning(
+                f"⚠️ Could not assign request {req['id'][:8]} ({req['chars_needed']} chars) - no account with sufficient quota"
+            )
 
-                    self.account_assignments[account_id]['requests'].append(req)
-                    self.account_assignments[account_id]['total_chars'] += cost
-                    unassigned_requests.remove(req)
-                    assigned = True
-                    log.info(
-                        f"✅ Assigned request {req['id'][:8]} ({req_chars} chars) to {account['email']} "
-                        f"(remaining: {remaining_quota - cost})"
-                    )
-                    break
+        stats = packing['stats']
+        self.packing_stats.append({"time": now_str(), "strategy": packing['strategy'], **stats})
+        log.info(
+            f"📦 Packing ({packing['strategy']}): {stats['assigned']}/{stats['requests']} requests on "
+            f"{stats['accounts_touched']} accounts (lower bound {stats['accounts_lower_bound']}), "
+            f"fill {stats['fill_ratio']:.1%}, efficiency {stats['efficiency']:.1%}"
+        )
 
-            if not assigned:
-                log.warning(
-                    f"⚠️ Could not assign request {req['id'][:8]} ({req_chars} chars) - no account with sufficient quota"
-                )
-        
         # Logiruem itogovye naznacheniya
         for account_id, assignment in self.account_assignments.items():
             account = assignment['account']
@@ -1327,109 +1483,49 @@ class ElevenLabsQueue:
     def _get_available_accounts(self, force_refresh: bool = False, required_quota: int = 0):
         """Poluchaet spisok dostupnykh akkauntov s proverkoy aktualnoy kvoty"""
         try:
-            wb = openpyxl.load_workbook(self.excel_path)
-            ws = wb.active
-
             accounts = []
-            processed_count = 0
             total_quota_collected = 0
             max_account_quota = 0
-            changes_made = False
 
-            skipped_status = []
-            skipped_low_quota = []
-            cached_quota_accounts = []
             refreshed_quota_accounts = []
-            available_accounts_info = []
 
             min_useful_quota = 100
-            log.info(f"📊 Scanning Excel file for accounts (required_quota={required_quota}, min_useful={min_useful_quota})")
-
-            for row in range(2, ws.max_row + 1):
-                api_key = ws[f'A{row}'].value
-                email = ws[f'B{row}'].value
-                status = ws[f'F{row}'].value or 'active'
-                unusual_activity = ws[f'I{row}'].value or 'no'
-
-                if not api_key:
-                    continue
-
-                processed_count += 1
-
-                if (status and status.lower() == 'disabled') or unusual_activity == 'yes':
-                    skipped_status.append(f"{email} (status={status}, unusual={unusual_activity})")
-                    continue
-
-                last_checked = ws[f'E{row}'].value
-                quota = ws[f'D{row}'].value
+            log.info(f"📊 Querying accounts store (required_quota={required_quota}, min_useful={min_useful_quota})")
 
-                if quota is not None and quota != '' and quota < min_useful_quota:
-                    skipped_low_quota.append(f"{email} ({quota})")
-                    continue
-
-                if quota and quota >= min_useful_quota:# and not self._is_quota_check_needed(last_checked):
-                    cached_quota_accounts.append(f"{email} ({quota})")
-                else:
-                    should_check_quota = force_refresh or quota is None or quota == 0 or quota == ''
-                    if should_check_quota:
-                        if self.mobile_proxy:
-                            proxy_info = self.mobile_proxy.get_proxy_connection_info()
-                            if proxy_info:
-                                proxy_dict = {
-                                    "http": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
-                                    "https": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}"
-                                }
-                            else:
-                                log.error("❌ No proxy connection info for quota check")
-                                continue
-                        else:
-                            log.error("❌ No mobile proxy available for quota check")
-                            continue
-
-                        quota = self.check_quota(api_key, proxy_dict, force=True)
-
-                        ws[f'D{row}'] = quota
-                        ws[f'E{row}'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        changes_made = True
-                        wb.save(self.excel_path)
-                        refreshed_quota_accounts.append(f"{email} ({quota})")
-                        time.sleep(2)
-
-                if quota and quota >= min_useful_quota:
-                    accounts.append({
-                        'api_key': api_key,
-                        'email': email,
-                        'quota_remaining': quota,
-                        'row': row
-                    })
-                    total_quota_collected += quota
-                    max_account_quota = max(max_account_quota, quota)
-                    available_accounts_info.append(f"{email} ({quota})")
-                else:
-                    skipped_low_quota.append(f"{email} ({quota})")
-
-            if changes_made:
-                wb.save(self.excel_path)
-
-            wb.close()
-
-            # Wait a moment to group logs after burst
-            time.sleep(1)
+            # Akkaunty s pustoy/nulevoy kvotoy — snachala proveryaem cherez API
+            for account in self.accounts.select_usable(unknown_quota=True):
+                if not self.mobile_proxy:
+                    log.error("❌ No mobile proxy available for quota check")
+                    break
+                proxy_info = self.mobile_proxy.get_proxy_connection_info()
+                if not proxy_info:
+                    log.error("❌ No proxy connection info for quota check")
+                    break
+                proxy_dict = {
+                    "http": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}",
+                    "https": f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['host']}:{proxy_info['port']}"
+                }
+                quota = self.check_quota(account['api_key'], proxy_dict, force=True)
+                self.accounts.set_quota(account['api_key'], quota)
+                refreshed_quota_accounts.append(f"{account['email']} ({quota})")
+                time.sleep(2)
 
-            # if skipped_status:
-            #     log.debug(f"⏭️ Skipped accounts (status/unusual): {', '.join(skipped_status)}")
-            # if skipped_low_quota:
-            #     log.debug(f"⏭️ Skipped accounts with low quota: {', '.join(skipped_low_quota)}")
-            # if cached_quota_accounts:
-            #     log.debug(f"✅ Using cached quota for: {', '.join(cached_quota_accounts)}")
             if refreshed_quota_accounts:
                 log.info(f"💾 Updated quota for: {', '.join(refreshed_quota_accounts)}")
-            # if available_accounts_info:
-                # log.info(f"✅ Accounts with available quota: {', '.join(available_accounts_info)}")
-
-            accounts.sort(key=lambda x: x['row'])
 
-            log.info(f"📊 Search complete: processed {processed_count} rows, found {len(accounts)} accounts")
+            # Odin indeksirovannyy zapros vmesto prokhoda po vsem strokam
+            for account in self.accounts.select_usable(min_quota=min_useful_quota):
+                quota = account['quota_remaining']
+                accounts.append({
+                    'api_key': account['api_key'],
+                    'email': account['email'],
+                    'quota_remaining': quota,
+                    'row': account['row']
+                })
+                total_quota_collected += quota
+                max_account_quota = max(max_account_quota, quota)
+
+            log.info(f"📊 Search complete: found {len(accounts)} accounts")
             log.info(f"📊 Total quota: {total_quota_collected}, max single: {max_account_quota}")
 
             return accounts
@@ -1517,49 +1613,33 @@ class ElevenLabsQueue:
     def _get_already_checked_accounts_for_reassignment(self, failed_account_email: str, required_quota: int):
         """Poluchaet uzhe proverennye akkaunty dlya perenaznacheniya (bez dopolnitelnykh API zaprosov)"""
         try:
-            with self.lock:
-                wb = self._load_workbook_safe()
-                ws = wb.active
-
             accounts = []
-            failed_api_key = None
-            
-            # Nakhodim API klyuch problemnogo akkaunta
-            for row in range(2, ws.max_row + 1):
-                email = ws[f'B{row}'].value
-                if email == failed_account_email:
-                    failed_api_key = ws[f'A{row}'].value
-                    break
-            
+            failed_api_key = self._get_api_key_by_email(failed_account_email)
+
             # Sobiraem podkhodyashchie akkaunty
-            for row in range(2, ws.max_row + 1):
-                api_key = ws[f'A{row}'].value
-                email = ws[f'B{row}'].value
-                status = ws[f'F{row}'].value or 'active'
-                unusual_activity = ws[f'I{row}'].value or 'no'
-                quota = ws[f'D{row}'].value
-                last_checked = ws[f'E{row}'].value
-
-                if not api_key or api_key == failed_api_key:
+            for account in self.accounts.accounts():
+                api_key = account['api_key']
+                email = account['email']
+                quota = account['quota_remaining']
+
+                if api_key == failed_api_key:
                     continue
                     
-                if (status and status.lower() == 'disabled') or unusual_activity == 'yes':
-                    log.debug(f"⏭️ Skipping {email}: status={status}, unusual={unusual_activity}")
+                if not is_usable(account):
+                    log.debug(f"⏭️ Skipping {email}: status={account['status']}, unusual={account['unusual_activity']}")
                     continue
                 
                 # Proveryaem chto kvota svezhaya i dostatochnaya
-                if quota and quota > 0: #and not self._is_quota_check_needed(last_checked):  # SPRAVLENE: ispolzuem self
-                    if quota >= required_quota:
-                        log.info(f"✅ Found cached account with sufficient quota: {email} ({quota} >= {required_quota})")
-                        accounts.append({
-                            'api_key': api_key,
-                            'email': email,
-                            'quota_remaining': quota,
-                            'row': row
-                        })
-                        break  # Nashli odin podkhodyashchiy - dostatochno
+                if quota and quota > 0 and quota >= required_quota:
+                    log.info(f"✅ Found cached account with sufficient quota: {email} ({quota} >= {required_quota})")
+                    accounts.append({
+                        'api_key': api_key,
+                        'email': email,
+                        'quota_remaining': quota,
+                        'row': account['row']
+                    })
+                    break  # Nashli odin podkhodyashchiy - dostatochno
             
-            wb.close()
             return accounts
             
         except Exception as e:
@@ -1568,23 +1648,8 @@ class ElevenLabsQueue:
 
     def _get_api_key_by_email(self, email: str):
         """Poluchaet API klyuch po email"""
-        try:
-            with self.lock:
-                wb = self._load_workbook_safe()
-                ws = wb.active
-
-                for row in range(2, ws.max_row + 1):
-                    if ws[f'B{row}'].value == email:
-                        api_key = ws[f'A{row}'].value
-                        wb.close()
-                        return api_key
-
-                wb.close()
-            return None
-
-        except Exception as e:
-            log.error(f"❌ Error getting API key by email: {e}")
-            return None
+        account = self.accounts.get_by_email(email)
+        return account['api_key'] if account else None
 
     def _reassign_failed_requests(self, failed_requests: list, failed_account_email: str):
         """Perenaznachaet zaprosy s problemnogo akkaunta. BEZ zapuska otdelnogo potoka —
@@ -1699,47 +1764,36 @@ class ElevenLabsQueue:
     def _get_all_available_accounts_for_reassignment(self, required_quota: int = 0):
         """Poluchaet dostupnye akkaunty dlya perenaznacheniya s poiskom podkhodyashchego akkaunta"""
         try:
-            with self.lock:
-                wb = self._load_workbook_safe()
-                ws = wb.active
-
             accounts = []
             total_quota_collected = 0
             processed_count = 0
-            changes_made = False
             
-            log.info(f"📊 Scanning Excel rows for reassignment (need {required_quota} chars)")
+            log.info(f"📊 Scanning accounts for reassignment (need {required_quota} chars)")
             
-            for row in range(2, ws.max_row + 1):
-                api_key = ws[f'A{row}'].value
-                email = ws[f'B{row}'].value
-                status = ws[f'F{row}'].value or 'active'
-                unusual_activity = ws[f'I{row}'].value or 'no'
+            for account in self.accounts.accounts():
+                api_key = account['api_key']
+                email = account['email']
+                status = account['status'] or 'active'
+                unusual_activity = account['unusual_activity'] or 'no'
 
-                if not api_key:
-                    continue
-                    
                 processed_count += 1
-                log.debug(f"📋 Row {row}: {email}, status={status}, unusual={unusual_activity}")
+                log.debug(f"📋 Row {account['row']}: {email}, status={status}, unusual={unusual_activity}")
 
-                if (status and status.lower() == 'disabled') or unusual_activity == 'yes':
+                if not is_usable(account):
                     log.debug(f"⏭️ Skipping {email}: status={status}, unusual={unusual_activity}")
                     continue
                 
-                last_checked = ws[f'E{row}'].value
-                quota = ws[f'D{row}'].value
+                quota = account['quota_remaining']
 
-                # Obnovlyaem kvotu esli ona pustaya, ravna 0, ravna None ili ustarela
+                # Obnovlyaem kvotu esli ona pustaya, ravna 0 ili None
                 should_check_quota = (
                     quota is None or 
                     quota == 0 or 
                     quota == ''
-                    # self._is_quota_check_needed(last_checked)  # SPRAVLENE: ispolzuem self
                 )
                 
                 if should_check_quota:
-                    reason = 'empty' if quota is None or quota == 0 or quota == '' else 'outdated'
-                    log.info(f"📊 Checking quota for reassignment account: {email} (reason: {reason})")
+                    log.info(f"📊 Checking quota for reassignment account: {email} (reason: empty)")
 
                     if self.mobile_proxy:
                         proxy_info = self.mobile_proxy.get_proxy_connection_info()
@@ -1757,14 +1811,8 @@ class ElevenLabsQueue:
 
                     quota = self.check_quota(api_key, proxy_dict, force=True)
 
-                    
                     # SOKhRANYaEM KVOTU SRAZU
-                    ws[f'D{row}'] = quota
-                    ws[f'E{row}'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    changes_made = True
-                    
-                    # SOKhRANYaEM FAYL POSLE KAZhDOGO OBNOVLENYa
-                    wb.save(self.excel_path)
+                    self.accounts.set_quota(api_key, quota)
                     log.info(f"💾 Saved reassignment quota for {email}: {quota}")
                     
                     time.sleep(2)  # Pauza mezhdu zaprosami
@@ -1775,7 +1823,7 @@ class ElevenLabsQueue:
                         'api_key': api_key,
                         'email': email,
                         'quota_remaining': quota,
-                        'row': row
+                        'row': account['row']
                     })
                     total_quota_collected += quota
                     log.info(f"✅ Reassignment account {email}: {quota} characters available")
@@ -1791,16 +1839,10 @@ class ElevenLabsQueue:
                 else:
                     log.warning(f"⚠️ Reassignment account {email}: no quota available (quota={quota})")
             
-            # Finalnoe sokhranenie esli byli izmeneniya
-            if changes_made:
-                wb.save(self.excel_path)
-                
-            wb.close()
-            
             # Sortiruem po ubyvaniyu kvoty
             accounts.sort(key=lambda x: x['quota_remaining'], reverse=True)
             
-            log.info(f"📊 For reassignment: processed {processed_count} rows, found {len(accounts)} accounts with total quota: {total_quota_collected}")
+            log.info(f"📊 For reassignment: processed {processed_count} accounts, found {len(accounts)} accounts with total quota: {total_quota_collected}")
             
             return accounts
             
@@ -1849,24 +1891,18 @@ class ElevenLabsQueue:
                 # Ensure voices cleaned once before first request for this account
                 self._ensure_initial_voice_cleanup(account, proxy_dict)
 
-                session = requests.Session()
-                session.trust_env = False
-                session.proxies = proxy_dict
-
+                stream_channel = request.get('stream')
                 url = f"https://api.elevenlabs.io/v1/text-to-speech/{request['voice_id']}"
+                if stream_channel is not None:
+                    url += "/stream"
+                session = session_pool.session(url, proxy_dict)
                 headers = {
                     'Accept': 'audio/mpeg',
                     'Content-Type': 'application/json',
                     'xi-api-key': api_key,
                 }
 
-                model_id = request['config'].get('model_id', self.config.get('model_id'))
-                allowed = MODEL_VOICE_PARAMS.get(model_id, VOICE_DEFAULTS.keys())
-                voice_settings = {
-                    p: request['config'].get(p, VOICE_DEFAULTS.get(p))
-                    for p in allowed
-                    if request['config'].get(p, VOICE_DEFAULTS.get(p)) is not None
-                }
+                model_id, voice_settings = self._voice_payload(request['config'])
                 payload = {
                     'text': request['text'],
                     'model_id': model_id,
@@ -1891,22 +1927,13 @@ class ElevenLabsQueue:
                 try:
                     start = time.time()
                     response = session.post(
-                        url, json=payload, headers=headers,
+                        url, json=payload, headers=headers, stream=stream_channel is not None,
                     )
                     duration = time.time() - start
                 except (ReadTimeout, ConnectionError, socket.error) as e:
-                    try:
-                        session.close()
-                    except Exception:
-                        pass
                     log.warning(f"⏳ Request attempt {attempt} failed: {e}")
                     time.sleep(5)
                     continue
-                finally:
-                    try:
-                        session.close()
-                    except Exception:
-                        pass
 
                 log.info("📥 ElevenLabs Response: %d (took %.2fs)", response.status_code, duration)
                 try:
@@ -1914,8 +1941,18 @@ class ElevenLabsQueue:
                 except Exception:
                     pass
 
+                if stream_channel is not None:
+                    try:
+                        if response.status_code == 200:
+                            return self._relay_stream(response, stream_channel, request.get('cache_key'))
+                        response.content  # chitaem telo oshibki, chtoby soedinenie vernulos v pul
+                    finally:
+                        response.close()
+
                 if response.status_code == 200:
                     log.info("📥 Response Size: %d bytes", len(response.content))
+                    if self.cache and request.get('cache_key'):
+                        self.cache.put(request['cache_key'], response.content)
                     return {'success': True, 'content': response.content, 'content_type': 'audio/mpeg'}
 
                 try:
@@ -1977,84 +2014,61 @@ class ElevenLabsQueue:
             except Exception:
                 pass
 
-    def _process_accounts_concurrently(self):
-        """Parallelno obrabatyvaet akkaunty, ogranichivaya chislo odnovremenno rabotayushchikh akkauntov."""
-        suspicious_requests = []
-        while self.account_assignments and not self.stop_event.is_set() and not self.quota_refresh_needed:
-            assignments_items = list(self.account_assignments.items())
-
-            for i in range(0, len(assignments_items), self.max_parallel_accounts):
-                if self.stop_event.is_set() or self.quota_refresh_needed:
-                    break
+    def _relay_stream(self, response, channel: StreamChannel, cache_key: str = None) -> dict:
+        """Peresylaet chanki otveta ElevenLabs v kanal po mere polucheniya.
 
-                batch = assignments_items[i : i + self.max_parallel_accounts]
-                threads = []
-
-                for account_id, assignment in batch:
-                    if self.stop_event.is_set() or self.quota_refresh_needed:
+        S ``cache_key`` parallelno pishet audio v kesh; esli klient otklyuchilsya,
+        dochityvaet otvet v kesh — kvota vse ravno uzhe spisana.
+        """
+        total = 0
+        writer = None
+        if self.cache and cache_key:
+            try:
+                writer = self.cache.writer(cache_key)
+            except OSError as e:
+                log.warning(f"⚠️ TTS cache write failed: {e}")
+        client_gone = False
+        try:
+            for chunk in response.iter_content(chunk_size=16384):
+                if not chunk:
+                    continue
+                if writer is not None:
+                    try:
+                        writer.write(chunk)
+                    except OSError as e:
+                        log.warning(f"⚠️ TTS cache write failed: {e}")
+                        writer.abort()
+                        writer = None
+                if client_gone:
+                    if writer is None:
                         break
-                    if account_id not in self.account_assignments:
-                        continue
-
-                    account = assignment["account"]
-                    requests = assignment["requests"]
-                    if not requests:
-                        log.info(
-                            f"🎤 Skipping account {account['email']}: no requests to process"
-                        )
-                        self.account_assignments.pop(account_id, None)
-                        continue
-
-                    log.info(
-                        f"🎤 Processing account {account['email']}: {len(requests)} requests"
-                    )
-
-                    suspicious_holder = []
-
-                    def worker(acc=account, reqs=requests, holder=suspicious_holder):
-                        if self.stop_event.is_set() or self.quota_refresh_needed:
-                            return
-                        self._process_remaining_requests_fast(acc, reqs)
-                        for r in reqs:
-                            if r.get("status") == "suspicious":
-                                holder.append(r)
-
-                    thread = threading.Thread(target=worker, daemon=True)
-                    threads.append((thread, suspicious_holder, account_id))
-                    thread.start()
-
-                for thread, holder, acc_id in threads:
-                    thread.join()
-                    suspicious_requests.extend(holder)
-                    self.account_assignments.pop(acc_id, None)
-
-        if self.quota_refresh_needed:
-            remaining = []
-            for assignment in self.account_assignments.values():
-                for req in assignment["requests"]:
-                    if req.get("status") != "completed":
-                        req["status"] = "pending"
-                        remaining.append(req)
-            self.account_assignments.clear()
-            # Obnovlyaem kvoty tolko u nuzhnykh akkauntov
-            self.refresh_all_quotas(
-                accounts=list(self.quota_refresh_accounts)
-            )
-            self.quota_refresh_accounts.clear()
-            self.quota_refresh_needed = False
-            for req in remaining:
-                self.queue.put(req)
-            log.info(f"🔄 Requeued {len(remaining)} requests after quota refresh")
-
-        return suspicious_requests
+                    continue
+                if not channel.put(chunk):
+                    # Klient otklyuchilsya; ElevenLabs vse ravno spisyvaet kvotu — schitaem uspekhom
+                    log.warning("⚠️ Stream client disconnected after %d bytes", total)
+                    if writer is None:
+                        break
+                    client_gone = True  # dochityvaem v kesh
+                    continue
+                total += len(chunk)
+        except (ChunkedEncodingError, ReadTimeout, ConnectionError, socket.error) as e:
+            if writer is not None:
+                writer.abort()
+            log.error(f"❌ ElevenLabs stream interrupted after {total} bytes: {e}")
+            return {'success': False, 'error': f'stream_interrupted: {e}'}
+        if writer is not None:
+            writer.commit()
+        log.info("📥 Streamed %d bytes", total)
+        return {'success': True, 'streamed': True, 'content_type': 'audio/mpeg', 'bytes': total}
 
     def _process_accounts_concurrently(self):
+        """Parallelno obrabatyvaet vse naznacheniya cherez obshchiy pul vorkerov.
+
+        Ne bolshe max_concurrent_per_account zaprosov na akkaunt odnovremenno — eto obespechivaet pul.
+        """
         suspicious_requests = []
         lock = threading.Lock()
 
-        # Если есть глобальный семафор (например, для лимита batch_size) — используем его.
-        global_sem = getattr(self, "_global_semaphore", None)
-
         while self.account_assignments and not self.stop_event.is_set() and not self.quota_refresh_needed:
             # Sobiraem vse pary (account, request)
             work_items = []
@@ -2067,28 +2081,23 @@ class ElevenLabsQueue:
             if not work_items:
                 self.account_assignments.clear()
                 break
-
-            threads = []
+            # Snachala vyrabatyvaem akkaunt, privyazannyy k IP (sortirovka ustoychivaya)
+            bound_key = rotation_stats.bound_key
+            work_items.sort(key=lambda item: item[0] != bound_key)
 
             def worker(acc, req):
                 if self.stop_event.is_set() or self.quota_refresh_needed:
                     return
                 self._process_single_request_with_quota_update(acc, req)
-                if req.get("status") == "suspicious":
-                    with lock:
+                with lock:
+                    if req.get("status") == "suspicious":
                         suspicious_requests.append(req)
+                    elif req.get("status") == "completed":
+                        self._last_served_key = acc["api_key"]
 
-            # Zapuskaem po potoku na kazhdyy zapros
-            for _acc_id, acc, req in work_items:
-                t = threading.Thread(target=worker, args=(acc, req), daemon=True)
-                threads.append((_acc_id, t))
-                t.start()
-
-            for _acc_id, t in threads:
-                try:
-                    t.join()
-                except Exception as exc:  # на всякий случай, чтобы не прерывать весь цикл
-                    log.error(f"⚠️ Не удалось дождаться потока для аккаунта {_acc_id}: {exc}")
+            # Stavim vse zaprosy v pul; sloty akkaunta ogranichivayut parallelizm
+            futures = [self._pool.submit(worker, acc, req, key=acc_id) for acc_id, acc, req in work_items]
+            wait_futures(futures)
 
             for acc_id in list(self.account_assignments.keys()):
                 assignment = self.account_assignments.get(acc_id)
@@ -2127,58 +2136,19 @@ class ElevenLabsQueue:
 
     def _process_remaining_requests_fast(self, account: dict, remaining_requests: list):
         """Bystro obrabatyvaet ostalnye zaprosy s ogranicheniem parallelizma"""
-        max_concurrent = self.max_concurrent_per_account
         log.info(
-            f"🚀 Starting LIMITED PARALLEL processing of {len(remaining_requests)} requests (max_concurrent={max_concurrent}) for {account['email']}"
+            f"🚀 Starting LIMITED PARALLEL processing of {len(remaining_requests)} requests "
+            f"(max_concurrent={self._max_concurrent_per_account}) for {account['email']}"
         )
 
-        # Razbivaem na batchi
-        import threading
-
-        semaphore = threading.Semaphore(max_concurrent)
-        global_sem = getattr(self, "_global_semaphore", None)  # может быть None
-
         def worker(req):
             if self.stop_event.is_set() or self.quota_refresh_needed:
                 return
-            # Небольшой джиттер, чтобы не выстрелить пачкой в одну миллисекунду
-            time.sleep(random.uniform(0.5, 1.5))
-            if self.stop_event.is_set() or self.quota_refresh_needed:
-                return
+            self._process_single_request_with_quota_update(account, req)
 
-            with semaphore:
-                if self.stop_event.is_set() or self.quota_refresh_needed:
-                    return
-                # Если задан глобальный семафор — учитываем и его
-                if global_sem is not None:
-                    with global_sem:
-                        if self.stop_event.is_set() or self.quota_refresh_needed:
-                            return
-                        try:
-                            self._process_single_request_with_quota_update(account, req)
-                        except Exception as e:
-                            log.error(f"❌ Thread error for req {req.get('id')}: {e}", exc_info=True)
-                else:
-                    try:
-                        self._process_single_request_with_quota_update(account, req)
-                    except Exception as e:
-                        log.error(f"❌ Thread error for req {req['id']}: {e}", exc_info=True)
-        
-        # Sozdaem potoki s ogranicheniem
-        threads = []
-        for req in remaining_requests:
-            if self.stop_event.is_set():
-                break
-            if self.quota_refresh_needed:
-                break
-            thread = threading.Thread(target=process_with_semaphore, args=(req,), daemon=True)
-            threads.append(thread)
-            thread.start()
-            time.sleep(0.5)  # Zaderzhka mezhdu zapuskami potokov
-
-        # Zhdem zaversheniya
-        for thread in threads:
-            thread.join()
+        # Parallelizm na akkaunt ogranichivaet pul — bez otdelnykh potokov i pauz mezhdu zapuskami
+        futures = [self._pool.submit(worker, req, key=account['api_key']) for req in remaining_requests]
+        wait_futures(futures)
 
     def _process_single_request_with_quota_update(self, account: dict, req: dict):
         """Obrabatyvaet odin zapros s obnovleniem kvoty (dlya parallelnogo vypolneniya)"""
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""SQLite storage for live ElevenLabs account state.
+
+``api_elevenlabs.xlsx`` stays the human-editable import/export format; quota,
+status, usage and unusual-activity flags live in ``api_elevenlabs.db``.
+Quota decrements are single ``UPDATE ... SET quota_remaining = quota_remaining - ?``
+statements, and account selection runs as indexed queries instead of sheet scans.
+"""
+import json
+import sqlite3
+import threading
+from typing import Iterable, List, Optional
+
+# Polya zapisi akkaunta (poryadok kak v Excel)
+ACCOUNT_FIELDS = (
+    "api_key", "email", "password", "quota_remaining", "last_checked", "status",
+    "usage_count", "total_used", "unusual_activity", "unusual_activity_time",
+    "notes", "retry_count",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    api_key               TEXT PRIMARY KEY,
+    email                 TEXT,
+    password              TEXT,
+    quota_remaining       INTEGER,
+    last_checked          TEXT,
+    status                TEXT NOT NULL DEFAULT 'active',
+    usage_count           INTEGER NOT NULL DEFAULT 0,
+    total_used            INTEGER,
+    unusual_activity      TEXT NOT NULL DEFAULT 'no',
+    unusual_activity_time TEXT,
+    notes                 TEXT,
+    retry_count           INTEGER,
+    row                   INTEGER NOT NULL,
+    extra                 TEXT
+);
+-- api_key indeksiruetsya PRIMARY KEY
+CREATE INDEX IF NOT EXISTS idx_accounts_email  ON accounts(email);
+CREATE INDEX IF NOT EXISTS idx_accounts_status ON accounts(status, unusual_activity);
+CREATE INDEX IF NOT EXISTS idx_accounts_quota  ON accounts(quota_remaining);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Usloviya "akkaunt mozhno ispolzovat" (sm. elevenlabs_accounts.is_usable)
+_USABLE = "status != 'disabled'"
+_NOT_UNUSUAL = "unusual_activity != 'yes'"
+
+
+def _normalize(record: dict) -> dict:
+    """Bring a record to the stored form (lower-case flags, JSON extras)."""
+    row = {field: record.get(field) for field in ACCOUNT_FIELDS}
+    row['status'] = str(row.get('status') or 'active').strip().lower()
+    row['unusual_activity'] = str(row.get('unusual_activity') or 'no').strip().lower()
+    row['usage_count'] = row.get('usage_count') or 0
+    row['row'] = record.get('row') or 0
+    row['extra'] = json.dumps(record.get('extra') or {}, ensure_ascii=False, default=str)
+    return row
+
+
+def _to_record(row: sqlite3.Row) -> dict:
+    record = dict(row)
+    record['extra'] = json.loads(record['extra'] or '{}')
+    return record
+
+
+class AccountStore:
+    """Thin thread-safe wrapper around the accounts database."""
+
+    def __init__(self, db_path: str):
+        self.db_path = str(db_path)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+
+    # ------------------------------------------------------------------
+    # Meta
+    # ------------------------------------------------------------------
+    def get_meta(self, key: str, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row['value']) if row else default
+
+    def _set_meta(self, key: str, value) -> None:
+        self.conn.execute(
+            "INSERT INTO meta(key, value) VALUES(?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value, ensure_ascii=False)),
+        )
+
+    @property
+    def journal_seq(self) -> int:
+        return int(self.get_meta("journal_seq", 0))
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+    def replace_all(self, records: Iterable[dict], meta: dict = None) -> int:
+        """Replace the whole account set (xlsx import)."""
+        rows = [_normalize(r) for r in records]
+        columns = list(ACCOUNT_FIELDS) + ['row', 'extra']
+        sql = (f"INSERT INTO accounts({', '.join(columns)}) "
+               f"VALUES({', '.join(':' + c for c in columns)})")
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM accounts")
+            self.conn.executemany(sql, rows)
+            for key, value in (meta or {}).items():
+                self._set_meta(key, value)
+        return len(rows)
+
+    def apply(self, entries: List[dict], seq: int) -> None:
+        """Apply journal entries and record ``seq`` in a single transaction."""
+        with self.lock, self.conn:
+            for entry in entries:
+                if entry["op"] == "consume":
+                    self.conn.execute(
+                        "UPDATE accounts SET "
+                        "quota_remaining = MAX(0, COALESCE(quota_remaining, 0) - ?), "
+                        "usage_count = usage_count + ?, "
+                        "last_checked = COALESCE(?, last_checked) "
+                        "WHERE api_key = ?",
+                        (entry["chars"], entry["chars"], entry.get("touched_at"), entry["api_key"]),
+                    )
+                elif entry["op"] == "update":
+                    fields = {k: v for k, v in entry["fields"].items() if k in ACCOUNT_FIELDS}
+                    if not fields:
+                        continue
+                    for flag in ('status', 'unusual_activity'):
+                        if flag in fields:
+                            fields[flag] = _normalize({flag: fields[flag]})[flag]
+                    assignments = ", ".join(f"{k} = :{k}" for k in fields)
+                    self.conn.execute(
+                        f"UPDATE accounts SET {assignments} WHERE api_key = :_api_key",
+                        {**fields, "_api_key": entry["api_key"]},
+                    )
+            self._set_meta("journal_seq", seq)
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+    def all(self) -> List[dict]:
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM accounts ORDER BY row").fetchall()
+        return [_to_record(r) for r in rows]
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+
+    def usable(self, min_quota: int = None, avoid_unusual: bool = True,
+               unknown_quota: bool = False, order_by: str = "row") -> List[dict]:
+        """Usable accounts with ``quota_remaining >= min_quota``.
+
+        ``unknown_quota=True`` selects accounts whose quota was never checked
+        (NULL or 0) instead.
+        """
+        where = [_USABLE]
+        params = []
+        if avoid_unusual:
+            where.append(_NOT_UNUSUAL)
+        if unknown_quota:
+            where.append("(quota_remaining IS NULL OR quota_remaining = 0)")
+        elif min_quota is not None:
+            where.append("quota_remaining >= ?")
+            params.append(min_quota)
+        order = "quota_remaining DESC, row" if order_by == "quota" else "row"
+        sql = f"SELECT * FROM accounts WHERE {' AND '.join(where)} ORDER BY {order}"
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [_to_record(r) for r in rows]
+
+    def best(self, required_chars: int, min_quota: int = 0,
+             avoid_unusual: bool = True) -> Optional[dict]:
+        """First account (by row) that fits ``required_chars``, else the largest quota."""
+        where = [_USABLE, "quota_remaining >= :min_quota"]
+        if avoid_unusual:
+            where.append(_NOT_UNUSUAL)
+        sql = (f"SELECT * FROM accounts WHERE {' AND '.join(where)} "
+               "ORDER BY quota_remaining < :required, "
+               "CASE WHEN quota_remaining >= :required THEN row ELSE -quota_remaining END "
+               "LIMIT 1")
+        with self.lock:
+            row = self.conn.execute(
+                sql, {"min_quota": max(min_quota, 1), "required": required_chars}
+            ).fetchone()
+        return _to_record(row) if row else None
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""asyncio upstream engine for the OpenAI path.
+
+:class:`AsyncOpenAIEngine` runs its own event loop in one daemon thread and
+executes OpenAI requests there with ``aiohttp``.  A request that waits for a
+limiter slot, for the upstream (Responses calls can take minutes) or for a
+retry backoff is a suspended coroutine, not a blocked OS thread.  Flask
+handlers hand requests over with :meth:`AsyncOpenAIEngine.submit` and get a
+``concurrent.futures.Future`` back.
+
+Admission (:meth:`OpenAIRateLimiter.acquire_slot_async`), retries
+(:class:`RetryState`) and the result format are the same as in
+:func:`execute_openai_request_parallel`.
+
+The engine is optional: it needs ``aiohttp`` and ``OPENAI_ASYNC_ENGINE=1``
+(see :func:`create_openai_engine`).
+"""
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+
+import globals as g
+from config.settings import OPENAI_ASYNC_ENGINE, OPENAI_ASYNC_MAX_CONNECTIONS, get_openai_config
+from proxy.session_pool import session_pool
+from services.openai_retry import RetryState, classify_exception, classify_status, retry_after_seconds
+from services.request_handlers import (openai_proxy_url, openai_queue_rejection, openai_upstream_error,
+                                       prepare_openai_request, record_openai_usage)
+from utils.logger import log, maybe_truncate
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp is optional
+    aiohttp = None
+
+DEFAULT_URL = "https://api.openai.com/v1/chat/completions"
+
+
+def classify_async_exception(exc: BaseException) -> str:
+    if isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    if aiohttp is not None and isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return "connection"
+    return classify_exception(exc)
+
+
+class AsyncOpenAIEngine:
+    """Executes OpenAI requests on a dedicated asyncio event loop thread."""
+
+    def __init__(self, max_connections: int = 200, request_timeout: float = None):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is not installed")
+        self.max_connections = max_connections
+        # None — bez obshchego taymauta, kak i v sinkhronnom puti
+        self.request_timeout = request_timeout
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        # Sessii zhivut tolko v potoke tsikla
+        self._session = None
+        self._generation = None
+        self._inflight = {}
+        self._retired = set()
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.active = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        with self._lock:
+            if self.running:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            self._loop = loop
+            self._thread = threading.Thread(target=run, name="openai-async", daemon=True)
+            self._thread.start()
+            ready.wait()
+        log.info(f"⚡ OpenAI async engine started (max {self.max_connections} connections)")
+
+    def stop(self, timeout: float = 10.0) -> None:
+        if not self.running:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_all(), self._loop).result(timeout)
+        except Exception as e:
+            log.warning(f"⚠️ OpenAI async engine shutdown: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+
+    def submit(self, request_data: dict, config: dict = None, use_limiter: bool = True,
+               max_wait: int = None) -> concurrent.futures.Future:
+        """Schedule a request; the future resolves to the usual result dict."""
+        if not self.running:
+            raise RuntimeError("OpenAI async engine is not running")
+        with self._lock:
+            self.submitted += 1
+        return asyncio.run_coroutine_threadsafe(
+            self.execute(request_data, config=config, use_limiter=use_limiter, max_wait=max_wait), self._loop)
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+    def _client(self):
+        # Posle rotatsii IP (session_pool.invalidate) otkryvaem novye soedineniya
+        generation = session_pool.invalidations
+        if self._session is None or generation != self._generation:
+            if self._session is not None:
+                self._retire(self._session)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout, sock_connect=30),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                trust_env=False,
+            )
+            self._generation = generation
+            self._inflight[self._session] = 0
+        return self._session
+
+    def _retire(self, session) -> None:
+        """Staruyu sessiyu zakryvaem, kogda na ney ne ostanetsya zaprosov."""
+        if self._inflight.get(session):
+            self._retired.add(session)
+        else:
+            self._inflight.pop(session, None)
+            self._loop.create_task(session.close())
+
+    async def _close_all(self) -> None:
+        for session in [*self._retired, *([self._session] if self._session else [])]:
+            await session.close()
+        self._retired.clear()
+        self._inflight.clear()
+        self._session = None
+
+    async def _send(self, method: str, url: str, headers: dict, body, proxy_url: str):
+        session = self._client()
+        self._inflight[session] += 1
+        try:
+            async with session.request(method, url, headers=headers, json=body, proxy=proxy_url) as resp:
+                return resp.status, resp.headers, await resp.read()
+        finally:
+            self._inflight[session] -= 1
+            if session in self._retired and not self._inflight[session]:
+                self._retired.discard(session)
+                self._retire(session)
+
+    # ------------------------------------------------------------------
+    # Requests
+    # ------------------------------------------------------------------
+    async def execute(self, request_data: dict, config: dict = None, use_limiter: bool = True,
+                      max_wait: int = None) -> dict:
+        """Coroutine counterpart of :func:`execute_openai_request_parallel`."""
+        if config is None:
+            config = get_openai_config()
+        start_time = time.time()
+        self.active += 1
+        try:
+            request_data, model, api_key, tokens, raw_prompt = prepare_openai_request(request_data, use_limiter)
+            retry = RetryState(config)
+            while True:
+                record = retry.begin()
+                result, error_class, retry_after = await self._attempt(
+                    record, retry, request_data, config, use_limiter, max_wait,
+                    model, api_key, tokens, raw_prompt)
+                if error_class is None:
+                    retry.end(record, "ok", result["status_code"])
+                    break
+                delay = retry.next_delay(error_class, retry_after)
+                retry.end(record, error_class, result["status_code"], backoff=None if delay is None else round(delay, 3))
+                if delay is None:
+                    log.warning("⛔ OpenAI %s: giving up after %d attempt(s), %.1fs", error_class,
+                                retry.attempt, time.time() - start_time)
+                    break
+                log.warning("🛑 OpenAI %s (status %d). Retry %d in %.2fs.", error_class, result["status_code"],
+                            retry.attempt, delay)
+                await asyncio.sleep(delay)
+
+            result["attempts"] = retry.summary()
+            if len(retry.attempts) > 1:
+                log.info("🔁 OpenAI attempts: %s", json.dumps(result["attempts"], ensure_ascii=False))
+            return result
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.active -= 1
+            self.completed += 1
+
+    async def _attempt(self, record: dict, retry: RetryState, request_data: dict, config: dict,
+                       use_limiter: bool, max_wait, model: str, api_key, tokens: int, raw_prompt: int):
+        """Odna popytka: (rezultat, klass oshibki ili None, Retry-After)."""
+        acquired = False
+        priority = config.get("priority")
+        try:
+            if use_limiter:
+                g.openai_limiter.update_config(config)
+                slot_start = time.time()
+                acquired = await g.openai_limiter.acquire_slot_async(model=model, tokens=tokens, timeout=max_wait,
+                                                                     priority=priority, api_key=api_key)
+                record["slot_wait"] = round(time.time() - slot_start, 3)
+                if not acquired:
+                    return openai_queue_rejection(model, tokens, priority, api_key), None, None
+
+            # Dannye proksi obychno iz kesha, no inogda eto zapros k API mobilnogo proksi
+            proxy_url = await asyncio.to_thread(openai_proxy_url)
+            if not proxy_url:
+                log.error("❌ No proxy available for OpenAI")
+                return {
+                    "content": json.dumps({"error": "Proxy unavailable"}).encode("utf-8"),
+                    "status_code": 503,
+                    "headers": {},
+                }, None, None
+
+            url = request_data.get("url") or DEFAULT_URL
+            method = request_data.get("method", "POST").upper()
+            log.info("📤 OpenAI Request (async): %s %s", method, url)
+            request_start = time.time()
+            status, headers, content = await self._send(method, url, request_data.get("headers", {}),
+                                                         request_data.get("body"), proxy_url)
+            record["upstream"] = round(time.time() - request_start, 3)
+            log.info("📥 OpenAI Response: %d (took %.2fs)", status, record["upstream"])
+
+            g.openai_limiter.update_from_headers(model, headers, api_key=api_key)
+            if status < 400 and use_limiter:
+                try:
+                    record_openai_usage(model, json.loads(content), tokens, raw_prompt, api_key)
+                except Exception:
+                    pass
+
+            result = {"content": content, "status_code": status, "headers": dict(headers)}
+            error_class = classify_status(status)
+            return result, error_class, (retry_after_seconds(headers, content)
+                                         if error_class == "rate_limited" else None)
+
+        except Exception as e:
+            error_class = classify_async_exception(e)
+            log.error("❌ OpenAI request %s: %s", error_class, maybe_truncate(str(e) or type(e).__name__, 200))
+            if retry.should_rotate_ip(error_class):
+                mobile_proxy = getattr(g.proxy_manager, "mobile_proxy", None)
+                if mobile_proxy:
+                    log.info("🔁 Rotating mobile proxy IP due to connection error …")
+                    try:
+                        await asyncio.to_thread(mobile_proxy.rotate_ip)
+                    except Exception as re:
+                        log.warning("⚠️ IP rotation failed: %s", re)
+            return openai_upstream_error(error_class, e), error_class, None
+
+        finally:
+            if acquired:
+                g.openai_limiter.release_slot()
+
+    def get_stats(self) -> dict:
+        return {
+            "running": self.running,
+            "max_connections": self.max_connections,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "errors": self.errors,
+            "active": self.active,
+        }
+
+
+def create_openai_engine():
+    """Engine per ``OPENAI_ASYNC_ENGINE`` (not started), or ``None``."""
+    if not OPENAI_ASYNC_ENGINE:
+        return None
+    if aiohttp is None:
+        log.warning("⚠️ OPENAI_ASYNC_ENGINE is set but aiohttp is not installed; using worker threads")
+        return None
+    return AsyncOpenAIEngine(max_connections=OPENAI_ASYNC_MAX_CONNECTIONS)
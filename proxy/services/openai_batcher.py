@@ -1,74 +1,207 @@
+import functools
+import json
 import threading
+import time
 from typing import List, Tuple, Dict
 
 import globals as g
+from core.rate_limiters import api_key_id
+from core.worker_pool import KeyedWorkerPool
 from utils.logger import log
-from services.request_handlers import execute_openai_request_parallel
+from services.request_handlers import execute_openai_request_parallel, prepare_openai_request
+
+# Obnovlyaem dannye mobilnogo proksi za stolko sekund do istecheniya kesha
+PROXY_REFRESH_MARGIN = 30.0
+PROXY_RETRY_INTERVAL = 30.0
 
 
 class OpenAIRequestBatcher:
-    """Collects incoming OpenAI requests and processes them in batches.
+    """Collects incoming OpenAI requests and dispatches them in micro-batches.
+
+    A batch is flushed as soon as one of these holds:
+
+    * nothing dispatched by the batcher is still running (idle — no wait);
+    * ``max_batch`` requests are waiting;
+    * the oldest waiting request has waited ``max_wait`` seconds.
 
-    Requests arriving within ``delay`` seconds are grouped into a single batch.
-    The mobile proxy stats and connection info are fetched once per batch to
-    avoid redundant API calls when many requests arrive simultaneously.
+    A background refresher keeps the mobile proxy connection info fresh, so
+    requests never wait for the proxy API.  Requests are executed on a
+    persistent bounded worker pool, or as coroutines on the asyncio engine
+    (``g.openai_engine``) when it runs.
+
+    A worker blocks while its request waits for a limiter slot, so the pool
+    is keyed like the limiter, by (API key, model); requests without a key
+    get one from the server key pool before they are submitted.  At most
+    ``per_model_workers`` workers serve one pair.  The other requests of a
+    throttled model wait in the pool without a worker, and requests for
+    other models keep running.
     """
 
-    def __init__(self, delay: float = 3.0) -> None:
-        self.delay = delay
-        self._lock = threading.Lock()
-        self._queue: List[Tuple[dict, dict, threading.Event, Dict]] = []
-        self._timer: threading.Timer | None = None
+    def __init__(self, max_wait: float = 0.05, max_batch: int = 32, max_workers: int = 64,
+                 per_model_workers: int = 8) -> None:
+        self.max_wait = max_wait
+        self.max_batch = max(1, int(max_batch))
+        self._cond = threading.Condition()
+        # (vremya postanovki, request_data, config, event, container)
+        self._queue: List[Tuple[float, dict, dict, threading.Event, Dict]] = []
+        self._in_flight = 0
+        self._batches = 0
+        self._batched = 0
+        self._started = False
+        self._pool = KeyedWorkerPool(max_workers, per_key_limit=per_model_workers, name="openai-batch")
+        self._proxy_refreshed_at = None
 
     def enqueue(self, request_data: dict, config: dict) -> dict:
         """Add a request to the queue and wait for the batch result."""
         event = threading.Event()
         container: Dict[str, dict] = {}
-        with self._lock:
-            self._queue.append((request_data, config, event, container))
-            # restart timer on every new request
-            if self._timer:
-                self._timer.cancel()
-            self._timer = threading.Timer(self.delay, self._process_batch)
-            self._timer.start()
+        with self._cond:
+            self._ensure_started()
+            self._queue.append((time.monotonic(), request_data, config, event, container))
+            self._cond.notify_all()
         event.wait()
         return container["response"]
 
-    def _process_batch(self) -> None:
-        with self._lock:
-            batch = self._queue
-            self._queue = []
-            self._timer = None
-
-        if not batch:
+    def _ensure_started(self) -> None:
+        # Vyzyvaetsya pod self._cond
+        if self._started:
             return
+        self._started = True
+        threading.Thread(target=self._dispatch_loop, name="openai-batcher", daemon=True).start()
+        threading.Thread(target=self._proxy_refresh_loop, name="openai-proxy-refresh", daemon=True).start()
 
-        # Prepare proxy information once for the whole batch
-        mp = getattr(getattr(g, "proxy_manager", None), "mobile_proxy", None)
-        if mp:
+    def _flush_due(self, now: float) -> float:
+        """0 if the queue must be flushed now, else seconds until its deadline. Called under ``_cond``."""
+        if self._in_flight == 0 or len(self._queue) >= self.max_batch:
+            return 0.0
+        return max(0.0, self._queue[0][0] + self.max_wait - now)
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if not self._queue:
+                        self._cond.wait()
+                        continue
+                    wait = self._flush_due(time.monotonic())
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+                self._in_flight += len(batch)
+                self._batches += 1
+                self._batched += len(batch)
             try:
-                stats = mp.get_stats()
-                mp.get_proxy_connection_info(stats)
-            except Exception as exc:  # pragma: no cover - best effort
-                log.error(f"❌ Failed to prepare proxy for batch: {exc}")
+                self._dispatch(batch)
+            except Exception as exc:
+                log.error(f"❌ Failed to dispatch OpenAI batch: {exc}")
+
+    def _finish(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                # Stali prostaivat — ozhidayushchie uhodyat srazu
+                self._cond.notify_all()
+
+    @staticmethod
+    def _limiter_key(request_data: dict, config: dict):
+        """(request_data, klyuch pula) — ta zhe para (klyuch API, model), chto i u limitera.
+
+        Klyuch iz servernogo pula vybiraem zdes, a ne v rabochem potoke,
+        inache vse zaprosy bez Authorization popali by v odnu gruppu.
+        """
+        request_data, model, api_key, _, _ = prepare_openai_request(
+            request_data, config.get("use_limiter", True))
+        return request_data, (api_key_id(api_key), model)
 
-        threads = []
+    @staticmethod
+    def _failure(exc: Exception) -> dict:
+        return {
+            "content": json.dumps({"error": "OpenAI request failed", "detail": str(exc)}).encode("utf-8"),
+            "status_code": 502,
+            "headers": {},
+        }
 
+    def _dispatch(self, batch) -> None:
         def worker(request_data: dict, config: dict, event: threading.Event, container: Dict) -> None:
             try:
-                resp = execute_openai_request_parallel(
+                container["response"] = execute_openai_request_parallel(
                     request_data,
                     config=config,
                     use_limiter=config.get("use_limiter", True),
                 )
-                container["response"] = resp
+            except Exception as exc:
+                log.error(f"❌ OpenAI request failed: {exc}")
+                container["response"] = self._failure(exc)
             finally:
+                self._finish()
                 event.set()
 
-        for request_data, config, event, container in batch:
-            t = threading.Thread(target=worker, args=(request_data, config, event, container), daemon=True)
-            threads.append(t)
-            t.start()
+        def done(event: threading.Event, container: Dict, future) -> None:
+            try:
+                container["response"] = future.result()
+            except Exception as exc:
+                log.error(f"❌ OpenAI async request failed: {exc}")
+                container["response"] = self._failure(exc)
+            finally:
+                self._finish()
+                event.set()
+
+        # Each caller waits on its own event, so the batch doesn't need joining
+        engine = getattr(g, "openai_engine", None)
+        for _, request_data, config, event, container in batch:
+            try:
+                if engine is not None and engine.running:
+                    # Upstream work runs as a coroutine on the engine's loop thread
+                    future = engine.submit(request_data, config, use_limiter=config.get("use_limiter", True))
+                    future.add_done_callback(functools.partial(done, event, container))
+                else:
+                    request_data, key = self._limiter_key(request_data, config)
+                    self._pool.submit(worker, request_data, config, event, container, key=key)
+            except Exception as exc:
+                # Ne otpravili (dvizhok ili pul ostanovleny) — otvechaem srazu, ostalnye idut dalshe
+                log.error(f"❌ Failed to submit OpenAI request: {exc}")
+                container["response"] = self._failure(exc)
+                self._finish()
+                event.set()
+
+    def _proxy_refresh_loop(self) -> None:
+        """Obnovlyaet dannye podklyucheniya k mobilnomu proksi do istecheniya kesha."""
+        while True:
+            mp = getattr(getattr(g, "proxy_manager", None), "mobile_proxy", None)
+            if mp is None:
+                time.sleep(PROXY_RETRY_INTERVAL)
+                continue
+            remaining = mp.cache_timestamp + mp.cache_ttl - time.time()
+            if mp.connection_info_cache and remaining > PROXY_REFRESH_MARGIN:
+                time.sleep(remaining - PROXY_REFRESH_MARGIN)
+                continue
+            try:
+                refreshed = mp.get_proxy_connection_info(force=True)
+            except Exception as exc:
+                log.error(f"❌ Failed to refresh proxy connection info: {exc}")
+                refreshed = None
+            # Kesh mog ne obnovitsya (zashchita ot chastykh zaprosov) — togda pauza
+            if refreshed and mp.cache_timestamp + mp.cache_ttl - time.time() > PROXY_REFRESH_MARGIN:
+                self._proxy_refreshed_at = time.time()
+            else:
+                time.sleep(PROXY_RETRY_INTERVAL)
 
-        for t in threads:
-            t.join()
\ No newline at end of file
+    def get_stats(self) -> dict:
+        with self._cond:
+            waiting = len(self._queue)
+            stats = {
+                "waiting_for_batch": waiting,
+                "in_flight": self._in_flight,
+                "batches": self._batches,
+                "avg_batch_size": round(self._batched / self._batches, 2) if self._batches else 0.0,
+                "max_wait": self.max_wait,
+                "max_batch": self.max_batch,
+                "proxy_refreshed_at": self._proxy_refreshed_at,
+                "pool": self._pool.get_stats(),
+            }
+        engine = getattr(g, "openai_engine", None)
+        if engine is not None:
+            stats["async_engine"] = engine.get_stats()
+        return stats
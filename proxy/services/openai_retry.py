@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Retry budget for upstream OpenAI calls.
+
+:class:`RetryState` decides whether and how long to wait before the next
+attempt.  Every failure is put into an error class with its own policy
+(:data:`RETRY_POLICIES`); delays use decorrelated jitter
+(``uniform(base, previous * 3)``, capped), and ``Retry-After`` acts as a
+floor.  Retrying stops after ``max_attempts`` attempts or when the next
+attempt would start after ``retry_deadline_seconds``.  Each attempt leaves a
+timing record in :attr:`RetryState.attempts`.
+"""
+import datetime
+import json
+import random
+import re
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from requests.exceptions import (ProxyError, ConnectionError, Timeout, SSLError,
+                                 ChunkedEncodingError)
+
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_RETRY_DEADLINE = 300.0
+DEFAULT_MAX_BACKOFF = 120.0
+
+# base/cap — granitsy pauzy; max_attempts — predel popytok dlya klassa
+RETRY_POLICIES = {
+    "rate_limited": {"base": 1.0, "cap": 120.0},
+    "server_error": {"base": 2.0, "cap": 30.0},
+    "timeout": {"base": 2.0, "cap": 20.0},
+    "connection": {"base": 1.0, "cap": 20.0, "rotate_ip": True},
+    "error": {"base": 5.0, "cap": 10.0, "max_attempts": 2},
+}
+
+_STATUS_CLASSES = {429: "rate_limited", 500: "server_error", 502: "server_error",
+                   503: "server_error", 504: "server_error"}
+
+
+def classify_status(status_code: int) -> Optional[str]:
+    """Error class of a retryable HTTP status, ``None`` for a final response."""
+    return _STATUS_CLASSES.get(status_code)
+
+
+def classify_exception(exc: BaseException) -> str:
+    if isinstance(exc, Timeout):
+        return "timeout"
+    if isinstance(exc, (ProxyError, ConnectionError, SSLError, ChunkedEncodingError, ConnectionResetError)):
+        return "connection"
+    return "error"
+
+
+def retry_after_seconds(headers, content: bytes = b"") -> float:
+    """Server-suggested delay from ``Retry-After`` (seconds or HTTP date) or the error text. Fallback 2.0s."""
+    ra = None
+    for k, v in headers.items():
+        if k.lower() == "retry-after":
+            ra = v.strip()
+            break
+    if ra:
+        if re.fullmatch(r"\d+", ra):
+            return max(1.0, float(int(ra)))
+        try:
+            dt = parsedate_to_datetime(ra)
+            date = next((v for k, v in headers.items() if k.lower() == "date"), None)
+            if date:
+                base = parsedate_to_datetime(date)
+            else:
+                base = datetime.datetime.utcnow().replace(tzinfo=dt.tzinfo)
+            delta = (dt - base).total_seconds()
+            if delta and delta > 0:
+                return float(delta)
+        except Exception:
+            pass
+
+    try:
+        body = json.loads(content or b"{}")
+        msg = body.get("error", {}).get("message", "") if isinstance(body, dict) else ""
+        if msg:
+            m = re.search(r"after\s+([\d.]+)\s*seconds", msg, re.IGNORECASE)
+            if m:
+                return max(1.0, float(m.group(1)))
+            m = re.search(r"in\s+(\d+)\s*ms", msg, re.IGNORECASE)
+            if m:
+                return max(0.5, int(m.group(1)) / 1000.0)
+            m = re.search(r"in\s+([\d.]+)\s*s\b", msg, re.IGNORECASE)
+            if m:
+                return max(1.0, float(m.group(1)))
+    except Exception:
+        pass
+
+    return 2.0
+
+
+class RetryState:
+    def __init__(self, config: dict = None, attempt: int = 0):
+        config = config or {}
+        self.max_attempts = max(1, int(config.get("max_attempts") or DEFAULT_MAX_ATTEMPTS))
+        self.max_backoff = float(config.get("max_backoff_seconds") or DEFAULT_MAX_BACKOFF)
+        self.started = time.monotonic()
+        self.deadline = self.started + float(config.get("retry_deadline_seconds") or DEFAULT_RETRY_DEADLINE)
+        # Popytki, sdelannye do nas (parametr retry_count)
+        self.offset = attempt
+        self.attempts = []
+        self._counts = {}
+        self._previous = {}
+
+    @property
+    def attempt(self) -> int:
+        return self.offset + len(self.attempts)
+
+    def begin(self) -> dict:
+        record = {"attempt": self.attempt + 1, "started_at": time.time(), "_t0": time.monotonic()}
+        self.attempts.append(record)
+        return record
+
+    @staticmethod
+    def end(record: dict, outcome: str, status_code: int = None, **extra) -> None:
+        record["duration"] = round(time.monotonic() - record.pop("_t0"), 3)
+        record["outcome"] = outcome
+        if status_code is not None:
+            record["status_code"] = status_code
+        record.update(extra)
+
+    def should_rotate_ip(self, error_class: str) -> bool:
+        return bool(RETRY_POLICIES[error_class].get("rotate_ip"))
+
+    def next_delay(self, error_class: str, retry_after: float = None) -> Optional[float]:
+        """Seconds to wait before the next attempt, or ``None`` to give up."""
+        policy = RETRY_POLICIES[error_class]
+        count = self._counts[error_class] = self._counts.get(error_class, 0) + 1
+        if self.attempt >= self.max_attempts:
+            return None
+        if policy.get("max_attempts") and count >= policy["max_attempts"]:
+            return None
+        cap = min(policy["cap"], self.max_backoff)
+        previous = self._previous.get(error_class, policy["base"])
+        delay = min(cap, random.uniform(policy["base"], previous * 3))
+        self._previous[error_class] = delay
+        if retry_after:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        if time.monotonic() + delay >= self.deadline:
+            return None
+        return delay
+
+    def summary(self) -> list:
+        return [{k: v for k, v in record.items() if not k.startswith("_")} for record in self.attempts]
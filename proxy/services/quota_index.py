@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Remaining-quota index for account selection.
+
+Keeps two views over a fixed set of accounts:
+
+* a list sorted by ``(quota, order, key)`` — best-fit (smallest quota that
+  still fits) and worst-fit (largest quota) via :mod:`bisect`;
+* a max segment tree over accounts in ``order`` (spreadsheet row) — first-fit
+  (earliest account that fits) by descending the tree.
+
+Lookups are O(log n).  :meth:`QuotaIndex.update` is O(log n) for the tree and
+the bisect search plus a memmove of the sorted list, which stays negligible
+for thousands of accounts.  Accounts are added or removed only by
+:meth:`QuotaIndex.rebuild`; quota changes never need a rebuild.
+"""
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_EMPTY = -1  # list dereva bez akkaunta ili s isklyuchennym akkauntom
+
+
+class QuotaIndex:
+    """Index of ``key -> remaining quota`` supporting first/best/worst-fit."""
+
+    def __init__(self, items: Iterable[Tuple[str, int, Optional[int]]] = ()):
+        self.rebuild(items)
+
+    def rebuild(self, items: Iterable[Tuple[str, int, Optional[int]]]) -> None:
+        """Reset the index from ``(key, order, quota)`` triples.
+
+        ``quota=None`` keeps the account known but excluded from lookups.
+        """
+        items = sorted(items, key=lambda item: item[1])
+        self._slot: Dict[str, int] = {}
+        self._order: Dict[str, int] = {}
+        self._keys: List[str] = []
+        self._quota: Dict[str, int] = {}
+        self._sorted: List[Tuple[int, int, str]] = []
+
+        size = 1
+        while size < max(len(items), 1):
+            size *= 2
+        self._size = size
+        self._tree = [_EMPTY] * (2 * size)
+
+        for slot, (key, order, quota) in enumerate(items):
+            self._slot[key] = slot
+            self._order[key] = order
+            self._keys.append(key)
+            if quota is not None:
+                self._quota[key] = quota
+                self._sorted.append((quota, order, key))
+                self._tree[size + slot] = quota
+        self._sorted.sort()
+        for pos in range(size - 1, 0, -1):
+            self._tree[pos] = max(self._tree[2 * pos], self._tree[2 * pos + 1])
+
+    def update(self, key: str, quota: Optional[int]) -> bool:
+        """Set the indexed quota of ``key`` (``None`` excludes it).
+
+        Returns ``False`` for keys the index doesn't know (caller should rebuild).
+        """
+        slot = self._slot.get(key)
+        if slot is None:
+            return False
+        order = self._order[key]
+        old = self._quota.pop(key, None)
+        if old is not None:
+            pos = bisect_left(self._sorted, (old, order, key))
+            if pos < len(self._sorted) and self._sorted[pos][2] == key:
+                del self._sorted[pos]
+        if quota is not None:
+            self._quota[key] = quota
+            insort(self._sorted, (quota, order, key))
+
+        pos = self._size + slot
+        self._tree[pos] = _EMPTY if quota is None else quota
+        pos //= 2
+        while pos:
+            self._tree[pos] = max(self._tree[2 * pos], self._tree[2 * pos + 1])
+            pos //= 2
+        return True
+
+    def quota(self, key: str) -> Optional[int]:
+        return self._quota.get(key)
+
+    @property
+    def count(self) -> int:
+        """Number of accounts currently eligible for lookups."""
+        return len(self._sorted)
+
+    def max_quota(self) -> int:
+        return self._tree[1] if self._sorted else 0
+
+    def first_fit(self, need: int) -> Optional[str]:
+        """Earliest account (by order) with ``quota >= need``."""
+        need = max(need, 0)
+        if not self._sorted or self._tree[1] < need:
+            return None
+        pos = 1
+        while pos < self._size:
+            pos = 2 * pos if self._tree[2 * pos] >= need else 2 * pos + 1
+        return self._keys[pos - self._size]
+
+    def best_fit(self, need: int) -> Optional[str]:
+        """Account with the smallest ``quota >= need`` (ties: earliest)."""
+        pos = bisect_left(self._sorted, (max(need, 0),))
+        return self._sorted[pos][2] if pos < len(self._sorted) else None
+
+    def worst_fit(self, need: int = 0) -> Optional[str]:
+        """Account with the largest quota, if it is at least ``need``."""
+        if not self._sorted or self._sorted[-1][0] < need:
+            return None
+        # Sredi odinakovykh maksimumov berem samyy ranniy
+        top = self._sorted[-1][0]
+        return self._sorted[bisect_left(self._sorted, (top,))][2]
+
+    def pick(self, need: int, strategy: str = "first_fit") -> Optional[str]:
+        if strategy == "best_fit":
+            return self.best_fit(need)
+        if strategy == "worst_fit":
+            return self.worst_fit(need)
+        return self.first_fit(need)
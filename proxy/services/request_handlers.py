@@ -2,17 +2,22 @@
 """
 Request processing handlers for different services
 """
+import math
 import time
 import json
 import random
 import re
-import requests
 from requests.exceptions import ReadTimeout, ConnectionError as RequestsConnectionError
 
 import globals as g
 from utils.logger import log, FULL_LOGS, maybe_truncate
 from config.settings import get_openai_config
-from utils.logging import color_ip
+from services.tts_chunker import join_mp3, split_text
+from services.openai_retry import RetryState, classify_exception, classify_status, retry_after_seconds
+from proxy.session_pool import session_pool
+
+# Limit ElevenLabs na odin zapros
+MAX_ELEVENLABS_CHARS = 5000
 
 def get_global_objects():
     """Poluchaet globalnye obekty iz main modulya"""
@@ -27,20 +32,91 @@ def get_global_objects():
 
 # V fayle: services/request_handlers.py
 
+def prepare_openai_request(request_data: dict, use_limiter: bool = True):
+    """Model, API key i otsenka tokenov zaprosa: (request_data, model, api_key, tokens, raw_prompt).
+
+    raw_prompt — nekalibrovannyy schet prompta; ego nado vernut v
+    record_openai_usage, chtoby kalibrovka ne zavisela ot tekushchego koeffitsienta.
+
+    Bez klyucha klienta i pri nastroennom pule klyuch beretsya iz pula
+    (vozvrashchaetsya kopiya request_data s zagolovkom Authorization).
+    """
+    body = request_data.get("body") or {}
+    model = body.get("model", "default") if isinstance(body, dict) else "default"
+    auth = (request_data.get("headers") or {}).get("Authorization", "")
+    api_key = auth[7:] if auth.startswith("Bearer ") else None
+    estimated_tokens = raw_prompt = 0
+    if use_limiter and isinstance(body, dict):
+        # prompt + max vykhod — tak zhe schitaet tmp/tpd sam OpenAI
+        estimated_tokens, raw_prompt = g.openai_limiter.estimator.estimate(model, body)
+
+    if not api_key and g.openai_limiter.key_pool:
+        # Klient bez klyucha — berem iz servernogo pula tot, chto osvoboditsya ranshe
+        api_key = g.openai_limiter.pick_pool_key(model, estimated_tokens)
+        request_data = {
+            **request_data,
+            "headers": {**(request_data.get("headers") or {}), "Authorization": f"Bearer {api_key}"},
+        }
+    return request_data, model, api_key, estimated_tokens, raw_prompt
+
+
+def openai_proxy_url():
+    """URL mobilnogo proksi dlya OpenAI ili None."""
+    proxy_obj = g.proxy_manager.get_available_proxy(for_openai_fm=True) if g.proxy_manager else None
+    if not proxy_obj:
+        return None
+    log.debug("🔌 OpenAI via proxy: %s", proxy_obj["host"])
+    return f"http://{proxy_obj['username']}:{proxy_obj['password']}@{proxy_obj['host']}:{proxy_obj['port']}"
+
+
+def openai_queue_rejection(model: str, tokens: int, priority, api_key) -> dict:
+    """Otvet 429 s pozitsiey v ocheredi, kogda slot ne poluchen za max_wait.
+
+    Ochered ne prodlevaem povtorami — klient sam pridet cherez Retry-After.
+    """
+    queue_info = g.openai_limiter.queue_status(model=model, tokens=tokens, priority=priority, api_key=api_key)
+    suggested = queue_info["estimated_wait_seconds"]
+    retry_after = max(1, math.ceil(suggested)) if suggested and suggested != float('inf') else 2
+    log.warning(" OpenAI slot unavailable; suggest retry after %ss (model=%s, queue position %s)",
+                retry_after, model, queue_info["queue_position"])
+    payload = {"error": "Rate limited", "retry_after_seconds": retry_after, "model": model, **queue_info}
+    return {
+        "content": json.dumps(payload).encode("utf-8"),
+        "status_code": 429,
+        "headers": {"Retry-After": str(retry_after)},
+    }
+
+
+def openai_upstream_error(error_class: str, exc: BaseException) -> dict:
+    status = 504 if error_class == "timeout" else 502
+    return {
+        "content": json.dumps({"error": f"OpenAI upstream {error_class}", "detail": maybe_truncate(str(exc), 200)}).encode("utf-8"),
+        "status_code": status,
+        "headers": {},
+    }
+
+
+def record_openai_usage(model: str, resp_json, estimated_tokens: int, raw_prompt: int, api_key) -> None:
+    """Peredaet limiteru fakticheskiy usage iz uspeshnogo otveta."""
+    usage = resp_json.get("usage", {}) if isinstance(resp_json, dict) else {}
+    total_tokens = (usage or {}).get("total_tokens")
+    if total_tokens is not None:
+        prompt_tokens = usage.get("input_tokens") or usage.get("prompt_tokens")
+        g.openai_limiter.record_usage(model, int(total_tokens), estimated_tokens,
+                                      prompt_tokens=prompt_tokens, raw_prompt=raw_prompt,
+                                      api_key=api_key)
+
+
 def execute_openai_request_parallel(request_data: dict, max_wait: int = None, config: dict = None, retry_count: int = 0, use_limiter: bool = True) -> dict:
     """Vypolnyaet zapros k OpenAI s ocheredyu, proksi, retrayami, rotatsiey IP
     i korrektnym ozhidaniem pri 429 — slot osvobozhdaetsya PERED sleep.
+
+    Povtory idut v tsikle po byudzhetu RetryState (max_attempts,
+    retry_deadline_seconds, max_backoff_seconds iz config); v rezultate
+    klyuch ``attempts`` — taymingi kazhdoy popytki.
     """
     import time
     import json
-    import random
-    import datetime
-    import requests
-    from requests.adapters import HTTPAdapter
-    from urllib3.util.retry import Retry
-    from requests.exceptions import ProxyError, ConnectionError, Timeout, ReadTimeout, ConnectTimeout, SSLError, ChunkedEncodingError
-    from email.utils import parsedate_to_datetime
-    import re
     import globals as g
     from utils.logger import log, FULL_LOGS, maybe_truncate
     from config.settings import get_openai_config
@@ -52,243 +128,135 @@ def execute_openai_request_parallel(request_data: dict, max_wait: int = None, co
             h["Authorization"] = (val[:14] + "...(redacted)") if len(val) > 20 else "Bearer ***"
         return h
 
-    def _parse_retry_after(resp) -> float:
-        """Vozvrashchaet rekomenduemuyu zaderzhku (sek) iz Retry-After (sek/data) ili tekstovki oshibki. Follbek — 2.0s."""
-        ra = None
-        for k, v in resp.headers.items():
-            if k.lower() == "retry-after":
-                ra = v.strip()
-                break
-        if ra:
-            if re.fullmatch(r"\d+", ra):
-                try:
-                    return max(1.0, float(int(ra)))
-                except Exception:
-                    pass
-            try:
-                dt = parsedate_to_datetime(ra)
-                if resp.headers.get("date"):
-                    base = parsedate_to_datetime(resp.headers["date"])
-                else:
-                    base = datetime.datetime.utcnow().replace(tzinfo=dt.tzinfo)
-                delta = (dt - base).total_seconds()
-                if delta and delta > 0:
-                    return float(delta)
-            except Exception:
-                pass
-
-        try:
-            body = resp.json()
-            msg = body.get("error", {}).get("message", "") if isinstance(body, dict) else ""
-            if msg:
-                m = re.search(r"after\s+([\d.]+)\s*seconds", msg, re.IGNORECASE)
-                if m:
-                    return max(1.0, float(m.group(1)))
-                m = re.search(r"in\s+(\d+)\s*ms", msg, re.IGNORECASE)
-                if m:
-                    return max(0.5, int(m.group(1)) / 1000.0)
-                m = re.search(r"in\s+([\d.]+)\s*s\b", msg, re.IGNORECASE)
-                if m:
-                    return max(1.0, float(m.group(1)))
-        except Exception:
-            pass
-
-        return 2.0
-
     if config is None:
         config = get_openai_config()
-    if max_wait is None:
-        max_wait = None
     start_time = time.time()
 
-    # opredelit model i priblizitelnoe kolichestvo tokenov
-    body = request_data.get("body") or {}
-    model = body.get("model", "default") if isinstance(body, dict) else "default"
-    estimated_tokens = 0
-    if isinstance(body, dict):
-        estimated_tokens = body.get("max_tokens") or body.get("max_output_tokens") or 0
-
-    acquired = False
-    if use_limiter:
-        # ochered/limiter
-        g.openai_limiter.update_config(config)
-        acquired = g.openai_limiter.acquire_slot(model=model, tokens=estimated_tokens, timeout=max_wait)
-        if not acquired:
-            # Smart behavior: do not extend queue timeouts recursively.
-            # Instead compute precise wait suggestion and return 429 with Retry-After.
-            suggested = g.openai_limiter.suggest_wait_seconds(model=model, tokens=estimated_tokens)
-            retry_after = max(1, int(suggested)) if suggested and suggested != float('inf') else 2
-            log.warning(" OpenAI slot unavailable; suggest retry after %ss (model=%s)", retry_after, model)
-            payload = {"error": "Rate limited", "retry_after_seconds": retry_after, "model": model}
-            return {
-                "content": json.dumps(payload).encode("utf-8"),
-                "status_code": 429,
-                "headers": {"Retry-After": str(retry_after)},
-            }
+    request_data, model, api_key, estimated_tokens, raw_prompt = prepare_openai_request(request_data, use_limiter)
 
-    session = None
-    slot_released_early = False
-    
-    try:
-        slot_wait_time = time.time() - start_time
-        log.debug("✅ OpenAI slot acquired after %.2fs", slot_wait_time)
-
-        session = requests.Session()
-        session.trust_env = False  # ignor sistemnykh proksi
-        proxy_obj = None
-        if g.proxy_manager:
-            proxy_obj = g.proxy_manager.get_available_proxy(for_openai_fm=True)
-        if not proxy_obj:
-            log.error("❌ No proxy available for OpenAI")
-            return {
-                "content": json.dumps({"error": "Proxy unavailable"}).encode("utf-8"),
-                "status_code": 503,
-                "headers": {},
-            }
+    priority = config.get("priority")
+    retry = RetryState(config, retry_count)
 
-        proxy_url = f"http://{proxy_obj['username']}:{proxy_obj['password']}@{proxy_obj['host']}:{proxy_obj['port']}"
-        session.proxies.update({"http": proxy_url, "https": proxy_url})
-        log.debug("🔌 OpenAI via proxy: %s", proxy_obj["host"])
-        retry = Retry(
-            total=2, connect=2, read=2, status=2,
-            backoff_factor=0.7,
-            status_forcelist=[429, 500, 502, 503, 504, 520, 521, 522, 523, 524],
-            allowed_methods=None,
-            raise_on_status=False,
-        )
-        adapter = HTTPAdapter(max_retries=retry, pool_connections=20, pool_maxsize=50)
-        session.mount("http://", adapter)
-        session.mount("https://", adapter)
-
-        url = request_data.get("url") or "https://api.openai.com/v1/chat/completions"
-        method = request_data.get("method", "POST").upper()
-
-        if FULL_LOGS:
-            log.info("📤 OpenAI Request: %s %s", method, url)
-            log.info("📤 Headers: %s", json.dumps(_redact_headers(request_data.get("headers", {})), indent=2, ensure_ascii=False))
-            if request_data.get("body") is not None:
-                body_str = json.dumps(request_data["body"], indent=2, ensure_ascii=False)
-                # if len(body_str) > 1000:
-                    # body_str = body_str[:1000] + "... (truncated)"
-                log.info("📤 Body: %s", body_str)
-        else:
-            log.info("📤 OpenAI Request: %s %s", method, url)
-        request_start = time.time()
-        resp = session.request(
-            method,
-            url,
-            headers=request_data.get("headers", {}),
-            json=request_data.get("body", None),
-        )
-        request_duration = time.time() - request_start
-        if FULL_LOGS:
-            log.info("📥 OpenAI Response: %d (took %.2fs)", resp.status_code, request_duration)
-            # log otveta (bezopasno)
-            try:
-                if resp.headers.get('content-type', '').startswith('application/json'):
-                    response_text = resp.text
-                    # if len(response_text) > 2000:
-                        # response_text = response_text[:2000] + ". (truncated)"
-                    log.info("📥 Response Body: %s", response_text)
-                else:
-                    log.info("📥 Response Body: Non-JSON content, size: %d bytes", len(resp.content))
-            except Exception:
-                log.info("📥 Response Body: Could not decode response")
-        else:
-            log.info("📥 OpenAI Response: %d", resp.status_code)
+    def _attempt(record: dict):
+        """Odna popytka: (rezultat, klass oshibki ili None, Retry-After)."""
+        acquired = False
+        try:
+            if use_limiter:
+                # ochered/limiter
+                g.openai_limiter.update_config(config)
+                slot_start = time.time()
+                acquired = g.openai_limiter.acquire_slot(model=model, tokens=estimated_tokens, timeout=max_wait,
+                                                         priority=priority, api_key=api_key)
+                record["slot_wait"] = round(time.time() - slot_start, 3)
+                if not acquired:
+                    return openai_queue_rejection(model, estimated_tokens, priority, api_key), None, None
+                log.debug("✅ OpenAI slot acquired after %.2fs", record["slot_wait"])
+
+            proxy_url = openai_proxy_url()
+            if not proxy_url:
+                log.error("❌ No proxy available for OpenAI")
+                return {
+                    "content": json.dumps({"error": "Proxy unavailable"}).encode("utf-8"),
+                    "status_code": 503,
+                    "headers": {},
+                }, None, None
+
+            url = request_data.get("url") or "https://api.openai.com/v1/chat/completions"
+            method = request_data.get("method", "POST").upper()
+            # Obshchaya keep-alive sessiya; povtory delaet RetryState
+            session = session_pool.session(url, {"http": proxy_url, "https": proxy_url})
+
+            if FULL_LOGS:
+                log.info("📤 OpenAI Request: %s %s", method, url)
+                log.info("📤 Headers: %s", json.dumps(_redact_headers(request_data.get("headers", {})), indent=2, ensure_ascii=False))
+                if request_data.get("body") is not None:
+                    body_str = json.dumps(request_data["body"], indent=2, ensure_ascii=False)
+                    # if len(body_str) > 1000:
+                        # body_str = body_str[:1000] + "... (truncated)"
+                    log.info("📤 Body: %s", body_str)
+            else:
+                log.info("📤 OpenAI Request: %s %s", method, url)
+            request_start = time.time()
+            resp = session.request(
+                method,
+                url,
+                headers=request_data.get("headers", {}),
+                json=request_data.get("body", None),
+            )
+            request_duration = time.time() - request_start
+            record["upstream"] = round(request_duration, 3)
+            if FULL_LOGS:
+                log.info("📥 OpenAI Response: %d (took %.2fs)", resp.status_code, request_duration)
+                # log otveta (bezopasno)
+                try:
+                    if resp.headers.get('content-type', '').startswith('application/json'):
+                        response_text = resp.text
+                        # if len(response_text) > 2000:
+                            # response_text = response_text[:2000] + ". (truncated)"
+                        log.info("📥 Response Body: %s", response_text)
+                    else:
+                        log.info("📥 Response Body: Non-JSON content, size: %d bytes", len(resp.content))
+                except Exception:
+                    log.info("📥 Response Body: Could not decode response")
+            else:
+                log.info("📥 OpenAI Response: %d", resp.status_code)
 
-        # obnovlyaem ispolzovanie tokenov tolko pri uspeshnom otvete
-        if resp.status_code < 400 and use_limiter:
-            try:
-                resp_json = resp.json()
-                usage = resp_json.get("usage", {}) if isinstance(resp_json, dict) else {}
-                total_tokens = usage.get("total_tokens")
-                if total_tokens is not None:
-                    g.openai_limiter.record_usage(model, int(total_tokens), estimated_tokens)
-            except Exception:
-                pass
+            # ostatok limita po mneniyu servera (x-ratelimit-*), v tom chisle pri 429
+            g.openai_limiter.update_from_headers(model, resp.headers, api_key=api_key)
 
-        # === 429: zhdem, NO SLOT SNAChALA OTPUSKAEM ===
-        if resp.status_code == 429:
-            retry_seconds = _parse_retry_after(resp)
-            max_backoff = float(config.get('max_backoff_seconds', 120.0))
-            # legkiy dzhitter + kap
-            retry_seconds = max(1.0, min(retry_seconds + random.uniform(0, 1.5), max_backoff))
-
-            log.warning("🛑 429 from OpenAI. Will wait %.2fs (retry=%d).", retry_seconds, retry_count)
-            if use_limiter and acquired and not slot_released_early:
-                g.openai_limiter.release_slot()
-                slot_released_early = True
-                log.debug("🔓 OpenAI slot released early (429)")
-
-            time.sleep(retry_seconds)
-
-            return execute_openai_request_parallel(request_data, max_wait, config, retry_count + 1)
-
-        # 5xx — kratkovremennye oshibki: tozhe ne derzhim slot vo vremya pauzy
-        if resp.status_code in (500, 502, 503, 504):
-            backoff = min(10.0 * (retry_count + 1), 30.0) + random.uniform(0, 1.0)
-            log.warning("⚠️ OpenAI %d. Backoff %.1fs, retry=%d", resp.status_code, backoff, retry_count)
-            if use_limiter and acquired and not slot_released_early:
-                g.openai_limiter.release_slot()
-                slot_released_early = True
-                log.debug("🔓 OpenAI slot released early (5xx)")
-            time.sleep(backoff)
-            return execute_openai_request_parallel(request_data, max_wait, config, retry_count + 1)
-
-        # obychnyy otvet
-        return {"content": resp.content, "status_code": resp.status_code, "headers": dict(resp.headers)}
-
-    except (Timeout, ReadTimeout, ConnectTimeout):
-        log.error("❌ OpenAI request timeout")
-        backoff = min(5.0 * (retry_count + 1), 20.0) + random.uniform(0, 1.0)
-        if use_limiter and acquired and not slot_released_early:
-            g.openai_limiter.release_slot()
-            slot_released_early = True
-            log.debug("🔓 OpenAI slot released early (timeout)")
-        time.sleep(backoff)
-        return execute_openai_request_parallel(request_data, max_wait, config, retry_count + 1)
-
-    except (ProxyError, ConnectionError, SSLError, ChunkedEncodingError, ConnectionResetError) as e:
-        log.error("❌ OpenAI connection/proxy error: %s", maybe_truncate(str(e), 200))
-        try:
-            if getattr(g.proxy_manager, "mobile_proxy", None):
-                log.info("🔁 Rotating mobile proxy IP due to connection error …")
-                g.proxy_manager.mobile_proxy.rotate_ip()
-        except Exception as re:
-            log.warning("⚠️ IP rotation failed: %s", re)
+            # obnovlyaem ispolzovanie tokenov tolko pri uspeshnom otvete
+            if resp.status_code < 400 and use_limiter:
+                try:
+                    record_openai_usage(model, resp.json(), estimated_tokens, raw_prompt, api_key)
+                except Exception:
+                    pass
 
-        backoff = min(5.0 * (retry_count + 1), 20.0) + random.uniform(0, 1.0)
-        if use_limiter and acquired and not slot_released_early:
-            g.openai_limiter.release_slot()
-            slot_released_early = True
-            log.debug("🔓 OpenAI slot released early (conn error)")
-        time.sleep(backoff)
+            result = {"content": resp.content, "status_code": resp.status_code, "headers": dict(resp.headers)}
+            error_class = classify_status(resp.status_code)
+            return result, error_class, (retry_after_seconds(resp.headers, resp.content)
+                                         if error_class == "rate_limited" else None)
 
-        return execute_openai_request_parallel(request_data, max_wait, config, retry_count + 1)
+        except Exception as e:
+            error_class = classify_exception(e)
+            log.error("❌ OpenAI request %s: %s", error_class, maybe_truncate(str(e), 200))
+            if retry.should_rotate_ip(error_class):
+                try:
+                    if getattr(g.proxy_manager, "mobile_proxy", None):
+                        log.info("🔁 Rotating mobile proxy IP due to connection error …")
+                        g.proxy_manager.mobile_proxy.rotate_ip()
+                except Exception as re:
+                    log.warning("⚠️ IP rotation failed: %s", re)
+            return openai_upstream_error(error_class, e), error_class, None
+
+        finally:
+            # slot ne derzhim ni vo vremya pauzy pered povtorom, ni posle otveta
+            try:
+                if acquired:
+                    g.openai_limiter.release_slot()
+                    log.debug("🔓 OpenAI slot released")
+            except Exception:
+                pass
 
-    except Exception as e:
-        log.error("❌ OpenAI request error: %s", maybe_truncate(str(e), 200))
-        backoff = 5.0 + random.uniform(0, 1.0)
-        if use_limiter and acquired and not slot_released_early:
-            g.openai_limiter.release_slot()
-            slot_released_early = True
-            log.debug("🔓 OpenAI slot released early (generic error)")
-        time.sleep(backoff)
-        return execute_openai_request_parallel(request_data, max_wait, config, retry_count + 1)
-
-    finally:
-        try:
-            if use_limiter and acquired and not slot_released_early:
-                g.openai_limiter.release_slot()
-                log.debug("🔓 OpenAI slot released")
-        except Exception:
-            pass
-        try:
-            if session:
-                session.close()
-        except Exception:
-            pass
+    while True:
+        record = retry.begin()
+        result, error_class, retry_after = _attempt(record)
+        if error_class is None:
+            retry.end(record, "ok", result["status_code"])
+            break
+        delay = retry.next_delay(error_class, retry_after)
+        retry.end(record, error_class, result["status_code"], backoff=None if delay is None else round(delay, 3))
+        if delay is None:
+            log.warning("⛔ OpenAI %s: giving up after %d attempt(s), %.1fs", error_class,
+                        retry.attempt, time.time() - start_time)
+            break
+        log.warning("🛑 OpenAI %s (status %d). Retry %d in %.2fs.", error_class, result["status_code"],
+                    retry.attempt, delay)
+        time.sleep(delay)
+
+    result["attempts"] = retry.summary()
+    if len(retry.attempts) > 1:
+        log.info("🔁 OpenAI attempts: %s", json.dumps(result["attempts"], ensure_ascii=False))
+    return result
 
 
 def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_count: int = 0):
@@ -296,10 +264,19 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
     
     # Primenyaem rate limiting, osnovannyy na global params
     
-    # Proveryaem dlinu teksta
-    if len(text) > 5000:
-        log.error("❌ Text too long for ElevenLabs: %d characters", len(text))
-        return None, 400, {"error": "Text too long"}
+    # Dlinnyy tekst: rezhem po predlozheniyam, kuski generiruet ochered
+    # parallelno na raznykh akkauntakh, zatem skleivaem MP3
+    if len(text) > MAX_ELEVENLABS_CHARS:
+        pieces = split_text(text, MAX_ELEVENLABS_CHARS)
+        log.info("✂️ Text of %d characters split into %d chunks", len(text), len(pieces))
+        req_ids = g.elevenlabs_queue.add_requests([(piece, voice_id, config) for piece in pieces])
+        results = [g.elevenlabs_queue.wait_for_result(req_id, timeout=999999) for req_id in req_ids]
+        for result in results:
+            if result is None:
+                return None, 504, {"error": "Timeout waiting for chunk"}
+            if not result.get("success"):
+                return None, 502, {"error": f"Chunk failed: {result.get('error', 'Generation failed')}"}
+        return join_mp3([r["content"] for r in results]), 200, {"Content-Type": "audio/mpeg"}
     
     # Poluchaem luchshiy API klyuch S ROTATsEY IP
     api_data = elevenlabs_manager.get_best_api_key(len(text), rotate_ip=True)
@@ -376,9 +353,7 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
         pass
 
     try:
-        session = requests.Session()
-        session.trust_env = False
-        session.proxies = proxy_dict
+        session = session_pool.session("https://api.elevenlabs.io", proxy_dict)
         
         # Formiruem zapros
         url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
@@ -415,7 +390,6 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
             )
         except (ReadTimeout, RequestsConnectionError) as e:
             log.error(f"❌ Proxy connection error for ElevenLabs: {e}")
-            session.close()
             if elevenlabs_manager.mobile_proxy:
                 log.info("🔄 Rotating IP after connection error")
                 elevenlabs_manager.mobile_proxy.rotate_ip()
@@ -424,7 +398,6 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
 
         if response.status_code == 200:
             content = response.content
-            session.close()
 
             
             # Obnovlyaem ispolzovanie
@@ -463,14 +436,12 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
                     except Exception:
                         pass
                     elevenlabs_manager.mark_quota_exceeded(api_data['api_key'], remaining, message)
-                    session.close()
                     time.sleep(5)
                     return _get_elevenlabs_audio_content(text, voice_id, config, retry_count + 1)
 
                 # Spetsialnaya obrabotka dlya unusual activity
                                 # Unusual activity branch
                 if error_status == 'detected_unusual_activity':
-                    session.close()
                     account_retry_count = getattr(api_data, '_retry_count', 0) + 1
                     log.warning(
                         f"Unusual activity detected on {api_data['email']} - attempt {account_retry_count}/4"
@@ -501,7 +472,6 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
                                 log.warning("IP rotation failed, continuing with current IP")
                         time.sleep(10)
                         return _retry_with_same_account(text, voice_id, config, api_data)          # Vse ostalnye oshibki 401
-                session.close()
                 return None, 401, {"error": f"API key error: {error_status}"}
 
             except json.JSONDecodeError:
@@ -509,7 +479,6 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
                     "❌ ElevenLabs API key invalid (cannot parse error): %s",
                     api_data['email'],
                 )
-                session.close()
                 return None, 401, {"error": "Invalid API key"}
             
         elif response.status_code == 403:
@@ -518,14 +487,12 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
                 proxy_manager.mark_elevenlabs_proxy_banned(temp_proxy_obj['proxy_string'], "403 Forbidden")
             else:
                 log.error("❌ ElevenLabs mobile proxy banned")
-            session.close()
             
             time.sleep(30)
             return _get_elevenlabs_audio_content(text, voice_id, config, retry_count + 1)
             
         elif response.status_code == 429:
             log.warning("⚠️ ElevenLabs rate limit hit")
-            session.close()
 
             time.sleep(60)
             return _get_elevenlabs_audio_content(text, voice_id, config, retry_count + 1)
@@ -544,7 +511,6 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
                     except Exception:
                         pass
                     elevenlabs_manager.mark_quota_exceeded(api_data['api_key'], remaining, message)
-                    session.close()
                     time.sleep(5)
                     return _get_elevenlabs_audio_content(text, voice_id, config, retry_count + 1)
             except Exception:
@@ -562,18 +528,14 @@ def _get_elevenlabs_audio_content(text: str, voice_id: str, config: dict, retry_
                             elevenlabs_manager._cleanup_elevenlabs_voices_for(api_data['api_key'], api_data.get('email'))
                     except Exception:
                         pass
-                    session.close()
                     time.sleep(2)
                     return _retry_with_same_account(text, voice_id, config, api_data)
             except Exception:
                 pass
-            session.close()
             return None, response.status_code, {"error": response.text}
             
     except Exception as e:
         log.error("❌ ElevenLabs request failed: %s", e)
-        if 'session' in locals():
-            session.close()
         return None, 500, {"error": str(e)}
 
 def _retry_with_same_account(text: str, voice_id: str, config: dict, api_data: dict):
@@ -607,9 +569,7 @@ def _retry_with_same_account(text: str, voice_id: str, config: dict, api_data: d
     log.info(f"🔄 Retrying with same account after IP rotation: {api_data['email']}, attempt {retry_count}/4, IP={request_ip}")
     
     try:
-        session = requests.Session()
-        session.trust_env = False
-        session.proxies = proxy_dict
+        session = session_pool.session("https://api.elevenlabs.io", proxy_dict)
         
         url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
         
@@ -642,7 +602,6 @@ def _retry_with_same_account(text: str, voice_id: str, config: dict, api_data: d
             )
         except (ReadTimeout, RequestsConnectionError) as e:
             log.error(f"❌ Proxy connection error during retry: {e}")
-            session.close()
             if elevenlabs_manager.mobile_proxy:
                 elevenlabs_manager.mobile_proxy.rotate_ip()
             time.sleep(5)
@@ -650,7 +609,6 @@ def _retry_with_same_account(text: str, voice_id: str, config: dict, api_data: d
 
         if response.status_code == 200:
             content = response.content
-            session.close()
             
             elevenlabs_manager.update_usage(api_data['api_key'], len(text))
             log.info(f"✅ Success after IP rotation: {api_data['email']}, attempt {retry_count}/4")
@@ -671,16 +629,13 @@ def _retry_with_same_account(text: str, voice_id: str, config: dict, api_data: d
                 except Exception:
                     pass
                 elevenlabs_manager.mark_quota_exceeded(api_data['api_key'], remaining, message)
-                session.close()
                 time.sleep(5)
                 return _retry_with_same_account(text, voice_id, config, api_data)
 
             if error_status == 'detected_unusual_activity':
-                session.close()
                 # Rekursivno vyzyvaem osnovnuyu funktsiyu dlya obrabotki
                 return _get_elevenlabs_audio_content(text, voice_id, config, 0)
             else:
-                session.close()
                 return None, 401, {"error": f"API key error: {error_status}"}
         else:
             try:
@@ -696,17 +651,13 @@ def _retry_with_same_account(text: str, voice_id: str, config: dict, api_data: d
                     except Exception:
                         pass
                     elevenlabs_manager.mark_quota_exceeded(api_data['api_key'], remaining, message)
-                    session.close()
                     time.sleep(5)
                     return _retry_with_same_account(text, voice_id, config, api_data)
             except Exception:
                 pass
-            session.close()
             return None, response.status_code, {"error": response.text}
             
     except Exception as e:
-        if 'session' in locals():
-            session.close()
         return None, 500, {"error": str(e)}
 
 def _handle_unusual_activity_retry(text: str, voice_id: str, config: dict, base_retry_count: int = 0):
@@ -766,9 +717,7 @@ def _handle_unusual_activity_retry(text: str, voice_id: str, config: dict, base_
         proxy_dict = elevenlabs_manager._get_proxy_dict(proxy_obj)
         
         try:
-            session = requests.Session()
-            session.trust_env = False
-            session.proxies = proxy_dict
+            session = session_pool.session("https://api.elevenlabs.io", proxy_dict)
             
             url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
             
@@ -803,14 +752,12 @@ def _handle_unusual_activity_retry(text: str, voice_id: str, config: dict, base_
                 )
             except (ReadTimeout, RequestsConnectionError) as e:
                 log.error(f"❌ Proxy connection error during unusual retry: {e}")
-                session.close()
                 if elevenlabs_manager.mobile_proxy:
                     elevenlabs_manager.mobile_proxy.rotate_ip()
                 continue
 
             if response.status_code == 200:
                 content = response.content
-                session.close()
                 
                 elevenlabs_manager.update_usage(api_data['api_key'], len(text))
                 proxy_manager.update_elevenlabs_request_count(proxy_obj['proxy_string'])
@@ -835,7 +782,6 @@ def _handle_unusual_activity_retry(text: str, voice_id: str, config: dict, base_
                             pass
                         elevenlabs_manager.mark_quota_exceeded(api_data['api_key'], remaining, message)
                         log.warning("⚠️ Quota exceeded during unusual activity retry")
-                        session.close()
                         return None, 402, {"error": "Quota exceeded"}
 
                     if error_status != 'detected_unusual_activity':
@@ -844,7 +790,6 @@ def _handle_unusual_activity_retry(text: str, voice_id: str, config: dict, base_
                             "❌ Different 401 error during unusual activity retry: %s",
                             error_status,
                         )
-                        session.close()
                         return None, 401, {"error": f"API key error: {error_status}"}
 
                     # Vse eshche unusual activity - prodolzhaem
@@ -852,7 +797,6 @@ def _handle_unusual_activity_retry(text: str, voice_id: str, config: dict, base_
 
                 except json.JSONDecodeError:
                     log.error("❌ Cannot parse error during unusual activity retry")
-                    session.close()
                     return None, 401, {"error": "Invalid API key"}
             else:
                 try:
@@ -869,18 +813,14 @@ def _handle_unusual_activity_retry(text: str, voice_id: str, config: dict, base_
                             pass
                         elevenlabs_manager.mark_quota_exceeded(api_data['api_key'], remaining, message)
                         log.warning("⚠️ Quota exceeded during unusual retry")
-                        session.close()
                         return None, 402, {"error": "Quota exceeded"}
                 except Exception:
                     pass
                 log.warning("⚠️ Other error during unusual activity retry: %d", response.status_code)
 
-            session.close()
             
         except Exception as e:
             log.error("❌ Error during unusual activity retry: %s", e)
-            if 'session' in locals():
-                session.close()
             continue
     
     log.error("❌ Max unusual activity retries exceeded")
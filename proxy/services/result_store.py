@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Bounded store for finished ElevenLabs queue results.
+
+Each request gets an entry with a ``threading.Event``; :meth:`ResultStore.set`
+fills it and wakes the waiters.  Entries are dropped:
+
+* when the waiter collects the result (:meth:`ResultStore.pop`);
+* ``ttl`` seconds after completion if nobody collected them;
+* when the in-memory audio exceeds ``max_bytes`` — the oldest results are
+  spilled to temp files (if ``spill_bytes`` is set) or replaced by an error.
+
+Results of at least ``spill_bytes`` go to a temp file right away, so large
+MP3s don't sit in RAM while the client is still waiting.
+"""
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from utils.logger import log
+
+
+class ResultStore:
+    def __init__(self, ttl: float = 600, max_bytes: int = 256 * 1024 * 1024,
+                 spill_bytes: int = None, spill_dir: str = None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self.spill_dir = spill_dir
+        self.lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        self._in_memory: "OrderedDict[str, int]" = OrderedDict()  # id -> bayty, po vremeni zaversheniya
+        self._memory_bytes = 0
+        self._spilled_bytes = 0
+        self.evicted_ttl = 0
+        self.evicted_budget = 0
+        self.spilled = 0
+        self._last_sweep = 0.0
+
+    # ------------------------------------------------------------------
+    def create(self, request_id: str) -> threading.Event:
+        event = threading.Event()
+        with self.lock:
+            self._entries[request_id] = {
+                "event": event, "result": None, "created": time.time(),
+                "done_at": None, "spill_path": None, "spill_size": 0,
+            }
+        if time.time() - self._last_sweep > 1:
+            self.sweep()
+        return event
+
+    def set(self, request_id: str, result: dict) -> None:
+        with self.lock:
+            entry = self._entries.get(request_id)
+            if entry is None:
+                return  # zapros uzhe zabyli (naprimer, strim zavershen)
+            self._drop_content(request_id, entry)
+            entry["result"] = result
+            entry["done_at"] = time.time()
+            size = len(result.get("content") or b"")
+            spilled = bool(size and self.spill_bytes and size >= self.spill_bytes
+                           and self._spill(request_id, entry))
+            if size and not spilled:
+                self._in_memory[request_id] = size
+                self._memory_bytes += size
+            self._enforce_budget()
+            event = entry["event"]
+        event.set()
+
+    # ------------------------------------------------------------------
+    def status(self, request_id: str) -> Optional[str]:
+        """``"pending"``, ``"done"`` or ``None`` for unknown/expired ids."""
+        with self.lock:
+            entry = self._entries.get(request_id)
+        if entry is None:
+            return None
+        return "done" if entry["event"].is_set() else "pending"
+
+    def created_at(self, request_id: str) -> Optional[float]:
+        with self.lock:
+            entry = self._entries.get(request_id)
+        return entry["created"] if entry else None
+
+    def wait(self, request_id: str, timeout: float = None) -> bool:
+        with self.lock:
+            entry = self._entries.get(request_id)
+        return bool(entry) and entry["event"].wait(timeout)
+
+    def peek(self, request_id: str) -> Optional[dict]:
+        """Finished result as stored (spilled audio is not read back)."""
+        with self.lock:
+            entry = self._entries.get(request_id)
+            return entry["result"] if entry else None
+
+    def get(self, request_id: str) -> Optional[dict]:
+        """Finished result without removing it (spilled audio is read back)."""
+        with self.lock:
+            entry = self._entries.get(request_id)
+            if entry is None or entry["result"] is None:
+                return None
+            result, path = entry["result"], entry["spill_path"]
+        return self._load(result, path)
+
+    def pop(self, request_id: str) -> Optional[dict]:
+        """Collect a finished result and forget the entry."""
+        with self.lock:
+            entry = self._entries.get(request_id)
+            if entry is None or entry["result"] is None:
+                return None
+            del self._entries[request_id]
+            result, path = entry["result"], entry["spill_path"]
+            self._forget_memory(request_id)
+            if path:
+                self._spilled_bytes -= entry["spill_size"]
+        try:
+            return self._load(result, path)
+        finally:
+            self._unlink(path)
+
+    def discard(self, request_id: str) -> None:
+        with self.lock:
+            entry = self._entries.pop(request_id, None)
+            if entry is not None:
+                self._drop_content(request_id, entry)
+
+    # ------------------------------------------------------------------
+    def sweep(self) -> int:
+        """Drop results not collected within ``ttl`` seconds of completion."""
+        if not self.ttl:
+            return 0
+        self._last_sweep = time.time()
+        cutoff = self._last_sweep - self.ttl
+        with self.lock:
+            expired = [rid for rid, e in self._entries.items()
+                       if e["done_at"] is not None and e["done_at"] < cutoff]
+            for rid in expired:
+                self._drop_content(rid, self._entries.pop(rid))
+            self.evicted_ttl += len(expired)
+        if expired:
+            log.info(f"🧹 Dropped {len(expired)} uncollected ElevenLabs results (ttl {self.ttl}s)")
+        return len(expired)
+
+    def get_stats(self) -> dict:
+        self.sweep()
+        with self.lock:
+            pending = sum(1 for e in self._entries.values() if e["done_at"] is None)
+            return {
+                "entries": len(self._entries),
+                "pending": pending,
+                "ready": len(self._entries) - pending,
+                "memory_bytes": self._memory_bytes,
+                "max_bytes": self.max_bytes,
+                "spilled_bytes": self._spilled_bytes,
+                "spilled": self.spilled,
+                "evicted_ttl": self.evicted_ttl,
+                "evicted_budget": self.evicted_budget,
+            }
+
+    # ------------------------------------------------------------------
+    # Vyzyvayutsya pod self.lock
+    # ------------------------------------------------------------------
+    def _forget_memory(self, request_id: str) -> None:
+        size = self._in_memory.pop(request_id, None)
+        if size:
+            self._memory_bytes -= size
+
+    def _drop_content(self, request_id: str, entry: dict) -> None:
+        self._forget_memory(request_id)
+        if entry["spill_path"]:
+            self._spilled_bytes -= entry["spill_size"]
+            self._unlink(entry["spill_path"])
+            entry["spill_path"] = None
+            entry["spill_size"] = 0
+
+    def _spill(self, request_id: str, entry: dict) -> bool:
+        result = entry["result"]
+        content = result.get("content") or b""
+        try:
+            fd, path = tempfile.mkstemp(prefix="tts_result_", suffix=".mp3", dir=self.spill_dir)
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(content)
+        except OSError as e:
+            log.warning(f"⚠️ Could not spill ElevenLabs result to disk: {e}")
+            return False
+        entry["result"] = {k: v for k, v in result.items() if k != "content"}
+        entry["spill_path"] = path
+        entry["spill_size"] = len(content)
+        self._spilled_bytes += len(content)
+        self.spilled += 1
+        return True
+
+    def _enforce_budget(self) -> None:
+        while self._memory_bytes > self.max_bytes and self._in_memory:
+            rid, size = self._in_memory.popitem(last=False)
+            self._memory_bytes -= size
+            entry = self._entries[rid]
+            if self.spill_bytes and self._spill(rid, entry):
+                continue
+            # Nekuda devat — zhdushchiy klient poluchit oshibku vmesto audio
+            entry["result"] = {"success": False, "error": "Result evicted (memory budget exceeded)"}
+            self.evicted_budget += 1
+            log.warning(f"⚠️ ElevenLabs result {rid[:8]} evicted: result store over {self.max_bytes} bytes")
+
+    @staticmethod
+    def _load(result: dict, path: Optional[str]) -> dict:
+        if not path:
+            return result
+        try:
+            with open(path, "rb") as fh:
+                return {**result, "content": fh.read()}
+        except OSError as e:
+            log.error(f"❌ Spilled ElevenLabs result lost: {e}")
+            return {"success": False, "error": "Result file lost"}
+
+    @staticmethod
+    def _unlink(path: Optional[str]) -> None:
+        if path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""On-disk content-addressed cache of generated ElevenLabs MP3s.
+
+The key is a SHA-256 of the normalized request ``(text, voice_id, model_id,
+voice_settings)``; the file lives at ``<dir>/<key[:2]>/<key>.mp3``.  The
+cache is bounded by total size and evicts least recently used files.  LRU
+order survives restarts through file mtimes (touched on every hit).
+
+Files are written to a temp file and moved in place with ``os.replace``, so
+readers never see a partial MP3.  Hits are served by path (``send_file``:
+``wsgi.file_wrapper``/sendfile, Range requests, optional X-Sendfile), so the
+audio never passes through Python memory.
+"""
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from utils.logger import log
+
+SUFFIX = ".mp3"
+
+
+def _normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", text or "").strip()
+
+
+def make_key(text: str, voice_id: str, model_id: str, voice_settings: dict) -> str:
+    """Stable hash of everything that changes the generated audio."""
+    settings = {
+        k: (round(v, 4) if isinstance(v, float) else v)
+        for k, v in (voice_settings or {}).items()
+        if v is not None
+    }
+    payload = json.dumps(
+        [_normalize_text(text), voice_id, model_id, settings],
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheWriter:
+    """Incremental writer for streamed audio; nothing is visible until :meth:`commit`."""
+
+    def __init__(self, cache: "TTSCache", key: str):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        self.tmp_path = cache.path_for(key).with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+        self.tmp_path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.tmp_path, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self._fh.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> Optional[Path]:
+        try:
+            self._fh.close()
+        except OSError as e:
+            log.warning(f"⚠️ TTS cache write failed: {e}")
+            self.abort()
+            return None
+        if not self.size:
+            self.abort()
+            return None
+        return self.cache._commit(self.key, self.tmp_path, self.size)
+
+    def abort(self) -> None:
+        try:
+            self._fh.close()
+            self.tmp_path.unlink()
+        except OSError:
+            pass
+
+
+class TTSCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # key -> razmer, starye pervymi
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def _scan(self) -> None:
+        """Vosstanavlivaet LRU-poryadok po mtime faylov i chistit nedopisannye tmp."""
+        found = []
+        for path in self.directory.glob("*/*"):
+            try:
+                if path.suffix == ".tmp":
+                    path.unlink()
+                elif path.suffix == SUFFIX:
+                    st = path.stat()
+                    found.append((st.st_mtime, path.stem, st.st_size))
+            except OSError:
+                continue
+        found.sort()
+        with self.lock:
+            for _, key, size in found:
+                self._entries[key] = size
+                self._bytes += size
+            self._evict_locked()
+        log.info(f"🗄️ TTS cache: {len(self._entries)} files, {self._bytes / 1048576:.1f} MB in {self.directory}")
+
+    def path_for(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}{SUFFIX}"
+
+    # ------------------------------------------------------------------
+    def lookup(self, key: str) -> Optional[Path]:
+        """Path of the cached MP3 (counts a hit) or ``None`` (a miss)."""
+        with self.lock:
+            if key in self._entries:
+                path = self.path_for(key)
+                try:
+                    os.utime(path)  # mtime = vremya poslednego ispolzovaniya
+                except OSError:
+                    # Fayl udalili snaruzhi — zabyvaem zapis
+                    self._bytes -= self._entries.pop(key)
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return path
+            self.misses += 1
+            return None
+
+    def put(self, key: str, content: bytes) -> Optional[Path]:
+        if not content:
+            return None
+        writer = None
+        try:
+            writer = self.writer(key)
+            writer.write(content)
+        except OSError as e:
+            if writer is not None:
+                writer.abort()
+            log.warning(f"⚠️ TTS cache write failed: {e}")
+            return None
+        return writer.commit()
+
+    def writer(self, key: str) -> CacheWriter:
+        return CacheWriter(self, key)
+
+    def _commit(self, key: str, tmp_path: Path, size: int) -> Optional[Path]:
+        if size > self.max_bytes:
+            tmp_path.unlink(missing_ok=True)
+            return None
+        path = self.path_for(key)
+        with self.lock:
+            try:
+                os.replace(tmp_path, path)
+            except OSError as e:
+                log.warning(f"⚠️ TTS cache write failed: {e}")
+                tmp_path.unlink(missing_ok=True)
+                return None
+            self._bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict_locked()
+        return path
+
+    def _evict_locked(self) -> None:
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                self.path_for(key).unlink()
+            except OSError:
+                pass
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
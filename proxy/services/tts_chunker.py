@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Splitting long TTS texts and stitching the generated MP3s back together.
+
+:func:`split_text` cuts on sentence boundaries (then clause boundaries, then
+whitespace) so each piece fits ``max_chars``; pieces can go to different
+accounts and be generated in parallel.
+
+:func:`join_mp3` concatenates MP3 streams frame-wise: the ID3v2 tag of the
+first part is kept, other tags are removed, and Xing/Info header frames are
+dropped (their frame counts describe a single part and would make players
+report the wrong duration).
+"""
+import re
+from typing import List
+
+_SENTENCE_END = re.compile(r'(?<=[.!?…。！？])\s+|(?<=[.!?…。！？]["»”\')\]])\s+')
+_CLAUSE_END = re.compile(r'(?<=[,;:—–])\s+')
+
+
+def _pack(pieces: List[str], max_chars: int, splitter) -> List[str]:
+    """Skleivaet sosednie kuski, poka pomeshchaetsya; slishkom dlinnye rezhet dalshe."""
+    chunks: List[str] = []
+    current = ""
+    for piece in pieces:
+        if len(piece) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.extend(splitter(piece, max_chars))
+            continue
+        candidate = f"{current} {piece}" if current else piece
+        if len(candidate) <= max_chars:
+            current = candidate
+        else:
+            chunks.append(current)
+            current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _split_hard(text: str, max_chars: int) -> List[str]:
+    chunks = []
+    while len(text) > max_chars:
+        cut = text.rfind(" ", 0, max_chars + 1)
+        if cut <= 0:
+            cut = max_chars
+        chunks.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def _split_clauses(text: str, max_chars: int) -> List[str]:
+    return _pack([p for p in _CLAUSE_END.split(text) if p], max_chars, _split_hard)
+
+
+def split_text(text: str, max_chars: int) -> List[str]:
+    """Split ``text`` into pieces of at most ``max_chars``, preferring sentence ends."""
+    text = text.strip()
+    if len(text) <= max_chars:
+        return [text] if text else []
+    chunks = []
+    # Abzatsy ne skleivaem mezhdu soboy — na nikh estestvennaya pauza
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = " ".join(paragraph.split())
+        if paragraph:
+            sentences = [s for s in _SENTENCE_END.split(paragraph) if s]
+            chunks.extend(_pack(sentences, max_chars, _split_clauses))
+    return chunks
+
+
+# ----------------------------------------------------------------------
+# MP3
+# ----------------------------------------------------------------------
+_BITRATES = {  # kbps po (MPEG-1?, bitrate index) dlya Layer III
+    True: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    False: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def _skip_id3v2(data: bytes) -> int:
+    if len(data) >= 10 and data[:3] == b"ID3":
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        return 10 + size + (10 if data[5] & 0x10 else 0)
+    return 0
+
+
+def _strip_id3v1(data: bytes) -> bytes:
+    if len(data) >= 128 and data[-128:-125] == b"TAG":
+        return data[:-128]
+    return data
+
+
+def _frame_info(data: bytes, pos: int):
+    """``(frame_length, side_info_length)`` for a Layer III header at ``pos`` or ``None``."""
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 0x03
+    layer = (data[pos + 1] >> 1) & 0x03
+    bitrate_index = data[pos + 2] >> 4
+    rate_index = (data[pos + 2] >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _BITRATES[mpeg1][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    padding = (data[pos + 2] >> 1) & 0x01
+    mono = (data[pos + 3] >> 6) == 3
+    length = (144 if mpeg1 else 72) * bitrate // sample_rate + padding
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    return length, side_info
+
+
+def _audio_frames(data: bytes, keep_id3: bool) -> bytes:
+    start = _skip_id3v2(data)
+    head = data[:start] if keep_id3 else b""
+    data = _strip_id3v1(data)
+    # Nachalo pervogo kadra (posle tega mogut byt nuli)
+    pos = start
+    while pos < min(len(data), start + 4096) and _frame_info(data, pos) is None:
+        pos += 1
+    info = _frame_info(data, pos)
+    if info is not None:
+        start = pos
+        length, side_info = info
+        tag = data[start + 4 + side_info:start + 8 + side_info]
+        if tag in (b"Xing", b"Info"):
+            start += length
+    return head + data[start:]
+
+
+def join_mp3(parts: List[bytes]) -> bytes:
+    """Concatenate MP3 parts in order into one playable stream."""
+    if len(parts) == 1:
+        return parts[0]
+    return b"".join(_audio_frames(part, keep_id3=(i == 0)) for i, part in enumerate(parts))
@@ -5,8 +5,9 @@ Excel file management web interface
 import os
 import time
 from datetime import datetime
+import tempfile
 import openpyxl
-from flask import request, jsonify
+from flask import request, jsonify, send_file
 import globals as g
 
 def register_excel_routes(app):
@@ -48,6 +49,8 @@ def register_excel_routes(app):
                     <button class="btn" onclick="createApiExcel()">📝 Создать api_elevenlabs.xlsx</button>
                     <button class="btn" onclick="checkQuotas()">🔍 Проверить квоты</button>
                     <button class="btn" onclick="loadStats()">📊 Обновить статистику</button>
+                    <button class="btn" onclick="importExcel()">📥 Импорт из Excel</button>
+                    <a class="btn" href="/api-keys-export">📤 Экспорт в Excel</a>
                     
                     <div id="result" class="result" style="display: none;"></div>
                     
@@ -90,6 +93,15 @@ def register_excel_routes(app):
                         });
                     }
                     
+                    function importExcel() {
+                        fetch('/api-keys-import', { method: 'POST' })
+                        .then(r => r.json())
+                        .then(data => {
+                            showResult(data.message, !data.success);
+                            if (data.success) loadStats();
+                        });
+                    }
+                    
                     function loadStats() {
                         fetch('/elevenlabs-stats')
                         .then(r => r.json())
@@ -161,34 +173,17 @@ def register_excel_routes(app):
     def api_keys_list():
         """Возвращает список API ключей с информацией"""
         try:
-            filename = "api_elevenlabs.xlsx"
-            
-            if not os.path.exists(filename):
-                return jsonify([])
-            
-            wb = openpyxl.load_workbook(filename)
-            ws = wb.active
-            
             keys = []
-            for row in range(2, ws.max_row + 1):
-                api_key = ws.cell(row=row, column=1).value
-                if not api_key:
-                    continue
-                    
-                email = ws.cell(row=row, column=2).value or "Unknown"
-                quota_remaining = ws.cell(row=row, column=4).value or 0
-                last_checked = ws.cell(row=row, column=5).value or "Never"
-                status = ws.cell(row=row, column=6).value or "Unknown"
-                usage_count = ws.cell(row=row, column=7).value or 0
-                total_used = ws.cell(row=row, column=8).value or 0
-                
+            for account in g.elevenlabs_manager.accounts.accounts():
+                quota_remaining = account.get("quota_remaining") or 0
+                total_used = account.get("total_used") or 0
                 keys.append({
-                    "email": email,
+                    "email": account.get("email") or "Unknown",
                     "quota_remaining": quota_remaining,
                     "quota_total": quota_remaining + total_used,
-                    "last_checked": last_checked,
-                    "status": status,
-                    "usage_count": usage_count,
+                    "last_checked": account.get("last_checked") or "Never",
+                    "status": account.get("status") or "Unknown",
+                    "usage_count": account.get("usage_count") or 0,
                     "total_used": total_used
                 })
             
@@ -197,6 +192,40 @@ def register_excel_routes(app):
         except Exception as e:
             return jsonify({"error": str(e)})
 
+    @app.route("/api-keys-import", methods=["POST"])
+    def api_keys_import():
+        """Загружает аккаунты из Excel в базу (файл в поле 'file' или api_elevenlabs.xlsx)"""
+        tmp_path = None
+        try:
+            accounts = g.elevenlabs_manager.accounts
+            upload = request.files.get("file")
+            if upload:
+                fd, tmp_path = tempfile.mkstemp(suffix=".xlsx")
+                os.close(fd)
+                upload.save(tmp_path)
+            count = accounts.import_excel(tmp_path or accounts.excel_path)
+            if not count:
+                return jsonify({"success": False, "message": "❌ В файле нет API ключей или он поврежден"})
+            return jsonify({"success": True, "message": f"✅ Импортировано {count} API ключей"})
+        except Exception as e:
+            return jsonify({"success": False, "message": f"❌ Ошибка импорта: {str(e)}"})
+        finally:
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    @app.route("/api-keys-export")
+    def api_keys_export():
+        """Выгружает текущее состояние аккаунтов в api_elevenlabs.xlsx и отдает файл"""
+        try:
+            path = g.elevenlabs_manager.accounts.export_excel()
+            return send_file(os.path.abspath(path), as_attachment=True,
+                             download_name=os.path.basename(path))
+        except Exception as e:
+            return jsonify({"success": False, "message": f"❌ Ошибка экспорта: {str(e)}"}), 500
+
 
 def create_api_excel_file():
     """Создает Excel файл для ElevenLabs API ключей"""
@@ -227,6 +256,8 @@ def create_api_excel_file():
                 ws.cell(row=row, column=col, value=value)
         
         wb.save(filename)
+        if getattr(g, "elevenlabs_manager", None):
+            g.elevenlabs_manager.accounts.import_excel(filename)
         return True, f"✅ Создан файл {filename}. Не забудьте заменить примеры на реальные API ключи!"
         
     except Exception as e:
@@ -237,23 +268,20 @@ def create_api_excel_file():
 def check_all_quotas():
     """Проверяет квоту для всех ключей ElevenLabs"""
     try:
-        filename = "api_elevenlabs.xlsx"
-        
-        if not os.path.exists(filename):
-            return False, f"Файл {filename} не найден! Создайте его сначала."
-        
-        wb = openpyxl.load_workbook(filename)
-        ws = wb.active
+        accounts = g.elevenlabs_manager.accounts
+        snapshot = accounts.accounts()
+        if not snapshot:
+            return False, "Нет загруженных API ключей! Создайте api_elevenlabs.xlsx сначала."
         
         updated_count = 0
         errors = []
         
-        for row in range(2, ws.max_row + 1):
-            api_key = ws.cell(row=row, column=1).value
-            email = ws.cell(row=row, column=2).value
-            status = ws.cell(row=row, column=6).value
+        for account in snapshot:
+            api_key = account["api_key"]
+            email = account["email"]
+            status = account["status"]
             
-            if not api_key or status == "disabled":
+            if status == "disabled":
                 continue
             
             try:
@@ -261,14 +289,13 @@ def check_all_quotas():
                 proxy_obj = g.proxy_manager.get_available_proxy(for_openai_fm=False)
                 proxy_dict = g.elevenlabs_manager._get_proxy_dict(proxy_obj) if proxy_obj else {}
                 quota = g.elevenlabs_manager.check_quota(api_key, proxy_dict)
-                # Обновляем данные в Excel
-                ws.cell(row=row, column=4, value=quota)  # Quota Remaining
-                ws.cell(row=row, column=5, value=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))  # Last Checked
-                
-                if quota <= 0:
-                    ws.cell(row=row, column=6, value="exhausted")
-                else:
-                    ws.cell(row=row, column=6, value="active")
+                # Обновляем данные в реестре
+                accounts.update(
+                    api_key,
+                    quota_remaining=quota,
+                    last_checked=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    status="exhausted" if quota <= 0 else "active",
+                )
                 
                 updated_count += 1
                 
@@ -277,9 +304,7 @@ def check_all_quotas():
                 
             except Exception as e:
                 errors.append(f"{email}: {str(e)}")
-                ws.cell(row=row, column=6, value="error")
-        
-        wb.save(filename)
+                accounts.update(api_key, status="error")
         
         message = f"✅ Проверено {updated_count} API ключей"
         if errors:
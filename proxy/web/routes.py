@@ -3,9 +3,13 @@
 Flask web routes and API endpoints
 """
 import io
+import math
 import time
 import json
 import os
+import uuid
+import zipfile
+import tempfile
 from pathlib import Path
 from flask import (
     Flask,
@@ -15,6 +19,8 @@ from flask import (
     jsonify,
     send_from_directory,
     Blueprint,
+    Response,
+    stream_with_context,
 )
 from flask_cors import CORS
 import requests
@@ -27,7 +33,8 @@ from utils.logging import color_ip, log_request_short
 from config.settings import get_openai_config
 from services.openai_batcher import OpenAIRequestBatcher
 from services.elevenlabs_manager import VOICE_DEFAULTS, MODEL_VOICE_PARAMS
-from services.request_handlers import execute_openai_request_parallel
+from services.request_handlers import record_openai_usage
+from proxy.session_pool import session_pool
 from db import init_db, get_conn
 from datetime import datetime
 
@@ -57,6 +64,14 @@ def _dump_headers(headers):
     return {k: (_redact_auth(v) if k.lower() == "authorization" else v) for k, v in headers.items()}
 
 
+def _openai_key_from_request():
+    """Ключ OpenAI из Authorization: Bearer ... или None."""
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return None
+    return auth.replace("Bearer ", "", 1) or None
+
+
 def _log_request(req):
     if FULL_LOGS:
         try:
@@ -260,6 +275,8 @@ def update_message(chat_id, msg_id):
 def create_app():
     """Создает и настраивает Flask приложение"""
     app = Flask(__name__, static_folder=str(CLIENT_DIR), static_url_path="")
+    # Za nginx/Apache otdachu faylov (kesh TTS) mozhno otdat frontendu
+    app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")
     CORS(app, origins="*", supports_credentials=True, allow_headers=["Content-Type", "Authorization", "X-Request-ID"])
 
     register_routes(app)
@@ -287,6 +304,16 @@ def register_routes(app):
         except:
             pass
 
+    def _flush_account_journal():
+        accounts = getattr(getattr(g, 'elevenlabs_manager', None), 'accounts', None)
+        if accounts is None:
+            return
+        try:
+            accounts.flush()
+            log.info("💾 ElevenLabs account changes flushed")
+        except Exception as e:
+            log.error(f"❌ Failed to flush ElevenLabs accounts: {e}")
+
     @app.route("/shutdown", methods=["POST"])
     def shutdown_server():
         """Graceful shutdown прокси сервера"""
@@ -306,6 +333,9 @@ def register_routes(app):
                     log.info("🧹 ElevenLabs queue stopped")
                 except Exception:
                     pass
+
+            # Sbrasyvaem nakoplennye izmeneniya kvot v Excel
+            _flush_account_journal()
             
             log.info("✅ Graceful shutdown initiated")
             
@@ -317,6 +347,12 @@ def register_routes(app):
             def delayed_shutdown():
                 import time
                 time.sleep(2)
+                # Zaprosy, zavershivshiesya za eti 2 sekundy, tozhe sohranyaem
+                _flush_account_journal()
+                # Zakryvaem sessii aiohttp i ostanavlivaem tsikl dvizhka OpenAI
+                engine = getattr(g, 'openai_engine', None)
+                if engine is not None:
+                    engine.stop()
                 import os
                 os._exit(0)
             
@@ -445,9 +481,7 @@ def register_routes(app):
                 proxy_type = "regular"
                 proxy_server = proxy_obj.get('host', 'unknown')
 
-            session = requests.Session()
-            session.trust_env = False
-            session.proxies = proxy_dict
+            session = session_pool.session("https://external.api.recraft.ai", proxy_dict)
 
             headers = {
                 "Authorization": f"Bearer {api_key}",
@@ -534,19 +568,13 @@ def register_routes(app):
         except Exception as e:
             log.error("❌ Recraft request failed: %s", str(e))
             return add_cors(make_response(f"Request failed: {e}", 500))
-        
-        finally:
-            try:
-                session.close()
-            except:
-                pass
 
 
     @app.after_request
     def add_cors(resp):
         resp.headers.update({
             "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "Content-Type, Authorization, X-Request-ID",
+            "Access-Control-Allow-Headers": "Content-Type, Authorization, X-Request-ID, X-Priority",
             "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
         })
         return resp
@@ -568,27 +596,37 @@ def register_routes(app):
 
             config = get_openai_config(request.args)
             log.info("📋 OpenAI config loaded")
+            priority = request.headers.get("X-Priority")
+
+            # Ключ нужен до лимитера: лимиты и бюджет OpenAI считаются по ключу
+            api_key = _openai_key_from_request()
+            if api_key is None and not g.openai_limiter.key_pool:
+                return "Missing or invalid Authorization header", 401
 
             # Используем глобальный лимитер из globalParams.json
             g.openai_limiter.update_config(config)
-            acquired = g.openai_limiter.acquire_slot(model=req_model, tokens=0, timeout=config.get("queue_timeout"))
+            estimated_tokens, raw_prompt = g.openai_limiter.estimator.estimate(req_model, req_json)
+            if api_key is None:
+                api_key = g.openai_limiter.pick_pool_key(req_model, estimated_tokens)
+            acquired = g.openai_limiter.acquire_slot(
+                model=req_model, tokens=estimated_tokens, timeout=config.get("queue_timeout"),
+                priority=priority, api_key=api_key)
             if not acquired:
-                retry_after = g.openai_limiter.suggest_wait_seconds(model=req_model, tokens=0)
+                queue_info = g.openai_limiter.queue_status(
+                    model=req_model, tokens=estimated_tokens, priority=priority, api_key=api_key)
+                retry_after = queue_info["estimated_wait_seconds"]
                 payload = {
                     "error": "Rate limited",
                     "retry_after_seconds": retry_after,
                     "model": req_model,
+                    **queue_info,
                 }
                 resp = make_response(json.dumps(payload), 429)
-                resp.headers["Retry-After"] = str(int(retry_after)) if retry_after and retry_after != float("inf") else "2"
+                resp.headers["Retry-After"] = (str(max(1, math.ceil(retry_after)))
+                                               if retry_after and retry_after != float("inf") else "2")
                 resp.headers["Content-Type"] = "application/json; charset=utf-8"
                 return add_cors(resp)
 
-            auth = request.headers.get("Authorization", "")
-            if not auth.startswith("Bearer "):
-                return "Missing or invalid Authorization header", 401
-            api_key = auth.replace("Bearer ", "", 1)
-
             client_ip = g.proxy_manager._get_client_ip()
             log.info("👤 Client: %s", color_ip(client_ip, is_local=True))
 
@@ -603,6 +641,7 @@ def register_routes(app):
                 },
                 "body": req_json,
             }
+            # Слот уже занят здесь, поэтому обработчик лимитер не трогает
             config["use_limiter"] = False
             try:
                 response_data = openai_request_batcher.enqueue(request_data, config)
@@ -611,6 +650,14 @@ def register_routes(app):
 
             status_code = response_data.get("status_code", 500)
 
+            # Фактический usage поправляет резерв и калибрует оценку токенов
+            if status_code < 400:
+                try:
+                    record_openai_usage(req_model, json.loads(response_data.get("content") or b"{}"),
+                                        estimated_tokens, raw_prompt, api_key)
+                except Exception:
+                    pass
+
             # Обрабатываем перегрузку прокси/апстрима так же, как в /proxy-responses
             if status_code in (503, 504):
                 error_content = response_data.get("content", b"")
@@ -801,13 +848,14 @@ def register_routes(app):
                 return "Missing request data", 400
 
             config = get_openai_config(request.args)
+            # Класс приоритета в очереди лимитера: high / normal / low
+            config["priority"] = request.headers.get("X-Priority")
 
             log.info("📋 OpenAI config loaded")
 
-            auth = request.headers.get("Authorization", "")
-            if not auth.startswith("Bearer "):
+            api_key = _openai_key_from_request()
+            if api_key is None and not g.openai_limiter.key_pool:
                 return "Missing or invalid Authorization header", 401
-            api_key = auth.replace("Bearer ", "", 1)
 
             client_ip = g.proxy_manager._get_client_ip()
             log.info("👤 Client: %s", color_ip(client_ip, is_local=True))
@@ -817,11 +865,13 @@ def register_routes(app):
                 "method": "POST",
                 "headers": {
                     "Content-Type": "application/json",
-                    "Authorization": f"Bearer {api_key}",
                     "User-Agent": "MyAppGPT/1.0",
                 },
                 "body": req_json,
             }
+            # Без ключа клиента ключ выберет пул (execute_openai_request_parallel)
+            if api_key is not None:
+                request_data["headers"]["Authorization"] = f"Bearer {api_key}"
 
             log.info("📤 OpenAI Request: POST %s", request_data["url"])
             log.debug("Payload: %s", maybe_truncate(json.dumps(req_json), 200))
@@ -889,28 +939,25 @@ def register_routes(app):
         """
         Прокси-эндпоинт для ElevenLabs TTS.
         Ставит запрос в очередь и ждёт готовый MP3 (до 10 минут).
+        С ``stream=1`` отдаёт MP3 по частям по мере генерации.
+        Повторный запрос с теми же параметрами отдаётся из дискового кеша
+        (заголовок ``X-Cache: HIT``) без траты квоты.
         """
 
-        text     = request.args.get("text")
-        voice_id = request.args.get("voice_id", "EXAVITQu4vr4xnSDxMaL")
+        text, voice_id, cfg = _tts_params(request.args)
         if not text:
             return make_response("Parameter 'text' is required", 400)
 
-        model_id = request.args.get("model_id", g.elevenlabs_manager.config.get("model_id"))
-        allowed = MODEL_VOICE_PARAMS.get(model_id, VOICE_DEFAULTS.keys())
-
-        cfg = {
-            "model_id": model_id,
-        }
+        log.info("📥 ElevenLabs request: text_len=%d, voice=%s", len(text), voice_id)
 
-        for param in allowed:
-            raw = request.args.get(param)
-            if param == "use_speaker_boost":
-                cfg[param] = (raw if raw is not None else str(VOICE_DEFAULTS[param])).lower() == "true"
-            else:
-                cfg[param] = float(raw) if raw is not None else VOICE_DEFAULTS[param]
+        # 0. Дисковый кеш: одинаковый запрос не тратит квоту
+        cache_key = g.elevenlabs_queue.cache_key(text, voice_id, cfg)
+        cached = _send_cached_tts(cache_key)
+        if cached is not None:
+            return cached
 
-        log.info("📥 ElevenLabs request: text_len=%d, voice=%s", len(text), voice_id)
+        if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+            return _with_cache_headers(_stream_elevenlabs(text, voice_id, cfg), cache_key)
 
         # 1. Кладём задачу в очередь
         req_id = g.elevenlabs_queue.add_request(text, voice_id, cfg)
@@ -921,16 +968,287 @@ def register_routes(app):
             return make_response("Timeout waiting for TTS", 504)
 
         if result.get("success"):
-            return add_cors(send_file(
+            return _with_cache_headers(add_cors(send_file(
                 io.BytesIO(result["content"]),
                 mimetype=result.get("content_type", "audio/mpeg"),
                 as_attachment=False,
                 download_name="tts.mp3"
-            ))
+            )), cache_key)
 
         # Ошибка генерации
         return add_cors(make_response(result.get("error", "Generation failed"), 502))
 
+    def _tts_params(source):
+        """(text, voice_id, cfg) из query-параметров или JSON-тела."""
+        text     = source.get("text")
+        voice_id = source.get("voice_id", "EXAVITQu4vr4xnSDxMaL")
+
+        model_id = source.get("model_id", g.elevenlabs_manager.config.get("model_id"))
+        allowed = MODEL_VOICE_PARAMS.get(model_id, VOICE_DEFAULTS.keys())
+
+        cfg = {
+            "model_id": model_id,
+        }
+
+        for param in allowed:
+            raw = source.get(param)
+            if param == "use_speaker_boost":
+                cfg[param] = str(raw if raw is not None else VOICE_DEFAULTS[param]).lower() == "true"
+            else:
+                cfg[param] = float(raw) if raw is not None else VOICE_DEFAULTS[param]
+        return text, voice_id, cfg
+
+    def _with_cache_headers(resp, cache_key, status="MISS"):
+        if cache_key:
+            resp.headers["X-Cache"] = status
+            resp.headers["X-Cache-Key"] = cache_key
+            resp.headers["Access-Control-Expose-Headers"] = "X-Cache, X-Cache-Key"
+        return resp
+
+    def _send_cached_tts(cache_key, path=None):
+        """Ответ из кеша TTS (sendfile по пути файла) или None при промахе."""
+        cache = g.elevenlabs_queue.cache
+        if path is None and cache_key:
+            path = cache.lookup(cache_key)
+        if path is None:
+            return None
+        try:
+            resp = send_file(
+                path,
+                mimetype="audio/mpeg",
+                as_attachment=False,
+                download_name="tts.mp3",
+                conditional=True,
+                etag=cache_key,
+                max_age=86400,
+            )
+        except FileNotFoundError:
+            # Файл вытеснен между lookup и отдачей — генерируем заново
+            return None
+        log.info("🗄️ TTS cache hit %s", cache_key[:12])
+        return _with_cache_headers(add_cors(resp), cache_key, "HIT")
+
+    def _stream_elevenlabs(text, voice_id, cfg):
+        """Стримит аудио из очереди; квота списывается после окончания стрима."""
+        queue = g.elevenlabs_queue
+        req_id = queue.add_request(text, voice_id, cfg, stream=True)
+        channel = queue.get_stream(req_id)
+
+        # Ждём первый чанк или ошибку, чтобы успеть вернуть корректный статус
+        if not channel.started.wait(timeout=999999):
+            channel.cancel()
+            return make_response("Timeout waiting for TTS", 504)
+        if channel.error and not channel.bytes_sent:
+            queue.release_result(req_id)
+            return add_cors(make_response(channel.error, 502))
+
+        def generate():
+            try:
+                yield from channel
+            finally:
+                queue.release_result(req_id)
+
+        return add_cors(Response(stream_with_context(generate()), mimetype="audio/mpeg"))
+
+    # ====== Асинхронные задачи TTS: HTTP-поток не ждёт генерацию ======
+
+    @app.route("/elevenlabs/jobs", methods=["POST"])
+    def submit_elevenlabs_job():
+        """Ставит TTS-задачу в очередь и сразу возвращает её id."""
+        params = request.get_json(silent=True)
+        if not isinstance(params, dict):
+            params = request.form.to_dict() or request.args.to_dict()
+        try:
+            text, voice_id, cfg = _tts_params(params)
+        except (TypeError, ValueError) as e:
+            return add_cors(jsonify({"success": False, "error": f"Invalid parameter: {e}"})), 400
+        if not text:
+            return add_cors(jsonify({"success": False, "error": "Parameter 'text' is required"})), 400
+
+        queue = g.elevenlabs_queue
+        cache_key = queue.cache_key(text, voice_id, cfg)
+        if cache_key and queue.cache.lookup(cache_key):
+            job_id = queue.add_cached_result(cache_key)
+        else:
+            job_id = queue.add_request(text, voice_id, cfg)
+        log.info("📥 ElevenLabs job %s: text_len=%d, voice=%s", job_id[:8], len(text), voice_id)
+
+        status = queue.job_status(job_id) or {"job_id": job_id, "status": "failed"}
+        status.update({
+            "success": True,
+            "status_url": f"/elevenlabs/jobs/{job_id}",
+            "audio_url": f"/elevenlabs/jobs/{job_id}/audio",
+        })
+        return add_cors(jsonify(status)), 202
+
+    @app.route("/elevenlabs/jobs/<job_id>", methods=["GET"])
+    def elevenlabs_job_status(job_id):
+        status = g.elevenlabs_queue.job_status(job_id)
+        if status is None:
+            return add_cors(jsonify({"success": False, "error": "Unknown or expired job"})), 404
+        return add_cors(jsonify({"success": True, **status}))
+
+    @app.route("/elevenlabs/jobs/<job_id>/audio", methods=["GET"])
+    def elevenlabs_job_audio(job_id):
+        """Отдаёт готовый MP3 (один раз — после этого задача забывается)."""
+        queue = g.elevenlabs_queue
+        status = queue.job_status(job_id)
+        if status is None:
+            return add_cors(jsonify({"success": False, "error": "Unknown or expired job"})), 404
+        if status["status"] in ("queued", "processing"):
+            return add_cors(jsonify({"success": True, **status})), 202
+
+        result = queue.results.pop(job_id) or {}
+        if not result.get("success"):
+            return add_cors(jsonify({
+                "success": False, "job_id": job_id, "error": result.get("error", "Generation failed"),
+            })), 502
+        if result.get("cached"):
+            # Попадание в кеш уже посчитано при постановке задачи
+            resp = _send_cached_tts(result["cache_key"], queue.cache.path_for(result["cache_key"]))
+            if resp is None:
+                return add_cors(jsonify({"success": False, "error": "Cached audio expired"})), 410
+            return resp
+        return add_cors(send_file(
+            io.BytesIO(result["content"]),
+            mimetype=result.get("content_type", "audio/mpeg"),
+            as_attachment=False,
+            download_name="tts.mp3"
+        ))
+
+    @app.route("/elevenlabs/bulk", methods=["POST"])
+    def submit_elevenlabs_bulk():
+        """
+        Пакетная постановка TTS: ``{"items": [{text, voice_id, model_id, ...}], "defaults": {...}}``.
+        Все строки уходят в очередь одной пачкой — распределение по аккаунтам видит всю нагрузку.
+        ``format``: ``jobs`` (по умолчанию, id задач), ``zip`` или ``multipart`` (ждут все результаты).
+        """
+        body = request.get_json(silent=True)
+        if isinstance(body, list):
+            body = {"items": body}
+        if not isinstance(body, dict) or not isinstance(body.get("items"), list) or not body["items"]:
+            return add_cors(jsonify({"success": False, "error": "Body must contain a non-empty 'items' list"})), 400
+        defaults = body.get("defaults") if isinstance(body.get("defaults"), dict) else {}
+        fmt = (request.args.get("format") or body.get("format") or "jobs").lower()
+        if fmt not in ("jobs", "zip", "multipart"):
+            return add_cors(jsonify({"success": False, "error": f"Unknown format: {fmt}"})), 400
+
+        parsed = []
+        for pos, item in enumerate(body["items"]):
+            if isinstance(item, str):
+                item = {"text": item}
+            try:
+                text, voice_id, cfg = _tts_params({**defaults, **item})
+            except (TypeError, ValueError) as e:
+                return add_cors(jsonify({"success": False, "error": f"items[{pos}]: invalid parameter: {e}"})), 400
+            if not text:
+                return add_cors(jsonify({"success": False, "error": f"items[{pos}]: 'text' is required"})), 400
+            parsed.append((text, voice_id, cfg))
+
+        # Попадания в кеш сразу готовы, остальное — одной пачкой в очередь
+        queue = g.elevenlabs_queue
+        job_ids = [None] * len(parsed)
+        to_queue = []
+        for pos, (text, voice_id, cfg) in enumerate(parsed):
+            cache_key = queue.cache_key(text, voice_id, cfg)
+            if cache_key and queue.cache.lookup(cache_key):
+                job_ids[pos] = queue.add_cached_result(cache_key)
+            else:
+                to_queue.append(pos)
+        for pos, job_id in zip(to_queue, queue.add_requests([parsed[pos] for pos in to_queue])):
+            job_ids[pos] = job_id
+        log.info("📥 ElevenLabs bulk: %d items (%d from cache), format=%s",
+                 len(parsed), len(parsed) - len(to_queue), fmt)
+
+        if fmt == "zip":
+            return _bulk_zip(job_ids)
+        if fmt == "multipart":
+            return _bulk_multipart(job_ids)
+        return add_cors(jsonify({
+            "success": True,
+            "jobs": [{"index": pos, "job_id": job_id, "status_url": f"/elevenlabs/jobs/{job_id}",
+                      "audio_url": f"/elevenlabs/jobs/{job_id}/audio"}
+                     for pos, job_id in enumerate(job_ids)],
+        })), 202
+
+    def _collect_job_audio(job_id):
+        """Ждёт задачу и забирает её результат: (mp3 bytes | None, ошибка | None)."""
+        queue = g.elevenlabs_queue
+        result = queue.wait_for_result(job_id, timeout=999999)
+        if result is None:
+            return None, "Timeout waiting for TTS"
+        if not result.get("success"):
+            return None, result.get("error", "Generation failed")
+        if result.get("cached"):
+            try:
+                return queue.cache.path_for(result["cache_key"]).read_bytes(), None
+            except OSError:
+                return None, "Cached audio expired"
+        return result["content"], None
+
+    def _bulk_zip(job_ids):
+        """ZIP (без сжатия — MP3 уже сжат) с 0001.mp3... и manifest.json."""
+        spool = tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024)
+        manifest = []
+        with zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_STORED) as zf:
+            for pos, job_id in enumerate(job_ids):
+                content, error = _collect_job_audio(job_id)
+                name = f"{pos + 1:04d}.mp3"
+                if content is not None:
+                    zf.writestr(name, content)
+                manifest.append({"index": pos, "job_id": job_id, "file": name if content is not None else None,
+                                 "success": content is not None, "error": error})
+            zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+        spool.seek(0)
+        return add_cors(send_file(spool, mimetype="application/zip", as_attachment=True,
+                                  download_name="tts_bulk.zip"))
+
+    def _bulk_multipart(job_ids):
+        """multipart/mixed: части отдаются по порядку по мере готовности."""
+        boundary = uuid.uuid4().hex
+
+        def generate():
+            for pos, job_id in enumerate(job_ids):
+                content, error = _collect_job_audio(job_id)
+                if content is not None:
+                    head = (f"Content-Type: audio/mpeg\r\n"
+                            f"Content-Disposition: attachment; filename=\"{pos + 1:04d}.mp3\"\r\n")
+                else:
+                    content = json.dumps({"success": False, "error": error}).encode("utf-8")
+                    head = "Content-Type: application/json\r\n"
+                yield (f"--{boundary}\r\n{head}X-Item-Index: {pos}\r\nX-Job-Id: {job_id}\r\n"
+                       f"Content-Length: {len(content)}\r\n\r\n").encode("utf-8")
+                yield content
+                yield b"\r\n"
+            yield f"--{boundary}--\r\n".encode("utf-8")
+
+        return add_cors(Response(stream_with_context(generate()),
+                                 mimetype=f"multipart/mixed; boundary={boundary}"))
+
+    @app.route("/elevenlabs/queue-stats", methods=["GET"])
+    def elevenlabs_queue_stats():
+        try:
+            return jsonify({"success": True, **g.elevenlabs_queue.get_stats()})
+        except Exception as e:
+            log.error(f"❌ Error collecting ElevenLabs queue stats: {e}")
+            return jsonify({"success": False, "error": str(e)}), 500
+
+    @app.route("/openai/batcher-stats", methods=["GET"])
+    def openai_batcher_stats():
+        try:
+            return jsonify({"success": True, **openai_request_batcher.get_stats()})
+        except Exception as e:
+            log.error(f"❌ Error collecting OpenAI batcher stats: {e}")
+            return jsonify({"success": False, "error": str(e)}), 500
+
+    @app.route("/upstream/session-stats", methods=["GET"])
+    def upstream_session_stats():
+        try:
+            return jsonify({"success": True, **session_pool.get_stats()})
+        except Exception as e:
+            log.error(f"❌ Error collecting upstream session stats: {e}")
+            return jsonify({"success": False, "error": str(e)}), 500
+
     @app.route("/elevenlabs/refresh-quotas", methods=["POST"])
     def refresh_elevenlabs_quotas():
         try: